@@ -1,22 +1,94 @@
-from .proxmox_api import ProxmoxClient
-import json
-import logging
-from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
 from datetime import timedelta
+from functools import partial
 
 from dynatrace_extension import Extension
-from dynatrace_extension.sdk.status import StatusValue, Status
+from dynatrace_extension.sdk.status import Status, StatusValue
+
+from .backfill import MAX_BACKFILL_GAP, Backfill, WatermarkStore
+from .cadence import DomainCadence
+from .capture import CaptureRecorder, load_replay
+from .collectors import (
+    COLLECTION_MODE_BULK,
+    COLLECTION_MODE_PER_GUEST,
+    COUNTER_OUTPUT_BOTH,
+    COUNTER_OUTPUT_RAW,
+    DOMAIN_INTERVAL_KEYS,
+    NODE_STATUS_KEYS,
+    STORAGE_MODE_PER_NODE,
+    STORAGE_MODE_SHARED_ONCE,
+    NodeCollectors,
+)
+from .instrumentation import Instrumentation
+from .limiter import AdaptiveLimiter
+from .metric_mapping import undeclared_keys
+from .planner import DOMAIN_CLUSTER, DOMAIN_NODE, DOMAIN_SERVICES, DOMAIN_STORAGE, CollectionPlan
+from .proxmox_api import DEFAULT_REQUEST_TIMEOUT, ProxmoxClient
+from .scheduler import (
+    CYCLE_RUN,
+    CYCLE_SHED,
+    CYCLE_SKIP,
+    OVERRUN_SKIP,
+    CollectionScheduler,
+    CycleGuard,
+    TaskGraph,
+)
+from .snapshot import CycleSnapshot
+
+# Collection engines selectable per endpoint
+ENGINE_THREAD_POOL = "THREAD_POOL"
+ENGINE_ASYNCIO = "ASYNCIO"
+ENGINE_PROCESS_POOL = "PROCESS_POOL"
+
+# Worker processes of the process pool engine when the activation config does not set them
+DEFAULT_PROCESS_WORKERS = 2
+
+# Domains a cycle that overlaps the previous one leaves out by default
+DEFAULT_SHED_DOMAINS = (DOMAIN_STORAGE, DOMAIN_SERVICES)
+
+
+class ProxmoxExtension(Extension, NodeCollectors):  # Enable for testing with DT Extensions SDK
+    worker_initializer = None  # Called first in every collection worker process, must be picklable
 
-class ProxmoxExtension(Extension):  # Enable for testing with DT Extensions SDK
     def __init__(self):
         self.extension_name = "proxmox_extension_topomapping"
-        self.executor = ThreadPoolExecutor(max_workers=10)
+        self.scheduler = None  # Created in initialize, its size comes from the activation config
+        self.async_engine = None  # Created on first use by an endpoint configured for the asyncio engine
+        self.async_engine_lock = threading.Lock()
+        # Created on first use by an endpoint configured for the process pool engine
+        self.process_engine = None
+        self.process_engine_lock = threading.Lock()
+        self.cycle_guards = {}  # ProxmoxClient -> CycleGuard
+        self.inventories = {}  # ProxmoxClient -> InventoryCache
+        self.sinks = {}  # ProxmoxClient -> MetricSink
+        self.rate_stores = {}  # ProxmoxClient -> RateStore, absent when the endpoint sends raw counters only
+        self.cadences = {}  # ProxmoxClient -> DomainCadence
+        self.backfills = {}  # ProxmoxClient -> Backfill, only for endpoints with backfill enabled
+        self.watermarks = None  # WatermarkStore shared by the backfilling endpoints
+        self.plan = CollectionPlan()  # Replaced in initialize once the enabled featureSets are known
         super().__init__()
 
-    def initialize(self, **kwargs):
+    def initialize(self, **_kwargs):
+
+        # The metric tables are checked once against the metrics extension.yaml declares
+        if self.extension_config:
+            undeclared = undeclared_keys(self.extension_config)
+            if undeclared:
+                self.logger.warning(f"Metric keys not declared in extension.yaml: {undeclared}")
+
+        # Requests whose metrics all belong to disabled featureSets are never scheduled
+        feature_sets = self.enabled_feature_sets_names
+        self.plan = CollectionPlan(self.enabled_feature_sets_metrics if feature_sets else None)
+        self.logger.info(f"Collection plan for featureSets {feature_sets}: {self.plan.describe()}")
+
+        # Global cap on collection threads shared by all endpoints
+        max_workers = self.activation_config.get("max_workers", 10)
+        self.scheduler = CollectionScheduler(max_workers=max_workers, logger=self.logger)
 
         endpoints = self.activation_config.get("endpoints")
         for endpoint in endpoints:
+            endpoint_config = endpoint
             frequency = endpoint.get("frequency", 60)  # Default to 60 seconds if not specified
 
             user_key = "user"
@@ -24,19 +96,104 @@ class ProxmoxExtension(Extension):  # Enable for testing with DT Extensions SDK
             user = endpoint.get(user_key)
             token_name = endpoint.get("token_name")
             token_value = endpoint.get("token_value")
+            endpoint_concurrency = endpoint.get("endpoint_concurrency", 5)
+
+            # The asyncio engine always collects per guest, a BULK setting would otherwise be ignored silently
+            engine = endpoint_config.get("engine", ENGINE_THREAD_POOL)
+            collection_mode = endpoint_config.get("collection_mode", COLLECTION_MODE_PER_GUEST)
+            if engine == ENGINE_ASYNCIO and collection_mode == COLLECTION_MODE_BULK:
+                self.logger.warning(
+                    f"The ASYNCIO engine does not support BULK, {host} is collected per guest"
+                )
+
+            # Requests in flight adapt to the latency and overload answers of pveproxy, up to the configured
+            # concurrency
+            limiter = None
+            if endpoint_config.get("adaptive_concurrency", True):
+                if endpoint_config.get("engine", ENGINE_THREAD_POOL) == ENGINE_ASYNCIO:
+                    maximum = endpoint_config.get("async_concurrency", 10)
+                else:
+                    maximum = endpoint_concurrency + 1
+                limiter = AdaptiveLimiter(
+                    maximum, rate=endpoint_config.get("max_requests_per_second", 0), logger=self.logger
+                )
+
+            # Real cycles can be recorded to a capture for offline profiling, and a capture replayed instead
+            # of the API
+            recorder = None
+            if endpoint_config.get("capture_file"):
+                recorder = CaptureRecorder(
+                    endpoint_config["capture_file"],
+                    cycles=endpoint_config.get("capture_cycles", 1),
+                    host=host[0] if isinstance(host, list) and host else host,
+                    logger=self.logger,
+                )
+                if endpoint_config.get("engine", ENGINE_THREAD_POOL) == ENGINE_PROCESS_POOL:
+                    self.logger.warning(
+                        f"The worker processes of {host} do not record, only cluster requests are captured"
+                    )
+            replay = None
+            if endpoint_config.get("replay_file"):
+                replay = load_replay(
+                    endpoint_config["replay_file"],
+                    speed=endpoint_config.get("replay_speed", 1.0),
+                    logger=self.logger,
+                )
 
-            # Create and initialize Proxmox client
+            # Create and initialize Proxmox client, its requests and collection tasks are timed per cycle
+            instrumentation = Instrumentation(logger=self.logger)
             endpoint = ProxmoxClient(
                 host=host,
                 user=user,
                 token_name=token_name,
                 token_value=token_value,
-                verify_ssl=False
+                verify_ssl=False,
+                pool_size=endpoint_concurrency + 1,  # One extra connection for the monitor callback itself
+                instrumentation=instrumentation,
+                discover_hosts=endpoint_config.get("discover_hosts", False),
+                timeout=endpoint_config.get("request_timeout", DEFAULT_REQUEST_TIMEOUT),
+                limiter=limiter,
+                recorder=recorder,
+                replay=replay,
+                stream_lists=endpoint_config.get("stream_lists", True),
+            )
+            guard = CycleGuard(
+                endpoint,
+                self.scheduler,
+                policy=endpoint_config.get("overrun_policy", OVERRUN_SKIP),
+                on_complete=self.complete_cycle,
+                on_coalesced=partial(self.submit_cycle, endpoint_config=endpoint_config),
+                logger=self.logger,
+            )
+            self.cycle_guards[endpoint] = guard
+            cadence = DomainCadence(
+                frequency,
+                {domain: endpoint_config.get(key, 0) for domain, key in DOMAIN_INTERVAL_KEYS.items()},
+                logger=self.logger,
+            )
+            self.cadences[endpoint] = cadence
+            self.logger.info(f"Domain intervals for {endpoint}: {cadence.describe()}")
+            self.register_endpoint_state(endpoint, endpoint_config, cadence)
+            counter_output = endpoint_config.get("counter_output", COUNTER_OUTPUT_BOTH)
+            if endpoint_config.get("backfill", False):
+                if self.watermarks is None:
+                    state_file = self.activation_config.get("backfill_state_file")
+                    self.watermarks = WatermarkStore(state_file, logger=self.logger)
+                self.backfills[endpoint] = Backfill(
+                    self.watermarks,
+                    endpoint.host,
+                    frequency,
+                    max_gap=endpoint_config.get("backfill_max_gap", MAX_BACKFILL_GAP),
+                    rates=counter_output != COUNTER_OUTPUT_RAW,
+                    logger=self.logger,
+                )
+            self.scheduler.register(
+                endpoint, endpoint_concurrency, on_idle=guard.on_idle, on_task=instrumentation.record_task
             )
 
             # Schedule the monitor method to be run every <frequency> seconds
-            # We also pass the endpoint as a parameter to this method
-            self.schedule(self.monitor, timedelta(seconds=frequency), (endpoint,))
+            # We also pass the endpoint and its configuration as parameters to this method
+            self.schedule(self.monitor, timedelta(seconds=frequency), (endpoint, endpoint_config))
 
     def fastcheck(self) -> Status:
         """
@@ -47,114 +204,308 @@ class ProxmoxExtension(Extension):  # Enable for testing with DT Extensions SDK
         """
         return Status(StatusValue.OK)
 
-    def monitor(self, endpoint: dict):
-        endpoint.initialize_proxmoxapi()
-
-        # Fetch cluster status
-        clusterStatusRequest = "cluster/status"
-        cluster_status_get = endpoint.get_metrics(clusterStatusRequest)
-        # self.logger.info(f"Collected cluster level status info")
-
-        # Parse the JSON string
-        cluster_status = json.loads(cluster_status_get)
-        self.logger.info(f"Collected cluster level status info: {cluster_status}")
-
-        # Initialize containers
-        cluster_info = {}
-        node_info_list = []
-        sdn_info_list = []
+    def monitor(self, endpoint: dict, endpoint_config: dict = None):
+        endpoint_config = endpoint_config or {}
+        guard = self.cycle_guards[endpoint]
+
+        # The previous cycle may still have tasks queued on the scheduler
+        # Sent with the time of the decision, a skipped cycle flushes it instead of waiting for the
+        # running one
+        decision = guard.begin()
+        sink = self.sinks[endpoint]
+        batch = sink.batch({"endpoint": endpoint.host}, timestamp=int(time.time() * 1000))
+        batch.add("proxmox.extension.cycle.overrun", 0 if decision == CYCLE_RUN else 1)
+        batch.commit()
+        if decision == CYCLE_SKIP:
+            sink.flush()
+            return
+
+        skip_domains = ()
+        if decision == CYCLE_SHED:
+            skip_domains = tuple(endpoint_config.get("shed_domains", DEFAULT_SHED_DOMAINS))
+            self.logger.warning(f"Shedding domains {skip_domains} for {endpoint} in this cycle")
+
+        start = time.perf_counter()
+        failed = True
+        try:
+            self.collect_cycle(endpoint, endpoint_config, skip_domains)
+            failed = False
+        finally:
+            # Recorded before end_submission, which may complete the cycle and take the snapshot
+            if endpoint.instrumentation is not None:
+                endpoint.instrumentation.record_task("collect_cycle", time.perf_counter() - start, failed)
+            guard.end_submission()
+
+    def submit_cycle(self, endpoint, endpoint_config: dict = None):
+        # Runs a coalesced cycle on its own thread like a monitor callback, outside the endpoint's budget
+        # A step that blocks its thread, like the asyncio engine, would otherwise hold one of its slots
+        threading.Thread(
+            target=self.monitor,
+            args=(endpoint, endpoint_config),
+            name=f"proxmox-coalesced-{endpoint.host}",
+            daemon=True,
+        ).start()
+
+    def complete_cycle(self, endpoint, duration, graphs):
+        # Hands the rest of the cycle's metric lines, including its self-monitoring, to the SDK
+        sink = self.sinks[endpoint]
+        sink.add("proxmox.extension.cycle.duration", round(duration, 6), {"endpoint": endpoint.host})
+        self.report_critical_path(sink, endpoint, graphs)
+        self.report_instrumentation(sink, endpoint)
+        sink.flush()
+        if endpoint.recorder is not None:
+            endpoint.recorder.complete_cycle()
+            self.logger.info(f"Capture stats for {endpoint}: {endpoint.recorder.stats()}")
+        backfill = self.backfills.get(endpoint)
+        if backfill is not None:
+            backfill.complete_cycle()
+            self.logger.info(f"Backfill stats for {endpoint}: {backfill.stats()}")
+        self.logger.info(f"Metric sink stats for {endpoint}: {sink.stats()}")
+
+    def report_critical_path(self, sink, endpoint, graphs):
+        # The chain of requests and steps the cycle waited for, and how much of it was spent waiting for a
+        # worker
+        # With a shed cycle overlapping, the graph whose last task ended last kept the cycle from completing
+        paths = [(graph, *graph.critical_path()) for graph in graphs]
+        paths = [entry for entry in paths if entry[1]]
+        if not paths:
+            return
+        graph, path, length, queued = max(paths, key=lambda entry: entry[1][-1].ended)
+        self.logger.info(
+            f"Critical path of the cycle for {endpoint}: {length * 1000:.0f}ms, "
+            f"{queued * 1000:.0f}ms queued, {graph.describe_path(path)}"
+        )
+        batch = sink.batch({"endpoint": endpoint.host})
+        batch.add("proxmox.extension.cycle.critical_path", round(length, 6))
+        batch.add("proxmox.extension.cycle.critical_path.queued", round(queued, 6))
+        batch.commit()
+
+    def report_instrumentation(self, sink, endpoint):
+        # API latency and errors per path template, collector durations and the cycle's totals
+        if endpoint.instrumentation is None:
+            return
+        requests, tasks, slowest = endpoint.instrumentation.cycle_snapshot()
+        endpoint_dimensions = {"endpoint": endpoint.host}
+
+        for template, stats in requests.items():
+            batch = sink.batch({**endpoint_dimensions, "path": template})
+            batch.add_summary(
+                "proxmox.extension.api.latency",
+                round(stats.minimum, 6),
+                round(stats.maximum, 6),
+                round(stats.total, 6),
+                stats.count,
+            )
+            batch.add("proxmox.extension.api.latency.p95", round(stats.percentile(0.95), 6))
+            batch.add("proxmox.extension.api.errors", stats.errors)
+            batch.add("proxmox.extension.api.timeouts", stats.timeouts)
+            batch.commit()
+
+        for name, stats in tasks.items():
+            batch = sink.batch({**endpoint_dimensions, "collector": name})
+            batch.add_summary(
+                "proxmox.extension.collector.duration",
+                round(stats.minimum, 6),
+                round(stats.maximum, 6),
+                round(stats.total, 6),
+                stats.count,
+            )
+            batch.add("proxmox.extension.collector.failures", stats.errors)
+            batch.commit()
 
-        # Ensure cluster_status is a list
-        if isinstance(cluster_status, list):
-            for item in cluster_status:
-                if isinstance(item, dict):
-                    item_type = item.get("type")
-                    if item_type == "cluster":
-                        cluster_info = {
-                            "id": item.get("id"),
-                            "name": item.get("name"),
-                            "nodes_count": item.get("nodes")
-                        }
-                    elif item_type == "node":
-                        node_info = {
-                            "id": item.get("id"),
-                            "name": item.get("name"),
-                            "online": item.get("online"),
-                            "local": item.get("local"),
-                            "ip": item.get("ip")
-                        }
-                        node_info_list.append(node_info)
-                    elif item_type == "sdn":
-                        sdn_info = {
-                            "id": item.get("id"),
-                            "node": item.get("node"),
-                            "status": item.get("status"),
-                            "sdn": item.get("sdn")
-                        }
-                        sdn_info_list.append(sdn_info)  
-                else:
-                    self.logger.error(f"Unexpected item type: {type(item)} - {item}")
-        else:
-            self.logger.error(f"cluster_status is not a list. Check the source of the data.")
+        batch = sink.batch(endpoint_dimensions)
+        batch.add("proxmox.extension.cycle.requests", sum(stats.count for stats in requests.values()))
+        batch.add("proxmox.extension.cycle.errors", sum(stats.errors for stats in requests.values()))
+        if endpoint.limiter is not None:
+            batch.add("proxmox.extension.api.concurrency", endpoint.limiter.stats()["limit"])
+        batch.commit()
 
-        # Setting cluster dimension variables
-        cluster_name = cluster_info.get("name")
-        cluster_id = cluster_info.get("id")
+        endpoint.instrumentation.dump_slowest(endpoint, requests, slowest)
 
-        # Determining the number of online nodes vs total nodes in cluster
-        cluster_node_count = cluster_info.get("nodes_count")
-        cluster_node_online_count = sum(
-            1 for node in node_info_list
-            if node['online'] == 1
+    def collect_cycle(self, endpoint, endpoint_config: dict, skip_domains=()):
+        # Re-uses the pooled keep-alive session, only rebuilt after an auth or transport failure
+        endpoint.initialize_proxmoxapi()
+        self.logger.info(f"Connection pool stats for {endpoint}: {endpoint.pool_stats()}")
+        self.logger.info(f"API host stats for {endpoint}: {endpoint.host_stats()}")
+        if endpoint.limiter is not None:
+            self.logger.info(f"API concurrency limiter stats for {endpoint}: {endpoint.limiter.stats()}")
+        if endpoint.replay is not None:
+            self.logger.info(f"Replay stats for {endpoint}: {endpoint.replay.stats()}")
+        if endpoint.recorder is not None:
+            endpoint.recorder.start_cycle()
+
+        # Guest-agent IPs are only looked up again when expired, spread over cycles by the refresh budget
+        inventory = self.inventories[endpoint]
+        inventory.start_cycle()
+        self.logger.info(f"Inventory cache stats for {endpoint}: {inventory.stats()}")
+
+        # Guests not seen for a few cycles give their rate slot back
+        rates = self.rate_stores.get(endpoint)
+        if rates is not None:
+            rates.start_cycle()
+            self.logger.info(f"Counter rate store stats for {endpoint}: {rates.stats()}")
+
+        # Every metric line of this cycle carries the same timestamp
+        sink = self.sinks[endpoint]
+        sink.start_cycle()
+
+        # Domains of disabled featureSets are skipped just like shed ones, slow domains wait for their
+        # interval
+        skip_domains = self.plan.skipped_domains.union(skip_domains)
+        waiting = self.cadences[endpoint].next_cycle(skip_domains)
+        if waiting:
+            self.logger.info(f"Domains {sorted(waiting)} of {endpoint} are not due in this cycle")
+            skip_domains = skip_domains.union(waiting)
+        collect_cluster = DOMAIN_CLUSTER not in skip_domains
+
+        # The cycle is a graph of requests and steps, each starts on the scheduler as soon as its inputs
+        # are ready
+        # A step that runs on this callback waits for its inputs at most one interval
+        frequency = endpoint_config.get("frequency", 60)
+        graph = TaskGraph(self.scheduler, endpoint, timeout=frequency, logger=self.logger)
+        self.cycle_guards[endpoint].add_graph(graph)
+        cluster_status_request = "cluster/status"
+        cluster_status = graph.add(
+            endpoint.fetch_list, cluster_status_request, ("type",), label=cluster_status_request
         )
 
-        # Determine SDN status for the cluster
-        sdn_status = 1
-        for sdn in sdn_info_list:
-            if sdn_status == 1:
-                if sdn['status'] == 'ok':
-                    sdn_status = 1
-                else:
-                    sdn_status = 0
-            elif sdn_status == 0:
-                sdn_status = 0
-
-
-        # Define dimensions for the cluster
-        cluster_dimensions = {
-            "cluster": cluster_name,
-            "clusterid": cluster_id,
-        }
-        # self.logger.info(f"Collected cluster level dimensions: {cluster_dimensions}")
+        # HA status does not need cluster/status, it is not requested at all when both HA metrics are disabled
+        cluster_ha_status_request = "cluster/ha/status/current"
+        collect_cluster_ha = self.plan.cluster_ha and collect_cluster
+        cluster_ha_status = ()
+        if collect_cluster_ha:
+            cluster_ha_status = (
+                graph.add(
+                    endpoint.fetch_list, cluster_ha_status_request, ("type",), label=cluster_ha_status_request
+                ),
+            )
 
-        # Sending to metrics server for cluster
-        self.report_metric(
-            "proxmox.cluster.node", cluster_node_count, cluster_dimensions
+        engine = endpoint_config.get("engine", ENGINE_THREAD_POOL)
+        node_collection = graph.add(
+            self.start_node_collection,
+            endpoint,
+            endpoint_config,
+            skip_domains,
+            engine not in (ENGINE_ASYNCIO, ENGINE_PROCESS_POOL),
+            after=(cluster_status,),
         )
-        self.report_metric(
-            "proxmox.cluster.node.online", cluster_node_online_count, cluster_dimensions
+        graph.add(
+            self.report_cluster_metrics,
+            endpoint,
+            collect_cluster,
+            collect_cluster_ha,
+            after=(node_collection,) + cluster_ha_status,
         )
 
-        self.report_metric(
-            "proxmox.cluster.sdn.status", sdn_status, cluster_dimensions
-        )
-
-        self.logger.info(f"Sent to metrics server for cluster: {cluster_name} with dimensions: {cluster_dimensions}")
-
-        # Fetch cluster HA status
-        clusterHaStatusRequest = "cluster/ha/status/current"
-        cluster_ha_status_get = endpoint.get_metrics(clusterHaStatusRequest)
-        # self.logger.info(f"Collected cluster high availability status info")
-
-        # Parse the JSON string
-        cluster_ha_status = json.loads(cluster_ha_status_get)
-        self.logger.info(f"Collected cluster high availability status info: {cluster_ha_status}")      
+        if engine == ENGINE_ASYNCIO:
+            # The asyncio engine always collects per guest, it blocks this callback until the cycle completes
+            concurrency = endpoint_config.get("async_concurrency", 10)
+            graph.run_inline(
+                self.run_async_cycle,
+                endpoint,
+                concurrency,
+                skip_domains,
+                after=(node_collection,),
+                label="async_engine",
+            )
+        elif engine == ENGINE_PROCESS_POOL:
+            # The nodes are collected by the worker processes, this callback waits for their lines and
+            # emits them
+            graph.run_inline(
+                self.run_process_cycle,
+                endpoint,
+                endpoint_config,
+                skip_domains,
+                after=(cluster_status, node_collection),
+                label="process_engine",
+            )
 
+    def start_node_collection(
+        self, endpoint, endpoint_config: dict, skip_domains, submit: bool, cluster_status
+    ):
+        self.logger.info(f"Collected cluster level status info: {cluster_status}")
+        sink = self.sinks[endpoint]
+
+        # One read-only snapshot of the cluster and its nodes is shared by every collector of the cycle
+        storage_mode = endpoint_config.get("storage_mode", STORAGE_MODE_PER_NODE)
+        shared_storage_once = storage_mode == STORAGE_MODE_SHARED_ONCE
+        snapshot = CycleSnapshot.from_cluster_status(cluster_status, self.logger, shared_storage_once)
+
+        # Requests for a node go to its own API when one of the hosts is that node, failed hosts are
+        # checked in the background
+        endpoint.register_nodes(snapshot.nodes)
+        if endpoint.hosts_due():
+            self.scheduler.submit(endpoint, endpoint.check_hosts)
+
+        # Minutes missed since the last completed cycle are replayed from rrddata by the node and guest
+        # collectors
+        backfill = self.backfills.get(endpoint)
+        if backfill is not None and snapshot.nodes:
+            window = backfill.start_cycle(sink.timestamp)
+            if window is not None:
+                self.logger.warning(f"Backfilling {window[1] - window[0]:.0f}s of history for {endpoint}")
+
+        # Offline nodes and nodes whose circuit is open are not asked, their requests would only wait for
+        # a timeout
+        collected_nodes = []
+        for node in snapshot.nodes:
+            if node.online == 0:
+                self.logger.info(f"Node {node.name} is offline, skipping its collection")
+            elif endpoint.node_open(node.name):
+                self.logger.info(f"Node {node.name} did not answer recently, skipping its collection")
+            else:
+                collected_nodes.append(node)
+                continue
+            if DOMAIN_NODE not in skip_domains:
+                self.report_node_metrics(sink, node, {})
+        if len(collected_nodes) < len(snapshot.nodes):
+            self.logger.info(f"Node circuit breaker stats for {endpoint}: {endpoint.breaker_stats()}")
+
+        if submit:
+            self.submit_node_collection(endpoint, endpoint_config, collected_nodes, skip_domains)
+        return snapshot, collected_nodes
+
+    def run_async_cycle(self, endpoint, concurrency, skip_domains, node_collection):
+        snapshot, collected_nodes = node_collection
+        self.get_async_engine().run_cycle(endpoint, collected_nodes, concurrency, skip_domains)
+
+    def run_process_cycle(
+        self, endpoint, endpoint_config: dict, skip_domains, cluster_status, node_collection
+    ):
+        snapshot, collected_nodes = node_collection
+        engine = self.get_process_engine()
+        collected = engine.run_cycle(
+            endpoint, endpoint_config, cluster_status, snapshot, collected_nodes, skip_domains
+        )
+        if not collected:
+            # No worker process is left, the thread pool collects the cycle in this process instead
+            self.logger.warning(
+                f"No collection worker process available, collecting {endpoint} on the thread pool"
+            )
+            self.submit_node_collection(endpoint, endpoint_config, collected_nodes, skip_domains)
+        self.logger.info(f"Process engine stats: {engine.stats()}")
+
+    def report_cluster_metrics(
+        self, endpoint, collect_cluster: bool, collect_cluster_ha: bool, node_collection, cluster_ha_status=()
+    ):
+        snapshot, collected_nodes = node_collection
+        cluster = snapshot.cluster
+
+        # Sending to metrics server for cluster, the HA metrics below are added to the same batch
+        cluster_batch = self.sinks[endpoint].batch(prefix=cluster.dimension_string)
+        if self.plan.cluster and collect_cluster:
+            cluster_batch.add("proxmox.cluster.node", cluster.nodes_count)
+            cluster_batch.add("proxmox.cluster.node.online", cluster.online_count)
+            cluster_batch.add("proxmox.cluster.sdn.status", cluster.sdn_status)
+
+        self.logger.info(
+            f"Sent to metrics server for cluster: {cluster.name} with dimensions: {cluster.dimensions}"
+        )
+        self.logger.info(f"Collected cluster high availability status info: {cluster_ha_status}")
 
         # Ensure cluster_ha_status is a list
         cluster_ha_info = {}
-        if isinstance(cluster_ha_status, list):
-
+        if isinstance(cluster_ha_status, (list, tuple)):
             for item in cluster_ha_status:
                 if isinstance(item, dict):
                     item_type = item.get("type")
@@ -162,507 +513,61 @@ class ProxmoxExtension(Extension):  # Enable for testing with DT Extensions SDK
                         cluster_ha_info = {
                             "id": item.get("id"),
                             "quorate": item.get("quorate"),
-                            "status": item.get("status")
+                            "status": item.get("status"),
                         }
                         self.logger.info(f"Cluster HA Info: {cluster_ha_info}")
                 else:
                     self.logger.error(f"Unexpected item type: {type(item)} - {item}")
         else:
-            self.logger.error(f"cluster_status is not a list. Check the source of the data.")
+            self.logger.error("cluster_status is not a list. Check the source of the data.")
 
         cluster_ha_quorate = cluster_ha_info.get("quorate")
-        cluster_ha_status_value = cluster_ha_info.get("status")
+        cluster_ha_status_value = 1 if cluster_ha_info.get("status") == "OK" else 0
 
-        if cluster_ha_status_value == "OK":
-            cluster_ha_status_value = 1
-        else:
-            cluster_ha_status_value = 0
-            
         # Sending to metrics server for cluster HA info
-        self.report_metric(
-            "proxmox.cluster.ha.quorate", cluster_ha_quorate, cluster_dimensions
-        )
-
-        self.report_metric(
-            "proxmox.cluster.ha.status", cluster_ha_status_value, cluster_dimensions
-        )
-
-        self.executor.submit(self.collect_nodes, endpoint, node_info_list, cluster_dimensions)
-        self.executor.submit(self.collect_storage, endpoint, node_info_list, cluster_dimensions)
-        self.executor.submit(self.collect_qemuvm, endpoint, node_info_list, cluster_dimensions)
-        self.executor.submit(self.collect_lxc, endpoint, node_info_list, cluster_dimensions)
-        self.executor.submit(self.collect_service, endpoint, node_info_list, cluster_dimensions)
-
-    def collect_nodes(self, endpoint, node_info_list, parent_dimensions: dict):
-        # Fetch metrics for each node in cluster
-        for node in node_info_list:
-            node_name = node['name']
-            nodeRequest = "nodes/" + node_name
-            nodeMetricsRequest = nodeRequest + "/status"
-
-            # Returns the metrics for each node
-            node_metrics = endpoint.get_metrics(nodeMetricsRequest)
-
-            # Parse the JSON string
-            node_data = json.loads(node_metrics)
-
-            # Extract Node info
-            node_online = node['online']
-            node_ip = node['ip']
-            node_id = node['id']
-
-            # Extract CPU info
-            cpuinfo_cores = node_data["cpuinfo"]["cores"]
-            cpuinfo_sockets = node_data["cpuinfo"]["sockets"]
-
-            # Extract swap metrics
-            swap_free = node_data["swap"]["free"]
-            swap_total = node_data["swap"]["total"]
-            swap_used = node_data["swap"]["used"]
-
-            # Extract rootfs metrics
-            rootfs_used = node_data["rootfs"]["used"]
-            rootfs_free = node_data["rootfs"]["free"]
-            rootfs_total = node_data["rootfs"]["total"]
-            rootfs_avail = node_data["rootfs"]["avail"]
-
-            # Extract system metrics
-            idle = node_data["idle"]*100
-            cpu = node_data["cpu"]*100
-            uptime = node_data["uptime"]
-            wait = node_data["wait"]*100
-
-            # Extract memory metrics
-            memory_used = node_data["memory"]["used"]
-            memory_total = node_data["memory"]["total"]
-            memory_free = node_data["memory"]["free"]
-
-            # Extract load averages
-            loadavg_1m = float(node_data["loadavg"][0])
-            loadavg_5m = float(node_data["loadavg"][1])
-            loadavg_15m = float(node_data["loadavg"][2])
-
-            # Build node dimensions
-            node_dimensions = {
-                **parent_dimensions,
-                "node": node_name,
-                "nodeip": node_ip,
-                "nodeid": node_id,
-            }
-
-            # Sending to metrics server for node
-            self.report_metric(
-                "proxmox.node.online", node_online, node_dimensions
-            )
-            self.report_metric(
-                "proxmox.node.swap.free", swap_free, node_dimensions
-            )
-            self.report_metric(
-                "proxmox.node.swap.total", swap_total, node_dimensions
-            )
-            self.report_metric(
-                "proxmox.node.swap.used", swap_used, node_dimensions
-            )
-            self.report_metric(
-                "proxmox.node.rootfs.avail", rootfs_avail, node_dimensions
-            )
-            self.report_metric(
-                "proxmox.node.rootfs.used", rootfs_used, node_dimensions
-            )
-            self.report_metric(
-                "proxmox.node.rootfs.free", rootfs_free, node_dimensions
-            )
-            self.report_metric(
-                "proxmox.node.rootfs.total", rootfs_total, node_dimensions
-            )
-            self.report_metric(
-                "proxmox.node.cpu.usage", cpu, node_dimensions
-            )
-            self.report_metric(
-                "proxmox.node.cpu.wait", wait, node_dimensions
-            )
-            self.report_metric(
-                "proxmox.node.cpu.idle", idle, node_dimensions
-            )
-            self.report_metric(
-                "proxmox.node.uptime", uptime, node_dimensions
-            )
-            self.report_metric(
-                "proxmox.node.memory.free", memory_free, node_dimensions
-            )
-            self.report_metric(
-                "proxmox.node.memory.total", memory_total, node_dimensions
-            )
-            self.report_metric(
-                "proxmox.node.memory.used", memory_used, node_dimensions
-            )
-            self.report_metric(
-                "proxmox.node.loadavg.1min", loadavg_1m, node_dimensions
-            )
-            self.report_metric(
-                "proxmox.node.loadavg.5min", loadavg_5m, node_dimensions
-            )
-            self.report_metric(
-                "proxmox.node.loadavg.15min", loadavg_15m, node_dimensions
-            )
-            self.logger.info(f"Sent to metrics server for node: {node_name} with dimensions: {node_dimensions}")
-
-    def collect_storage(self, endpoint, node_info_list, parent_dimensions: dict):
-        # Fetch storage metrics for each node in cluster
-        for node in node_info_list:
-            node_name = node['name']
-            nodeRequest = "nodes/" + node_name
-            nodeStorageRequest = nodeRequest + "/storage"
-            
-            node_storage_metrics = endpoint.get_metrics_2(nodeStorageRequest)
-
-            # Parse the JSON string
-            storage_data = json.loads(node_storage_metrics)
-
-            # Extract Node info
-            node_id = node['id']
-
-            # Loop through each storage entry for this node
-            for entry in storage_data:
-                if entry.get("active") == 1 and entry.get("enabled") == 1:       
-                    storage_name = entry.get("storage")
-                    storage_total = entry.get("total")
-                    storage_used = entry.get("used")
-                    storage_avail = entry.get("avail")
-                    storage_type = entry.get("type")
-
-                    # Build storage dimensions
-                    storage_dimensions = {
-                        **parent_dimensions,
-                        "node": node_name,
-                        "nodeid": node_id,
-                        "nodestorage": storage_name,
-                        "nodestoragetype": storage_type
-                    }
-
-                    # Sending to metrics server for storage
-                    self.report_metric(
-                        "proxmox.node.storage.total", storage_total, storage_dimensions
-                    )
-                    self.report_metric(
-                        "proxmox.node.storage.used", storage_used, storage_dimensions
-                    )
-                    self.report_metric(
-                        "proxmox.node.storage.avail", storage_avail, storage_dimensions
-                    )
-                    self.logger.info(f"Sent to metrics server for storage: {storage_name} for node: {node_name} with dimensions: {storage_dimensions}")
-
-    def collect_qemuvm(self, endpoint, node_info_list, parent_dimensions: dict):
-        # Fetch Qemu-VM metrics for each node in cluster
-        for node in node_info_list:
-            node_vm_count = 0
-            node_name = node['name']
-            nodeRequest = "nodes/" + node_name
-            nodeVmRequest = nodeRequest + "/qemu"
-            
-            # Fetching VM metrics
-            node_vm_entries = endpoint.get_metrics_2(nodeVmRequest)
-
-            # Parse the JSON string
-            vm_entry_data = json.loads(node_vm_entries)
-
-            # Extract Node info
-            node_id = node['id']
-
-            node_dimensions = {
-                **parent_dimensions,
-                "node": node_name,
-                "nodeid": node_id,
-            }
-
-            # Loop through each VM entry for this node to get list of VMs
-            for entry in vm_entry_data:
-                if entry.get("status") == "running":
-                    node_vm_count = node_vm_count + 1
-                    vm_name = entry.get("name")
-                    vm_id = entry.get("vmid")
-
-                    all_ips = ''
-
-                    try:
-                        vmIPSubRequest = nodeVmRequest + "/" + str(vm_id) + "/agent/network-get-interfaces"
-                        vm_ip_info = endpoint.get_metrics_2(vmIPSubRequest)
-                        agent_info = json.loads(vm_ip_info)
-
-                        for interface in agent_info.get('result', []):
-                            for ip in interface.get('ip-addresses', []):
-                                ip_addr = ip.get('ip-address')
-                                if ip_addr and ip_addr != '127.0.0.1' and ':' not in ip_addr:  # exclude loopback and IPv6
-                                    all_ips = ip_addr if all_ips == '' else all_ips + ', ' + ip_addr
-                    except Exception as e:
-                        self.logger.warning(f"Could not retrieve IP/MAC for VM {vm_name}: {e}")
-
-                    # Build VM dimensions with VM IP
-                    vm_dimensions = {
-                        **parent_dimensions,
-                        "node": node_name,
-                        "nodeid": node_id,
-                        "vmname": vm_name,
-                        "vmid": vm_id,
-                        "vmips": all_ips
-                    }
-
-                    # Making request to retrieve metrics for each VM running on the node.
-                    nodeVmSubRequest = nodeVmRequest + "/" + str(vm_id) + "/status/current"
-                    node_vm_metrics = endpoint.get_metrics_2(nodeVmSubRequest)
-
-                    vm_metrics = json.loads(node_vm_metrics)
-
-                    vm_netout = vm_metrics.get("netout")
-                    vm_uptime = vm_metrics.get("uptime")
-                    vm_freemem = vm_metrics.get("freemem")
-                    vm_maxdisk = vm_metrics.get("maxdisk")
-                    vm_diskused = vm_metrics.get("disk")
-                    vm_balloon = vm_metrics.get("balloon")
-                    vm_diskwrite = vm_metrics.get("diskwrite")
-                    vm_netin = vm_metrics.get("netin")
-                    vm_qmpstatus = vm_metrics.get("qmpstatus")
-                    vm_diskread = vm_metrics.get("diskread")
-                    vm_mem = vm_metrics.get("mem")
-                    vm_cpu = vm_metrics.get("cpu")
-                    vm_cpus = vm_metrics.get("cpus")*100
-                    vm_maxmem = vm_metrics.get("maxmem")
-                    vm_status = vm_metrics.get("status")
-
-                    if vm_qmpstatus == "running":
-                        vm_qmpstatus = 1
-                    else:
-                        vm_qmpstatus = 0
-
-                    if vm_status == "running":
-                        vm_status = 1
-                    else:
-                        vm_status = 0                        
-
-                    # Sending metrics to metric server for VM
-                    self.report_metric(
-                        "proxmox.vm.memory.free", vm_freemem, vm_dimensions
-                    )
-                    self.report_metric(
-                        "proxmox.vm.balloon", vm_balloon, vm_dimensions
-                    )
-                    self.report_metric(
-                        "proxmox.vm.qmp.status", vm_qmpstatus, vm_dimensions
-                    )
-                    self.report_metric(
-                        "proxmox.vm.network.netin", vm_netin, vm_dimensions
-                    )
-                    self.report_metric(
-                        "proxmox.vm.network.netout", vm_netout, vm_dimensions
-                    )
-                    self.report_metric(
-                        "proxmox.vm.disk.write", vm_diskwrite, vm_dimensions
-                    )
-                    self.report_metric(
-                        "proxmox.vm.disk.max", vm_maxdisk, vm_dimensions
-                    )
-                    self.report_metric(
-                        "proxmox.vm.disk.used", vm_diskused, vm_dimensions
-                    )
-                    self.report_metric(
-                        "proxmox.vm.disk.read", vm_diskread, vm_dimensions
-                    )
-                    self.report_metric(
-                        "proxmox.vm.memory.max", vm_maxmem, vm_dimensions
-                    )
-                    self.report_metric(
-                        "proxmox.vm.memory.mem", vm_mem, vm_dimensions
-                    )
-                    self.report_metric(
-                        "proxmox.vm.cpu.usable", vm_cpus, vm_dimensions
-                    )
-                    self.report_metric(
-                        "proxmox.vm.cpu.usage", vm_cpu, vm_dimensions
-                    )
-                    self.report_metric(
-                        "proxmox.vm.uptime", vm_uptime, vm_dimensions
-                    )
-                    self.report_metric(
-                        "proxmox.vm.status", vm_status, vm_dimensions
-                    )
-                    self.logger.info(f"Sent to metrics server for VM: {vm_name} for node: {node_name} with dimensions: {vm_dimensions}")
-
-            self.report_metric(
-                "proxmox.node.vm", node_vm_count, node_dimensions
-            )
-            self.logger.info(f"Sent to metrics server for VM count: {node_vm_count} for node: {node_name} with dimensions: {node_dimensions}")
-
-    def collect_lxc(self, endpoint, node_info_list, parent_dimensions: dict):
-        # Fetch LXC-Container metrics for each node in cluster
-        for node in node_info_list:
-            node_lxc_count = 0
-            node_name = node['name']
-            nodeRequest = "nodes/" + node_name
-            nodeLXCRequest = nodeRequest + "/lxc"
-
-            # Fetching VM metrics
-            node_lxc_entries = endpoint.get_metrics_2(nodeLXCRequest)
-
-            # Parse the JSON string
-            lxc_entry_data = json.loads(node_lxc_entries)
-
-            # Extract Node info
-            node_id = node['id']
-
-            node_dimensions = {
-                **parent_dimensions,
-                "node": node_name,
-                "nodeid": node_id,
-            }
-
-            # Loop through each VM entry for this node to get list of VMs
-            for entry in lxc_entry_data:
-                if entry.get("status") == "running":
-                    node_lxc_count = node_lxc_count + 1
-                    lxc_name = entry.get("name")
-                    lxc_id = entry.get("vmid")
-
-                    # Making request to retrieve metrics for each VM running on the node.
-                    nodeLXCSubRequest = nodeLXCRequest + "/" + str(lxc_id) + "/status/current"
-                    node_lxc_metrics = endpoint.get_metrics_2(nodeLXCSubRequest)
-
-                    lxc_metrics = json.loads(node_lxc_metrics)
-
-                    lxc_netout = lxc_metrics.get("netout")
-                    lxc_uptime = lxc_metrics.get("uptime")
-                    lxc_maxswap = lxc_metrics.get("maxswap")
-                    lxc_diskwrite = lxc_metrics.get("diskwrite")
-                    lxc_netin = lxc_metrics.get("netin")
-                    lxc_diskread = lxc_metrics.get("diskread")
-                    lxc_mem = lxc_metrics.get("mem")
-                    lxc_cpu = lxc_metrics.get("cpu")
-                    lxc_cpus = lxc_metrics.get("cpus")
-                    lxc_maxmem = lxc_metrics.get("maxmem")
-                    lxc_status = lxc_metrics.get("status")
-                    lxc_disk = lxc_metrics.get("disk")
-                    lxc_swap = lxc_metrics.get("swap")
-                    lxc_maxdisk = lxc_metrics.get("maxdisk")
-
-                    if lxc_status == "running":
-                        lxc_status = 1
-                    else:
-                        lxc_status = 0            
-
-                    # Build VM dimensions
-                    lxc_dimensions = {
-                        **parent_dimensions,
-                        "node": node_name,
-                        "nodeid": node_id,
-                        "lxcname": lxc_name,
-                        "lxcid": lxc_id,
-                        "lxctype": "lxc"
-                    }
-                    # Sending metrics to metric server for VM
-                    self.report_metric(
-                        "proxmox.lxc.network.netout", lxc_netout, lxc_dimensions
-                    )
-                    self.report_metric(
-                        "proxmox.lxc.uptime", lxc_uptime, lxc_dimensions
-                    )
-                    self.report_metric(
-                        "proxmox.lxc.swap.max", lxc_maxswap, lxc_dimensions
-                    )
-                    self.report_metric(
-                        "proxmox.lxc.disk.write", lxc_diskwrite, lxc_dimensions
-                    )
-                    self.report_metric(
-                        "proxmox.lxc.network.netin", lxc_netin, lxc_dimensions
-                    )
-                    self.report_metric(
-                        "proxmox.lxc.disk.read", lxc_diskread, lxc_dimensions
-                    )
-                    self.report_metric(
-                        "proxmox.lxc.memory.mem", lxc_mem, lxc_dimensions
-                    )
-                    self.report_metric(
-                        "proxmox.lxc.cpu.usage", lxc_cpu, lxc_dimensions
-                    )
-                    self.report_metric(
-                        "proxmox.lxc.cpu.usable", lxc_cpus, lxc_dimensions
-                    )
-                    self.report_metric(
-                        "proxmox.lxc.memory.max", lxc_maxmem, lxc_dimensions
-                    )
-                    self.report_metric(
-                        "proxmox.lxc.status", lxc_status, lxc_dimensions
-                    )
-                    self.report_metric(
-                        "proxmox.lxc.disk.usage", lxc_disk, lxc_dimensions
-                    )
-                    self.report_metric(
-                        "proxmox.lxc.swap.usage", lxc_swap, lxc_dimensions
-                    )
-                    self.report_metric(
-                        "proxmox.lxc.disk.max", lxc_maxdisk, lxc_dimensions
-                    )
-                    self.logger.info(f"Sent to metrics server for VM: {lxc_name} for node: {node_name} with dimensions: {lxc_dimensions}")
-
-            self.report_metric(
-                "proxmox.node.lxc", node_lxc_count, node_dimensions
-            )
-            self.logger.info(f"Sent to metrics server for LXC count: {node_lxc_count} for node: {node_name} with dimensions: {node_dimensions}")
-
-    def collect_service(self, endpoint, node_info_list, parent_dimensions: dict):
-        # Fetch services status for each node in cluster
-
-        for node in node_info_list:
-            node_name = node['name']
-            nodeRequest = "nodes/" + node_name
-            nodeserviceRequest = nodeRequest + "/services"
-            node_service_metrics = endpoint.get_metrics_2(nodeserviceRequest)
-
-            # Parse the JSON string
-            service_data = json.loads(node_service_metrics)
-
-            # Extract Node info
-            node_id = node['id']
-
-            # Loop through each service entry for this node
-            for entry in service_data:
-
-                service_name = entry.get("name")
-                service_id = entry.get("service")
-                service_activestate = entry.get("active-state")
-                service_active = entry.get("active")
-                service_unitstate = entry.get("unit-state")
-
-                if service_activestate == "active": service_activestate = 1 
-                else: service_activestate = 0
-
-                if service_active == "running": service_active = 1 
-                else: service_active = 0                
+        if collect_cluster_ha:
+            cluster_batch.add("proxmox.cluster.ha.quorate", cluster_ha_quorate)
+            cluster_batch.add("proxmox.cluster.ha.status", cluster_ha_status_value)
+        cluster_batch.commit()
+
+    def get_async_engine(self):
+        with self.async_engine_lock:
+            if self.async_engine is None:
+                # Imported here so aiohttp is only loaded when an endpoint uses the asyncio engine
+                from .async_engine import AsyncCollectionEngine
+
+                self.async_engine = AsyncCollectionEngine(self, NODE_STATUS_KEYS, logger=self.logger)
+            return self.async_engine
+
+    def get_process_engine(self):
+        with self.process_engine_lock:
+            if self.process_engine is None:
+                # Imported here so the worker processes are only started when an endpoint uses the process
+                # pool engine
+                from .process_engine import ProcessCollectionEngine
+
+                self.process_engine = ProcessCollectionEngine(
+                    self,
+                    workers=self.activation_config.get("process_workers", DEFAULT_PROCESS_WORKERS),
+                    max_restarts=self.activation_config.get("process_max_restarts", 5),
+                    max_workers=self.scheduler.max_workers,
+                    initializer=self.worker_initializer,
+                    logger=self.logger,
+                )
+            return self.process_engine
 
-                if service_unitstate == "enabled": service_unitstate = 1 
-                else: service_unitstate = 0  
+    def on_shutdown(self):
+        if self.scheduler is not None:
+            self.scheduler.shutdown()
+        if self.async_engine is not None:
+            self.async_engine.close()
+        if self.process_engine is not None:
+            self.process_engine.close()
 
-                # Build node service dimensions
-                service_dimensions = {
-                    **parent_dimensions,
-                    "node": node_name,
-                    "nodeid": node_id,
-                    "service": service_id,
-                    "service_name": service_name
-                }
-
-                # Sending metrics to metric server for node services
-                self.report_metric(
-                    "proxmox.node.service.state", service_active, service_dimensions
-                )
-                self.report_metric(
-                    "proxmox.node.service.activestate", service_activestate, service_dimensions
-                )
-                self.report_metric(
-                    "proxmox.node.service.unitstate", service_unitstate, service_dimensions
-                )
-                self.logger.info(f"Sent to metrics server for service: {service_name} for node: {node_name} with dimensions: {service_dimensions}")
 
 def main():
     ProxmoxExtension().run()
 
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,361 @@
+import asyncio
+import logging
+import threading
+import time
+
+import aiohttp
+
+from .backfill import RRD_PARAMS
+from .instrumentation import OUTCOME_ERROR, OUTCOME_OK, OUTCOME_TIMEOUT
+from .planner import DOMAIN_LXC, DOMAIN_NODE, DOMAIN_SERVICES, DOMAIN_STORAGE, DOMAIN_VM
+from .proxmox_api import route_node
+from .snapshot import is_shared_storage
+
+default_logger = logging.getLogger(__name__)
+default_logger.setLevel(logging.INFO)
+
+PROXMOX_DEFAULT_PORT = 8006
+
+
+class AsyncProxmoxClient:
+    """aiohttp transport for a ProxmoxClient, re-uses its credentials and response validation."""
+
+    def __init__(self, client, concurrency=10, timeout=5, logger=default_logger):
+        self.client = client
+        self.logger = logger
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.base_urls = {}  # API host -> base URL, hosts come from the ProxmoxClient's routing
+        self.headers = {
+            "Authorization": f"PVEAPIToken={client.user}!{client.token_name}={client.token_value}",
+            "Accept": "application/json",
+        }
+        # Created lazily so they are bound to the engine's event loop
+        self.session = None
+        self.semaphore = None
+
+    @staticmethod
+    def build_base_url(host):
+        # Mirrors proxmoxer: bare IPv6 addresses are bracketed and the PVE port is added when missing
+        if host.count(":") > 1 and not host.startswith("["):
+            host = f"[{host}]"
+        if not host.rsplit("]", 1)[-1].count(":"):
+            host = f"{host}:{PROXMOX_DEFAULT_PORT}"
+        return f"https://{host}/api2/json/"
+
+    def base_url(self, host):
+        base_url = self.base_urls.get(host)
+        if base_url is None:
+            base_url = self.base_urls[host] = self.build_base_url(host)
+        return base_url
+
+    def open(self):
+        ssl = None if self.client.verify_ssl else False
+        connector = aiohttp.TCPConnector(limit=self.concurrency, ssl=ssl)
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            headers=self.headers,
+            # Connect and read are bounded each like on the sync client, a large list may take longer in total
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=self.timeout, sock_read=self.timeout),
+        )
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+
+    async def fetch(self, request, params=None):
+        # Returns the decoded "data" member of the response, or None when the request failed
+        node = route_node(request)
+        if node is not None and not self.client.node_available(node):
+            return None
+        if self.session is None or self.session.closed:
+            self.open()
+        limiter = self.client.limiter
+        async with self.semaphore:
+            # Timed once the semaphore and the limiter let it through, so the latency does not include
+            # queueing
+            if limiter is not None:
+                await limiter.acquire_async()
+            start = time.perf_counter()
+            outcome = OUTCOME_OK
+            overloaded = False
+            tried = []
+            try:
+                while True:
+                    # Same host selection and failover as the sync client
+                    api_host = self.client.select_host(node, tried)
+                    if api_host is None:
+                        return None
+                    try:
+                        data = await self.get(api_host.host, request, params)
+                    except Exception as e:
+                        timed_out = isinstance(e, asyncio.TimeoutError)
+                        # Same split as the sync client, a read timeout on a node's request is the node's
+                        # failure
+                        # Connect timeouts are connection errors, read timeouts are SocketTimeoutError
+                        read_timeout = isinstance(e, aiohttp.SocketTimeoutError)
+                        connection_failed = isinstance(e, aiohttp.ClientConnectionError) and not read_timeout
+                        if connection_failed or (timed_out and node is None):
+                            self.client.mark_down(api_host, e)
+                            tried.append(api_host.host)
+                            if len(tried) < len(self.client.api_hosts):
+                                continue
+                        outcome = OUTCOME_TIMEOUT if timed_out else OUTCOME_ERROR
+                        overloaded = self.client.is_overload(request, getattr(e, "status", None), timed_out)
+                        self.logger.error(
+                            f"Error fetching metrics for '{request}' from {api_host.host}: {e!r}"
+                        )
+                        if self.client.recorder is not None:
+                            self.client.recorder.record(
+                                request,
+                                params,
+                                start,
+                                time.perf_counter() - start,
+                                status=getattr(e, "status", None),
+                                timed_out=timed_out,
+                            )
+                        status = getattr(e, "status", None)
+                        if node is not None and self.client.is_node_failure(request, status, timed_out):
+                            self.client.node_failed(node, e)
+                        return None
+                    self.client.mark_up(api_host)
+                    if node is not None:
+                        self.client.node_succeeded(node)
+                    if self.client.recorder is not None:
+                        self.client.recorder.record(request, params, start, time.perf_counter() - start, data)
+                    return data
+            finally:
+                duration = time.perf_counter() - start
+                if limiter is not None:
+                    limiter.release(duration, overloaded, self.client.is_latency_sample(request))
+                if self.client.instrumentation is not None:
+                    self.client.instrumentation.record_request(request, duration, outcome)
+
+    async def get(self, host, request, params=None):
+        replay = self.client.replay
+        if replay is not None:
+            return await self.replay(replay, request, params)
+        async with self.session.get(self.base_url(host) + request, params=params) as response:
+            if response.status >= 400:
+                raise aiohttp.ClientResponseError(
+                    response.request_info, response.history, status=response.status, message=response.reason
+                )
+            body = await response.json(content_type=None)
+            return body.get("data") if isinstance(body, dict) else None
+
+    @staticmethod
+    async def replay(replay, request, params=None):
+        # The recorded answer after its recorded latency, failures raise what the aiohttp transport would
+        record, delay = replay.next_record(request, params)
+        if delay:
+            await asyncio.sleep(delay)
+        return replay.answer(request, record, asyncio.TimeoutError, aiohttp.ClientConnectionError)
+
+    async def fetch_list(self, request, required_keys=(), params=None):
+        return self.client.validate_list(request, await self.fetch(request, params), required_keys)
+
+    async def fetch_dict(self, request, required_keys=()):
+        return self.client.validate_dict(request, await self.fetch(request), required_keys)
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+
+
+class AsyncCollectionEngine:
+    """Runs the per-node collection of a cycle as coroutines on a dedicated event loop thread.
+
+    Node, storage, guest, agent and service requests of all nodes are issued concurrently,
+    bounded per endpoint by the client's semaphore. Metrics are emitted through the same
+    report_* helpers of the extension as the thread-pool collectors.
+    """
+
+    def __init__(self, extension, node_status_keys=(), logger=default_logger):
+        self.extension = extension
+        self.node_status_keys = node_status_keys
+        self.logger = logger
+        self.clients = {}
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="proxmox-asyncio", daemon=True)
+        self.thread.start()
+
+    def run_cycle(self, endpoint, nodes, concurrency=10, skip_domains=()):
+        # Blocks the calling thread until every request of the cycle has completed, nodes are the
+        # snapshot's NodeRecords
+        start = time.perf_counter()
+        cycle = self.collect(endpoint, nodes, concurrency, skip_domains)
+        asyncio.run_coroutine_threadsafe(cycle, self.loop).result()
+        duration = time.perf_counter() - start
+        self.logger.info(
+            f"Asyncio collection for {endpoint} finished in {duration:.3f}s for {len(nodes)} nodes"
+        )
+        return duration
+
+    async def get_client(self, endpoint, concurrency):
+        # A client of another concurrency is closed first, its session would otherwise keep its sockets open
+        client = self.clients.get(id(endpoint))
+        if client is not None and client.concurrency != concurrency:
+            await client.close()
+            client = None
+        if client is None:
+            client = AsyncProxmoxClient(
+                endpoint, concurrency=concurrency, timeout=endpoint.timeout, logger=self.logger
+            )
+            self.clients[id(endpoint)] = client
+        return client
+
+    async def collect(self, endpoint, nodes, concurrency, skip_domains=()):
+        client = await self.get_client(endpoint, concurrency)
+        collectors = [
+            collector
+            for domain, collector in (
+                (DOMAIN_NODE, self.collect_node_status),
+                (DOMAIN_STORAGE, self.collect_node_storage),
+                (DOMAIN_VM, self.collect_node_qemuvm),
+                (DOMAIN_LXC, self.collect_node_lxc),
+                (DOMAIN_SERVICES, self.collect_node_services),
+            )
+            if domain not in skip_domains
+        ]
+        tasks = []
+        for node in nodes:
+            for collector in collectors:
+                tasks.append(self.timed(client, collector(client, node)))
+
+        for result in await asyncio.gather(*tasks, return_exceptions=True):
+            if isinstance(result, Exception):
+                self.logger.error(f"Asyncio collection task failed for {endpoint}: {result!r}")
+
+    async def timed(self, client, coroutine):
+        # Records the collector's duration under its name, like the scheduler does for thread-pool tasks
+        start = time.perf_counter()
+        failed = False
+        try:
+            return await coroutine
+        except Exception:
+            failed = True
+            raise
+        finally:
+            if client.client.instrumentation is not None:
+                duration = time.perf_counter() - start
+                client.client.instrumentation.record_task(coroutine.__name__, duration, failed)
+
+    async def collect_node_status(self, client, node):
+        node_data = await client.fetch_dict(node.request + "/status", self.node_status_keys)
+        if not node_data:
+            self.logger.warning(f"No usable status for node: {node.name}, skipping")
+            return
+        self.extension.report_node_metrics(self.extension.sinks[client.client], node, node_data)
+        await self.backfill_history(client, "node", node.request, prefix=node.status_dimension_string)
+
+    async def collect_node_storage(self, client, node):
+        storage_data = await client.fetch_list(node.request + "/storage", ("storage",))
+        for entry in storage_data:
+            if entry.get("active") == 1 and entry.get("enabled") == 1:
+                self.extension.report_storage_metrics(
+                    self.extension.sinks[client.client],
+                    node,
+                    entry.get("storage"),
+                    entry.get("type"),
+                    entry.get("total"),
+                    entry.get("used"),
+                    entry.get("avail"),
+                    is_shared_storage(entry, entry.get("type")),
+                )
+
+    async def collect_node_qemuvm(self, client, node):
+        vm_entries = await client.fetch_list(node.request + "/qemu", ("vmid",))
+        running = [entry for entry in vm_entries if entry.get("status") == "running"]
+
+        if self.extension.plan.vm_guests:
+            await asyncio.gather(
+                *(self.timed(client, self.collect_vm(client, node, entry)) for entry in running)
+            )
+
+        sink = self.extension.sinks[client.client]
+        sink.add("proxmox.node.vm", len(running), prefix=node.dimension_string)
+
+    async def collect_vm(self, client, node, entry):
+        vm_id = entry.get("vmid")
+        vm_request = node.request + "/qemu/" + str(vm_id)
+
+        vm_metrics = await client.fetch_dict(vm_request + "/status/current", ("status", "cpus"))
+        if not vm_metrics:
+            return
+
+        vm_dimensions = {
+            "vmname": entry.get("name"),
+            "vmid": vm_id,
+            "vmips": await self.get_vm_ips(client, node, entry, vm_metrics.get("uptime")),
+        }
+        self.extension.report_vm_metrics(
+            self.extension.sinks[client.client],
+            node,
+            vm_metrics,
+            vm_dimensions,
+            self.extension.rate_stores.get(client.client),
+        )
+        await self.backfill_history(client, "qemu", vm_request, vm_dimensions, node.dimension_string)
+
+    async def backfill_history(self, client, kind, request, dimensions=None, prefix=""):
+        # Same gap replay as the thread-pool collectors, one rrddata request per node or guest
+        backfill = self.extension.backfills.get(client.client)
+        if backfill is None or backfill.window is None:
+            return
+        rrd_data = await client.fetch_list(request + "/rrddata", ("time",), RRD_PARAMS)
+        backfill.emit(self.extension.sinks[client.client], kind, rrd_data, dimensions, prefix)
+
+    async def get_vm_ips(self, client, node, entry, uptime=None):
+        # Same inventory cache as the thread-pool collectors, the agent is only asked when the entry
+        # needs a lookup
+        inventory = self.extension.inventories[client.client]
+        inventory_key = (node.cluster.name, node.name, entry.get("vmid"))
+        ips, lookup_needed = inventory.needs_lookup(inventory_key, entry.get("name"), uptime)
+        if not lookup_needed:
+            return ips
+
+        request = node.request + "/qemu/" + str(entry.get("vmid")) + "/agent/network-get-interfaces"
+        agent_info = await client.fetch(request)
+        ips = ""
+        if agent_info is not None:
+            ips = self.extension.parse_vm_ips(client.client.validate_dict(request, agent_info))
+        inventory.store(inventory_key, entry.get("name"), ips, agent_info is not None, uptime)
+        return ips
+
+    async def collect_node_lxc(self, client, node):
+        lxc_entries = await client.fetch_list(node.request + "/lxc", ("vmid",))
+        running = [entry for entry in lxc_entries if entry.get("status") == "running"]
+
+        if self.extension.plan.lxc_guests:
+            await asyncio.gather(
+                *(self.timed(client, self.collect_container(client, node, entry)) for entry in running)
+            )
+
+        sink = self.extension.sinks[client.client]
+        sink.add("proxmox.node.lxc", len(running), prefix=node.dimension_string)
+
+    async def collect_container(self, client, node, entry):
+        lxc_id = entry.get("vmid")
+        lxc_request = node.request + "/lxc/" + str(lxc_id)
+        lxc_metrics = await client.fetch_dict(lxc_request + "/status/current", ("status",))
+        if not lxc_metrics:
+            return
+
+        lxc_dimensions = {"lxcname": entry.get("name"), "lxcid": lxc_id, "lxctype": "lxc"}
+        self.extension.report_lxc_metrics(
+            self.extension.sinks[client.client],
+            node,
+            lxc_metrics,
+            lxc_dimensions,
+            self.extension.rate_stores.get(client.client),
+        )
+        await self.backfill_history(client, "lxc", lxc_request, lxc_dimensions, node.dimension_string)
+
+    async def collect_node_services(self, client, node):
+        service_data = await client.fetch_list(node.request + "/services", ("service",))
+        self.extension.report_service_metrics(self.extension.sinks[client.client], node, service_data)
+
+    def close(self):
+        async def close_clients():
+            for client in self.clients.values():
+                await client.close()
+
+        asyncio.run_coroutine_threadsafe(close_clients(), self.loop).result(timeout=10)
+        self.loop.call_soon_threadsafe(self.loop.stop)
@@ -0,0 +1,158 @@
+import json
+import logging
+import tempfile
+import threading
+from pathlib import Path
+
+from .metric_mapping import (
+    LXC_RRD_GAUGE_METRICS,
+    LXC_RRD_METRICS,
+    NODE_RRD_METRICS,
+    VM_RRD_GAUGE_METRICS,
+    VM_RRD_METRICS,
+)
+
+default_logger = logging.getLogger(__name__)
+default_logger.setLevel(logging.INFO)
+
+# rrddata of the last hour has one averaged point per minute, it is the only timeframe with that resolution
+RRD_PARAMS = {"timeframe": "hour", "cf": "AVERAGE"}
+MAX_BACKFILL_GAP = 3600
+
+DEFAULT_STATE_FILE = str(Path(tempfile.gettempdir()) / "dynatrace-proxmox-watermarks.json")
+
+
+class WatermarkStore:
+    """Timestamp of the last successful cycle per endpoint, kept in a JSON file across restarts.
+
+    The file is rewritten through a temporary file and a rename, so a restart in the middle of
+    a write finds either the previous or the new watermarks, never a truncated file.
+    """
+
+    def __init__(self, path=None, logger=default_logger):
+        self.path = path or DEFAULT_STATE_FILE
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.watermarks = self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as state_file:
+                watermarks = json.load(state_file)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            self.logger.warning(
+                f"Could not read the backfill watermarks from {self.path}, starting without: {e!r}"
+            )
+            return {}
+        if not isinstance(watermarks, dict):
+            self.logger.warning(f"Ignoring the backfill watermarks in {self.path}, expected an object")
+            return {}
+        return {key: value for key, value in watermarks.items() if isinstance(value, int)}
+
+    def get(self, key):
+        with self.lock:
+            return self.watermarks.get(key)
+
+    def advance(self, key, timestamp):
+        # Watermarks only move forward, a late completion of an older cycle leaves a newer one in place
+        with self.lock:
+            if timestamp <= self.watermarks.get(key, 0):
+                return
+            self.watermarks[key] = timestamp
+            watermarks = dict(self.watermarks)
+            try:
+                temporary = Path(f"{self.path}.tmp")
+                with temporary.open("w") as state_file:
+                    json.dump(watermarks, state_file)
+                temporary.replace(self.path)
+            except OSError as e:
+                self.logger.warning(f"Could not write the backfill watermarks to {self.path}: {e!r}")
+
+
+class Backfill:
+    """Recovers the minutes one endpoint missed from the rrddata of its nodes and guests.
+
+    A cycle that starts more than one and a half cycles after the watermark opens a window from
+    the watermark to half a cycle before its own timestamp, at most max_gap seconds long. Each
+    node and guest the cycle collects then makes one rrddata request for the whole window and
+    its minute points are sent with their own timestamps. The watermark advances once the cycle
+    has completed, a cycle that could not read cluster/status leaves it where it was.
+    """
+
+    def __init__(self, store, key, frequency, max_gap=MAX_BACKFILL_GAP, rates=True, logger=default_logger):
+        self.store = store
+        self.key = key
+        self.frequency = frequency
+        self.max_gap = min(max_gap, MAX_BACKFILL_GAP)
+        self.logger = logger
+        self.tables = {
+            "node": NODE_RRD_METRICS,
+            "qemu": VM_RRD_METRICS if rates else VM_RRD_GAUGE_METRICS,
+            "lxc": LXC_RRD_METRICS if rates else LXC_RRD_GAUGE_METRICS,
+        }
+        self.lock = threading.Lock()
+        self.window = None  # (start, end) in seconds, both exclusive, None when the cycle has no gap
+        self.covered_until = 0  # End of the last window, an overlapping cycle does not replay it again
+        self.pending = None
+        self.gaps = 0
+        self.points = 0
+
+    def start_cycle(self, timestamp):
+        # timestamp is the cycle's metric timestamp in milliseconds
+        with self.lock:
+            self.pending = timestamp
+            self.window = None
+            last_seen = self.store.get(self.key)
+            if last_seen is None:
+                return None
+            now = timestamp / 1000
+            start = max(last_seen / 1000, self.covered_until, now - self.max_gap)
+            end = now - self.frequency / 2
+            if now - last_seen / 1000 <= 1.5 * self.frequency or end <= start:
+                return None
+            if now - last_seen / 1000 > self.max_gap:
+                self.logger.warning(
+                    f"Gap of {now - last_seen / 1000:.0f}s for {self.key} is longer than {self.max_gap}s, "
+                    f"only its last {self.max_gap}s are backfilled"
+                )
+            self.window = (start, end)
+            self.covered_until = end
+            self.gaps += 1
+            return self.window
+
+    def complete_cycle(self):
+        with self.lock:
+            timestamp, self.pending = self.pending, None
+        if timestamp is not None:
+            self.store.advance(self.key, timestamp)
+
+    def emit(self, sink, kind, rrd_data, dimensions: dict = None, prefix=""):
+        # Sends the points of rrd_data inside the window, one batch per minute with its own timestamp
+        window = self.window
+        if window is None:
+            return 0
+        start, end = window
+        table = self.tables[kind]
+        emitted = 0
+        for point in rrd_data:
+            point_time = point.get("time")
+            if not isinstance(point_time, (int, float)) or not start < point_time < end:
+                continue
+            batch = sink.batch(dimensions, prefix, int(point_time * 1000))
+            table.emit(batch, point)
+            batch.commit()
+            emitted += 1
+        with self.lock:
+            self.points += emitted
+        return emitted
+
+    def add_points(self, points):
+        # Points a collection worker process emitted for this endpoint
+        with self.lock:
+            self.points += points
+
+    def stats(self):
+        with self.lock:
+            return {"gaps": self.gaps, "points": self.points, "watermark": self.store.get(self.key)}
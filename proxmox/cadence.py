@@ -0,0 +1,52 @@
+import logging
+import threading
+import time
+
+default_logger = logging.getLogger(__name__)
+default_logger.setLevel(logging.INFO)
+
+
+class DomainCadence:
+    """Decides which collection domains of one endpoint are due in a cycle.
+
+    The monitor callback runs every `frequency` seconds. A domain with a longer interval is left
+    out of the cycles in between, just like a shed domain, so slow-changing data such as storage
+    and services is requested less often while node and guest metrics keep the base cadence.
+    A domain is due once its interval has passed since it last ran, less half a cycle of slack
+    so the jitter of the SDK scheduler does not push it into the following cycle.
+    """
+
+    def __init__(self, frequency, intervals: dict, logger=default_logger):
+        self.frequency = frequency
+        self.logger = logger
+        # Intervals up to the frequency mean every cycle, those domains need no bookkeeping
+        self.intervals = {
+            domain: interval for domain, interval in intervals.items() if interval and interval > frequency
+        }
+        self.lock = threading.Lock()
+        self.last_run = {}
+
+    def next_cycle(self, excluded=()):
+        # Returns the domains waiting for their interval, due domains not in `excluded` count as run now
+        now = time.monotonic()
+        waiting = set()
+        with self.lock:
+            for domain, interval in self.intervals.items():
+                last_run = self.last_run.get(domain)
+                if last_run is not None and now - last_run < interval - self.frequency / 2:
+                    waiting.add(domain)
+                elif domain not in excluded:
+                    self.last_run[domain] = now
+        return waiting
+
+    def cycles_per_run(self, domains):
+        # How many cycles the slowest of `domains` spans, 1 when they all run every cycle
+        slowest = max(
+            (self.intervals.get(domain, self.frequency) for domain in domains), default=self.frequency
+        )
+        return max(1, -(-int(slowest) // max(1, int(self.frequency))))
+
+    def describe(self):
+        if not self.intervals:
+            return "every domain every cycle"
+        return ", ".join(f"{domain} every {interval}s" for domain, interval in sorted(self.intervals.items()))
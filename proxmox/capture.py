@@ -0,0 +1,204 @@
+import gzip
+import json
+import logging
+import threading
+import time
+
+import requests
+
+default_logger = logging.getLogger(__name__)
+default_logger.setLevel(logging.INFO)
+
+CAPTURE_VERSION = 1
+# Status a replay answers for a request the capture has no record of, like pveproxy for an unknown path
+MISSING_STATUS = 501
+
+
+def params_key(params):
+    # Query parameters in a stable order, so a recorded and a replayed request match whatever order they
+    # were built in
+    return json.dumps(params, sort_keys=True) if params else ""
+
+
+class ReplayError(Exception):
+    """A recorded error answer, it carries its HTTP status under the names proxmoxer and aiohttp use."""
+
+    def __init__(self, request, status):
+        super().__init__(f"{status} recorded for '{request}'")
+        self.status = status
+        self.status_code = status
+
+
+class CaptureRecorder:
+    """Writes the API answers of an endpoint's cycles to a gzip capture, one JSON document per line.
+
+    The first line describes the capture, every further line is one request with its path,
+    query parameters, offset from the start of the capture, latency, status and decoded body.
+    Failed requests are kept with their status, or with status null for a host that did not
+    answer and a timeout flag, so a replay fails them the same way. Only `cycles` cycles are
+    recorded, the file is closed after the last of them.
+    """
+
+    def __init__(self, path, cycles=1, host=None, logger=default_logger):
+        self.path = path
+        self.cycles = cycles
+        self.host = host
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.file = None
+        self.recording = False
+        self.recorded_cycles = 0
+        self.records = 0
+        self.start = None
+
+    def start_cycle(self):
+        with self.lock:
+            if self.recorded_cycles >= self.cycles:
+                return
+            if self.file is None:
+                try:
+                    # Stays open across the recorded cycles, it is closed after the last of them
+                    self.file = gzip.open(self.path, "wt", encoding="utf-8")  # noqa: SIM115
+                except OSError as e:
+                    self.logger.warning(f"Could not open the capture file {self.path}, not recording: {e!r}")
+                    self.recorded_cycles = self.cycles
+                    return
+                self.start = time.perf_counter()
+                header = {"version": CAPTURE_VERSION, "host": self.host, "recorded": int(time.time())}
+                self.file.write(json.dumps(header) + "\n")
+                self.logger.info(f"Recording {self.cycles} cycles of {self.host} to {self.path}")
+            self.recording = True
+
+    def record(self, request, params, started, latency, data=None, status=200, timed_out=False):
+        # started is the perf_counter() at which the request was sent, latency in seconds
+        if not self.recording:
+            return
+        line = json.dumps(
+            {
+                "path": request,
+                "params": params or None,
+                "offset": round(started - self.start, 6),
+                "latency": round(latency, 6),
+                "status": status,
+                "timeout": timed_out,
+                "data": data,
+            }
+        )
+        with self.lock:
+            if self.recording:
+                self.file.write(line + "\n")
+                self.records += 1
+
+    def complete_cycle(self):
+        with self.lock:
+            if not self.recording:
+                return
+            self.recording = False
+            self.recorded_cycles += 1
+            if self.recorded_cycles < self.cycles:
+                self.file.flush()
+                return
+            self.file.close()
+            self.logger.info(
+                f"Capture of {self.host} complete, {self.records} requests written to {self.path}"
+            )
+
+    def stats(self):
+        with self.lock:
+            return {"cycles": self.recorded_cycles, "records": self.records, "recording": self.recording}
+
+
+def load_replay(path, speed=1.0, logger=default_logger):
+    # The ReplayTransport of a capture, or None when it cannot be read, the endpoint then uses the cluster
+    try:
+        return ReplayTransport(path, speed=speed, logger=logger)
+    except (OSError, EOFError, ValueError, KeyError) as e:
+        logger.warning(f"Could not load the capture {path}, not replaying it: {e!r}")
+        return None
+
+
+class ReplayTransport:
+    """Answers the requests of a ProxmoxClient from a capture instead of the network.
+
+    The records of each path and query are answered in their recorded order, and again from the
+    first one once all were served, so a capture of one cycle can be replayed for any number of
+    cycles. Every answer waits for its recorded latency divided by `speed`, a speed of 0 answers
+    at once. Requests the capture has no record of fail with MISSING_STATUS.
+    """
+
+    def __init__(self, path, speed=1.0, logger=default_logger):
+        self.path = path
+        self.speed = speed
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.records = {}  # (path, params key) -> recorded answers in order
+        self.cursors = {}  # (path, params key) -> index of the next answer
+        self.header = {}
+        self.served = 0
+        self.failed = 0
+        self.missing = set()
+        self.load()
+
+    def load(self):
+        with gzip.open(self.path, "rt", encoding="utf-8") as capture:
+            self.header = json.loads(capture.readline() or "{}")
+            if self.header.get("version") != CAPTURE_VERSION:
+                raise ValueError(f"{self.path} is not a capture of version {CAPTURE_VERSION}: {self.header}")
+            for line in capture:
+                record = json.loads(line)
+                self.records.setdefault((record["path"], params_key(record["params"])), []).append(record)
+        self.logger.info(
+            f"Replaying {sum(len(records) for records in self.records.values())} recorded requests of "
+            f"{self.header.get('host')} from {self.path} at speed {self.speed}"
+        )
+
+    def next_record(self, request, params):
+        # The next recorded answer and how long to wait for it, None when the request was never recorded
+        key = (request, params_key(params))
+        with self.lock:
+            records = self.records.get(key)
+            if records is None:
+                self.served += 1
+                self.failed += 1
+                if request not in self.missing:
+                    self.missing.add(request)
+                    self.logger.warning(f"No recorded answer for '{request}' {params or ''} in {self.path}")
+                return None, 0.0
+            cursor = self.cursors.get(key, 0)
+            self.cursors[key] = (cursor + 1) % len(records)
+            record = records[cursor]
+            self.served += 1
+            if record["status"] != 200:
+                self.failed += 1
+        return record, record["latency"] / self.speed if self.speed else 0.0
+
+    def get(self, request, params=None):
+        # Blocking replay for the thread-pool client, raises the exceptions the requests transport would
+        record, delay = self.next_record(request, params)
+        if delay:
+            time.sleep(delay)
+        return self.answer(
+            request, record, requests.exceptions.ReadTimeout, requests.exceptions.ConnectionError
+        )
+
+    @staticmethod
+    def answer(request, record, timeout_error, connection_error):
+        if record is None:
+            raise ReplayError(request, MISSING_STATUS)
+        if record["timeout"]:
+            raise timeout_error(f"Recorded timeout for '{request}'")
+        status = record["status"]
+        if status is None:
+            raise connection_error(f"Recorded connection failure for '{request}'")
+        if status >= 400:
+            raise ReplayError(request, status)
+        return record["data"]
+
+    def stats(self):
+        with self.lock:
+            return {
+                "served": self.served,
+                "failed": self.failed,
+                "paths": len(self.records),
+                "missing": len(self.missing),
+            }
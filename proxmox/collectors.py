@@ -0,0 +1,475 @@
+import logging
+
+from .backfill import RRD_PARAMS
+from .inventory import InventoryCache
+from .metric_mapping import (
+    LXC_COUNTER_RATES,
+    LXC_GAUGE_METRICS,
+    LXC_METRICS,
+    NODE_METRICS,
+    SERVICE_METRICS,
+    STATIC_METRIC_KEYS,
+    VM_COUNTER_RATES,
+    VM_GAUGE_METRICS,
+    VM_METRICS,
+)
+from .metric_sink import ChangeFilter, MetricSink
+from .planner import DOMAIN_CLUSTER, DOMAIN_LXC, DOMAIN_NODE, DOMAIN_SERVICES, DOMAIN_STORAGE, DOMAIN_VM
+from .rates import RateStore
+from .snapshot import is_shared_storage
+
+default_logger = logging.getLogger(__name__)
+default_logger.setLevel(logging.INFO)
+
+# Collection modes selectable per endpoint
+COLLECTION_MODE_PER_GUEST = "PER_GUEST"
+COLLECTION_MODE_BULK = "BULK"
+
+# Guest fields available from cluster/resources
+BULK_GUEST_FIELDS = (
+    "netin",
+    "netout",
+    "diskread",
+    "diskwrite",
+    "disk",
+    "maxdisk",
+    "mem",
+    "maxmem",
+    "cpu",
+    "uptime",
+    "status",
+)
+# Guest fields collect_vm and collect_container take from the guest lists
+GUEST_LIST_FIELDS = ("vmid", "name")
+
+# Guest fields only available from the per-guest status/current endpoint
+VM_DETAIL_FIELDS = ("balloon", "freemem", "qmpstatus")
+LXC_DETAIL_FIELDS = ("swap", "maxswap")
+
+# How storages shared by several nodes are reported, selectable per endpoint
+STORAGE_MODE_PER_NODE = "PER_NODE"
+STORAGE_MODE_SHARED_ONCE = "SHARED_ONCE"
+
+# How the cumulative guest network and disk counters are sent, selectable per endpoint
+COUNTER_OUTPUT_RAW = "RAW"
+COUNTER_OUTPUT_RATE = "RATE"
+COUNTER_OUTPUT_BOTH = "BOTH"
+
+# A nodes/{node}/status response without any of these is not usable
+NODE_STATUS_KEYS = NODE_METRICS.required_keys()
+
+# Endpoint settings holding the polling interval of each domain, 0 or missing means every cycle
+DOMAIN_INTERVAL_KEYS = {
+    DOMAIN_CLUSTER: "cluster_interval",
+    DOMAIN_NODE: "node_interval",
+    DOMAIN_STORAGE: "storage_interval",
+    DOMAIN_SERVICES: "services_interval",
+    DOMAIN_VM: "vm_interval",
+    DOMAIN_LXC: "lxc_interval",
+}
+
+
+class NodeCollectors:
+    """The per-node and per-guest collectors of the thread-pool engine and their reporting helpers.
+
+    ProxmoxExtension collects with them in its own process, ShardCollector in the worker
+    processes of the process pool engine. A class using them provides `logger`, `plan`, the
+    `scheduler` the tasks are submitted to, and the per-endpoint `sinks`, `inventories`,
+    `rate_stores` and `backfills`, all keyed by the ProxmoxClient a collector is given.
+    """
+
+    def register_endpoint_state(self, endpoint, endpoint_config: dict, cadence, reporter=None):
+        # Sink, guest inventory and counter rates of an endpoint, a worker process passes the reporter of
+        # its sink's lines
+        # Static capacities and states are only re-sent on change or as a heartbeat when the endpoint asks
+        # for it
+        static_heartbeat = endpoint_config.get("static_heartbeat", 0)
+        changes = None
+        if static_heartbeat:
+            changes = ChangeFilter(STATIC_METRIC_KEYS, static_heartbeat, logger=self.logger)
+        self.sinks[endpoint] = MetricSink(reporter or self, changes=changes, logger=self.logger)
+        self.inventories[endpoint] = InventoryCache(
+            ttl=endpoint_config.get("inventory_ttl", 600),
+            negative_ttl=endpoint_config.get("agent_retry_interval", 1800),
+            refresh_budget=endpoint_config.get("agent_lookups_per_cycle", 20),
+            logger=self.logger,
+        )
+        counter_output = endpoint_config.get("counter_output", COUNTER_OUTPUT_BOTH)
+        if counter_output != COUNTER_OUTPUT_RAW:
+            # A guest collected only every few cycles must not be taken for gone in between
+            self.rate_stores[endpoint] = RateStore(
+                width=max(len(VM_COUNTER_RATES.rows), len(LXC_COUNTER_RATES.rows)),
+                idle_cycles=3 * cadence.cycles_per_run((DOMAIN_VM, DOMAIN_LXC)),
+                emit_raw=counter_output == COUNTER_OUTPUT_BOTH,
+                logger=self.logger,
+            )
+
+    def submit_node_collection(self, endpoint, endpoint_config: dict, collected_nodes, skip_domains):
+        collection_mode = endpoint_config.get("collection_mode", COLLECTION_MODE_PER_GUEST)
+
+        # Every node is collected by its own set of tasks, bounded by the endpoint's budget on the scheduler
+        # cluster/resources serves storage, VMs and containers at once, it is only shed with all three
+        resources_shed = {DOMAIN_STORAGE, DOMAIN_VM, DOMAIN_LXC}.issubset(skip_domains)
+        if collection_mode == COLLECTION_MODE_BULK and not resources_shed:
+            guest_details = endpoint_config.get("bulk_guest_details", False)
+            self.scheduler.submit(
+                endpoint,
+                self.collect_cluster_resources,
+                endpoint,
+                collected_nodes,
+                guest_details,
+                skip_domains,
+            )
+
+        for node in collected_nodes:
+            if DOMAIN_NODE not in skip_domains:
+                self.scheduler.submit(endpoint, self.collect_node, endpoint, node)
+            if collection_mode != COLLECTION_MODE_BULK:
+                if DOMAIN_STORAGE not in skip_domains:
+                    self.scheduler.submit(endpoint, self.collect_node_storage, endpoint, node)
+                if DOMAIN_VM not in skip_domains:
+                    self.scheduler.submit(endpoint, self.collect_node_qemuvm, endpoint, node)
+                if DOMAIN_LXC not in skip_domains:
+                    self.scheduler.submit(endpoint, self.collect_node_lxc, endpoint, node)
+            if DOMAIN_SERVICES not in skip_domains:
+                self.scheduler.submit(endpoint, self.collect_node_service, endpoint, node)
+
+    def collect_node(self, endpoint, node):
+        # Fetch metrics for a single node in the cluster
+        node_data = endpoint.fetch_dict(node.request + "/status", NODE_STATUS_KEYS)
+        if not node_data:
+            self.logger.warning(f"No usable status for node: {node.name}, skipping")
+            return
+
+        self.report_node_metrics(self.sinks[endpoint], node, node_data)
+        self.backfill_history(endpoint, "node", node.request, prefix=node.status_dimension_string)
+
+    def collect_node_storage(self, endpoint, node):
+        # Fetch storage metrics for a single node in the cluster
+        storage_data = endpoint.fetch_list(node.request + "/storage", ("storage",))
+
+        # Loop through each storage entry for this node
+        for entry in storage_data:
+            if entry.get("active") == 1 and entry.get("enabled") == 1:
+                storage_name = entry.get("storage")
+                self.report_storage_metrics(
+                    self.sinks[endpoint],
+                    node,
+                    storage_name,
+                    entry.get("type"),
+                    entry.get("total"),
+                    entry.get("used"),
+                    entry.get("avail"),
+                    is_shared_storage(entry, entry.get("type")),
+                )
+                self.logger.info(f"Sent to metrics server for storage: {storage_name} for node: {node.name}")
+
+    def collect_node_qemuvm(self, endpoint, node):
+        # Fetch the Qemu-VM list of a single node, every running VM is collected as its own task
+        # The list is parsed while it is read, each queued task only keeps the fields collect_vm needs
+        vm_entry_data = endpoint.fetch_iter(node.request + "/qemu", ("vmid",))
+
+        node_vm_count = 0
+        for entry in vm_entry_data:
+            if entry.get("status") == "running":
+                node_vm_count = node_vm_count + 1
+                if self.plan.vm_guests:
+                    guest = {field: entry.get(field) for field in GUEST_LIST_FIELDS}
+                    self.scheduler.submit(endpoint, self.collect_vm, endpoint, node, guest)
+
+        self.sinks[endpoint].add("proxmox.node.vm", node_vm_count, prefix=node.dimension_string)
+        self.logger.info(f"Sent to metrics server for VM count: {node_vm_count} for node: {node.name}")
+
+    def collect_vm(self, endpoint, node, entry: dict):
+        vm_name = entry.get("name")
+        vm_id = entry.get("vmid")
+        vm_request = node.request + "/qemu/" + str(vm_id)
+
+        # Making request to retrieve metrics for the VM
+        vm_metrics = endpoint.fetch_dict(vm_request + "/status/current", ("status", "cpus"))
+        if not vm_metrics:
+            return
+
+        # Build VM dimensions with VM IP, the cluster and node dimensions come from the node record
+        vm_dimensions = {
+            "vmname": vm_name,
+            "vmid": vm_id,
+            "vmips": self.get_vm_ips(endpoint, node, vm_id, vm_name, vm_metrics.get("uptime")),
+        }
+
+        rates = self.rate_stores.get(endpoint)
+        self.report_vm_metrics(self.sinks[endpoint], node, vm_metrics, vm_dimensions, rates)
+        self.backfill_history(endpoint, "qemu", vm_request, vm_dimensions, node.dimension_string)
+        self.logger.info(
+            f"Sent to metrics server for VM: {vm_name} for node: {node.name} with dimensions: {vm_dimensions}"
+        )
+
+    def collect_node_lxc(self, endpoint, node):
+        # Fetch the LXC-Container list of a single node, every running container is collected as its own task
+        lxc_entry_data = endpoint.fetch_iter(node.request + "/lxc", ("vmid",))
+
+        node_lxc_count = 0
+        for entry in lxc_entry_data:
+            if entry.get("status") == "running":
+                node_lxc_count = node_lxc_count + 1
+                if self.plan.lxc_guests:
+                    guest = {field: entry.get(field) for field in GUEST_LIST_FIELDS}
+                    self.scheduler.submit(endpoint, self.collect_container, endpoint, node, guest)
+
+        self.sinks[endpoint].add("proxmox.node.lxc", node_lxc_count, prefix=node.dimension_string)
+        self.logger.info(f"Sent to metrics server for LXC count: {node_lxc_count} for node: {node.name}")
+
+    def collect_container(self, endpoint, node, entry: dict):
+        lxc_name = entry.get("name")
+        lxc_id = entry.get("vmid")
+        lxc_request = node.request + "/lxc/" + str(lxc_id)
+
+        # Making request to retrieve metrics for the container
+        lxc_metrics = endpoint.fetch_dict(lxc_request + "/status/current", ("status",))
+        if not lxc_metrics:
+            return
+
+        # Build LXC dimensions, the cluster and node dimensions come from the node record
+        lxc_dimensions = {"lxcname": lxc_name, "lxcid": lxc_id, "lxctype": "lxc"}
+        rates = self.rate_stores.get(endpoint)
+        self.report_lxc_metrics(self.sinks[endpoint], node, lxc_metrics, lxc_dimensions, rates)
+        self.backfill_history(endpoint, "lxc", lxc_request, lxc_dimensions, node.dimension_string)
+        self.logger.info(
+            f"Sent to metrics server for LXC: {lxc_name} for node: {node.name} "
+            f"with dimensions: {lxc_dimensions}"
+        )
+
+    def collect_node_service(self, endpoint, node):
+        # Fetch services status for a single node in the cluster
+        service_data = endpoint.fetch_list(node.request + "/services", ("service",))
+
+        self.report_service_metrics(self.sinks[endpoint], node, service_data)
+
+    def collect_cluster_resources(self, endpoint, nodes, guest_details: bool, skip_domains=()):
+        # Bulk mode: one cluster/resources call replaces the per-node storage/qemu/lxc lists and the
+        # per-guest status
+        # Parsed while it is read, only the resources of the collected types are kept
+        resource_data = endpoint.fetch_iter("cluster/resources", ("type",))
+
+        # Group the resources by node and type, types of skipped domains are left out
+        domains = (("qemu", DOMAIN_VM), ("lxc", DOMAIN_LXC), ("storage", DOMAIN_STORAGE))
+        resource_types = {resource_type for resource_type, domain in domains if domain not in skip_domains}
+        node_resources = {}
+        for entry in resource_data:
+            if entry.get("type") in resource_types:
+                guests = node_resources.setdefault(entry.get("node"), {})
+                guests.setdefault(entry.get("type"), []).append(entry)
+
+        sink = self.sinks[endpoint]
+        for node in nodes:
+            resources = node_resources.get(node.name, {})
+
+            # Storage, only storages which are active and enabled are reported as available
+            for entry in resources.get("storage", []):
+                if entry.get("status") == "available":
+                    storage_total = entry.get("maxdisk")
+                    storage_used = entry.get("disk")
+                    storage_avail = None
+                    if storage_total is not None and storage_used is not None:
+                        storage_avail = storage_total - storage_used
+                    self.report_storage_metrics(
+                        sink,
+                        node,
+                        entry.get("storage"),
+                        entry.get("plugintype"),
+                        storage_total,
+                        storage_used,
+                        storage_avail,
+                        is_shared_storage(entry, entry.get("plugintype")),
+                    )
+
+            # Qemu VMs, each VM still needs its agent IP lookup so it runs as its own task
+            node_vm_count = 0
+            for entry in resources.get("qemu", []):
+                if entry.get("status") == "running" and not entry.get("template"):
+                    node_vm_count = node_vm_count + 1
+                    if self.plan.vm_guests:
+                        self.scheduler.submit(
+                            endpoint, self.collect_bulk_vm, endpoint, node, entry, guest_details
+                        )
+
+            if DOMAIN_VM not in skip_domains:
+                sink.add("proxmox.node.vm", node_vm_count, prefix=node.dimension_string)
+
+            # LXC containers, only a task of their own when details have to be fetched
+            node_lxc_count = 0
+            for entry in resources.get("lxc", []):
+                if entry.get("status") == "running" and not entry.get("template"):
+                    node_lxc_count = node_lxc_count + 1
+                    if not self.plan.lxc_guests:
+                        continue
+                    if guest_details:
+                        self.scheduler.submit(
+                            endpoint, self.collect_bulk_container, endpoint, node, entry, guest_details
+                        )
+                    else:
+                        self.collect_bulk_container(endpoint, node, entry, guest_details)
+
+            if DOMAIN_LXC not in skip_domains:
+                sink.add("proxmox.node.lxc", node_lxc_count, prefix=node.dimension_string)
+            self.logger.info(
+                f"Sent to metrics server for {node_vm_count} VMs and {node_lxc_count} LXCs "
+                f"from cluster/resources for node: {node.name}"
+            )
+
+    def collect_bulk_vm(self, endpoint, node, entry: dict, guest_details: bool):
+        vm_name = entry.get("name")
+        vm_id = entry.get("vmid")
+        vm_request = node.request + "/qemu/" + str(vm_id)
+        vm_metrics = self.bulk_guest_metrics(entry)
+
+        if guest_details:
+            vm_metrics.update(self.get_guest_details(endpoint, vm_request, VM_DETAIL_FIELDS))
+
+        vm_dimensions = {
+            "vmname": vm_name,
+            "vmid": vm_id,
+            "vmips": self.get_vm_ips(endpoint, node, vm_id, vm_name, entry.get("uptime")),
+        }
+        rates = self.rate_stores.get(endpoint)
+        self.report_vm_metrics(self.sinks[endpoint], node, vm_metrics, vm_dimensions, rates)
+        self.backfill_history(endpoint, "qemu", vm_request, vm_dimensions, node.dimension_string)
+
+    def collect_bulk_container(self, endpoint, node, entry: dict, guest_details: bool):
+        lxc_id = entry.get("vmid")
+        lxc_request = node.request + "/lxc/" + str(lxc_id)
+        lxc_metrics = self.bulk_guest_metrics(entry)
+
+        if guest_details:
+            lxc_metrics.update(self.get_guest_details(endpoint, lxc_request, LXC_DETAIL_FIELDS))
+
+        lxc_dimensions = {"lxcname": entry.get("name"), "lxcid": lxc_id, "lxctype": "lxc"}
+        rates = self.rate_stores.get(endpoint)
+        self.report_lxc_metrics(self.sinks[endpoint], node, lxc_metrics, lxc_dimensions, rates)
+        self.backfill_history(endpoint, "lxc", lxc_request, lxc_dimensions, node.dimension_string)
+
+    def bulk_guest_metrics(self, entry: dict):
+        # cluster/resources reports the CPU count as maxcpu where status/current uses cpus
+        guest_metrics = {key: entry.get(key) for key in BULK_GUEST_FIELDS}
+        guest_metrics["cpus"] = entry.get("maxcpu")
+        return guest_metrics
+
+    def get_guest_details(self, endpoint, guest_request, fields):
+        # Fetches status/current for a single guest, keeping only the fields cluster/resources lacks
+        guest_metrics = endpoint.fetch_dict(guest_request + "/status/current")
+        return {field: guest_metrics[field] for field in fields if field in guest_metrics}
+
+    def backfill_history(self, endpoint, kind, request, dimensions: dict = None, prefix=""):
+        # One rrddata request covers the entity's whole gap, cycles without a gap request nothing
+        backfill = self.backfills.get(endpoint)
+        if backfill is None or backfill.window is None:
+            return
+        rrd_data = endpoint.fetch_list(request + "/rrddata", ("time",), RRD_PARAMS)
+        backfill.emit(self.sinks[endpoint], kind, rrd_data, dimensions, prefix)
+
+    def get_vm_ips(self, endpoint, node, vm_id, vm_name, uptime=None):
+        agent_request = node.request + "/qemu/" + str(vm_id) + "/agent/network-get-interfaces"
+
+        def lookup():
+            # None marks the agent as unavailable so the inventory applies its negative TTL
+            try:
+                agent_info = endpoint.fetch(agent_request)
+                if agent_info is None:
+                    return None
+                return self.parse_vm_ips(endpoint.validate_dict(agent_request, agent_info))
+            except Exception as e:
+                self.logger.warning(f"Could not retrieve IP/MAC for VM {vm_name}: {e}")
+                return None
+
+        inventory_key = (node.cluster.name, node.name, vm_id)
+        return self.inventories[endpoint].get_vm_ips(inventory_key, vm_name, lookup, uptime)
+
+    def report_node_metrics(self, sink, node, node_data: dict):
+        # Sending to metrics server for node, online comes from cluster/status and the rest from the table
+        batch = sink.batch(prefix=node.status_dimension_string)
+        batch.add("proxmox.node.online", node.online)
+        if node_data:
+            NODE_METRICS.emit(batch, node_data)
+        batch.commit()
+        self.logger.info(f"Sent to metrics server for node: {node.name}")
+
+    def report_service_metrics(self, sink, node, service_data: list):
+        # Loop through each service entry for this node
+        for entry in service_data:
+            service_name = entry.get("name")
+
+            # Build node service dimensions
+            service_dimensions = {"service": entry.get("service"), "service_name": service_name}
+
+            # Sending metrics to metric server for node services
+            batch = sink.batch(service_dimensions, node.dimension_string)
+            SERVICE_METRICS.emit(batch, entry)
+            batch.commit()
+            self.logger.info(
+                f"Sent to metrics server for service: {service_name} for node: {node.name} "
+                f"with dimensions: {service_dimensions}"
+            )
+
+    def parse_vm_ips(self, agent_info: dict):
+        all_ips = ""
+        for interface in agent_info.get("result", []):
+            for ip in interface.get("ip-addresses", []):
+                ip_addr = ip.get("ip-address")
+                if ip_addr and ip_addr != "127.0.0.1" and ":" not in ip_addr:  # exclude loopback and IPv6
+                    all_ips = ip_addr if all_ips == "" else all_ips + ", " + ip_addr
+        return all_ips
+
+    def report_storage_metrics(
+        self, sink, node, storage_name, storage_type, storage_total, storage_used, storage_avail, shared=False
+    ):
+        # A shared storage is reported once per cycle against the cluster when the endpoint asks for it
+        shared_storages = node.cluster.shared_storages
+        if shared and shared_storages is not None:
+            if shared_storages.claim(storage_name):
+                self.report_shared_storage_metrics(
+                    sink, node.cluster, storage_name, storage_type, storage_total, storage_used, storage_avail
+                )
+            return
+
+        # Build storage dimensions
+        storage_dimensions = {"nodestorage": storage_name, "nodestoragetype": storage_type}
+
+        # Sending to metrics server for storage
+        batch = sink.batch(storage_dimensions, node.dimension_string)
+        batch.add("proxmox.node.storage.total", storage_total)
+        batch.add("proxmox.node.storage.used", storage_used)
+        batch.add("proxmox.node.storage.avail", storage_avail)
+        batch.commit()
+
+    def report_shared_storage_metrics(
+        self, sink, cluster, storage_name, storage_type, storage_total, storage_used, storage_avail
+    ):
+        batch = sink.batch({"storage": storage_name, "storagetype": storage_type}, cluster.dimension_string)
+        batch.add("proxmox.cluster.storage.total", storage_total)
+        batch.add("proxmox.cluster.storage.used", storage_used)
+        batch.add("proxmox.cluster.storage.avail", storage_avail)
+        batch.commit()
+
+    def report_vm_metrics(self, sink, node, vm_metrics: dict, vm_dimensions: dict, rates=None):
+        # Sending metrics to metric server for VM, with the counter rates when the endpoint has a rate store
+        batch = sink.batch(vm_dimensions, node.dimension_string)
+        if rates is None or rates.emit_raw:
+            VM_METRICS.emit(batch, vm_metrics)
+        else:
+            VM_GAUGE_METRICS.emit(batch, vm_metrics)
+        if rates is not None:
+            guest_key = ("qemu", node.cluster.id, vm_dimensions.get("vmid"))
+            rates.emit(batch, guest_key, node.name, vm_metrics, VM_COUNTER_RATES)
+        batch.commit()
+
+    def report_lxc_metrics(self, sink, node, lxc_metrics: dict, lxc_dimensions: dict, rates=None):
+        # Sending metrics to metric server for LXC, with the counter rates when the endpoint has a rate store
+        batch = sink.batch(lxc_dimensions, node.dimension_string)
+        if rates is None or rates.emit_raw:
+            LXC_METRICS.emit(batch, lxc_metrics)
+        else:
+            LXC_GAUGE_METRICS.emit(batch, lxc_metrics)
+        if rates is not None:
+            guest_key = ("lxc", node.cluster.id, lxc_dimensions.get("lxcid"))
+            rates.emit(batch, guest_key, node.name, lxc_metrics, LXC_COUNTER_RATES)
+        batch.commit()
@@ -1,7 +1,7 @@
 import json
 
-class common_functions:
 
+class common_functions:  # noqa: N801 - imported under this name by every module
     @staticmethod
     def is_valid_json(data):
         try:
@@ -9,4 +9,11 @@ class common_functions:
             json.loads(json.dumps(data))  # Optional: round-trip check
             return True
         except (TypeError, ValueError):
-            return False
\ No newline at end of file
+            return False
+
+    @staticmethod
+    def has_keys(data, required_keys=()):
+        # Cheap shape check on an already decoded response, no serialization involved
+        if not isinstance(data, dict):
+            return False
+        return all(key in data for key in required_keys)
@@ -0,0 +1,152 @@
+import heapq
+import logging
+import threading
+from bisect import bisect_left
+
+default_logger = logging.getLogger(__name__)
+default_logger.setLevel(logging.INFO)
+
+# Upper bounds in seconds of the latency histogram buckets, slower requests land in a last open bucket
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Request outcomes
+OUTCOME_OK = "ok"
+OUTCOME_ERROR = "error"
+OUTCOME_TIMEOUT = "timeout"
+
+
+def path_template(request):
+    # "nodes/pve1/qemu/101/status/current" -> "nodes/{node}/qemu/{vmid}/status/current"
+    parts = request.strip("/").split("/")
+    if len(parts) > 1 and parts[0] == "nodes":
+        parts[1] = "{node}"
+        if len(parts) > 3 and parts[2] in ("qemu", "lxc"):
+            parts[3] = "{vmid}"
+    return "/".join(parts)
+
+
+class LatencyStats:
+    __slots__ = ("count", "total", "minimum", "maximum", "buckets", "errors", "timeouts")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.errors = 0
+        self.timeouts = 0
+
+    def add(self, duration):
+        self.count += 1
+        self.total += duration
+        self.minimum = duration if self.minimum is None else min(self.minimum, duration)
+        self.maximum = max(self.maximum, duration)
+        self.buckets[bisect_left(LATENCY_BUCKETS, duration)] += 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        if other.minimum is not None:
+            self.minimum = other.minimum if self.minimum is None else min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+        self.buckets = [own + theirs for own, theirs in zip(self.buckets, other.buckets, strict=True)]
+        self.errors += other.errors
+        self.timeouts += other.timeouts
+
+    def percentile(self, fraction):
+        # Upper bound of the bucket holding the requested rank, capped at the slowest observed value
+        rank = fraction * self.count
+        seen = 0
+        # The last bucket, above all bounds, is left out
+        for bound, count in zip(LATENCY_BUCKETS, self.buckets, strict=False):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.maximum)
+        return self.maximum
+
+
+class Instrumentation:
+    """Request and collector timings of one endpoint, aggregated per collection cycle.
+
+    ProxmoxClient and AsyncProxmoxClient record every API call with its path template and
+    outcome, the scheduler records every collection task. cycle_snapshot() hands the totals of
+    the cycle to the extension and starts the next one, so each cycle reports its own values.
+    The slowest requests of the cycle are kept for the debug dump.
+    """
+
+    def __init__(self, slowest=10, logger=default_logger):
+        self.slowest_size = slowest
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.tasks = {}
+        self.slowest = []
+
+    def record_request(self, request, duration, outcome=OUTCOME_OK):
+        template = path_template(request)
+        with self.lock:
+            stats = self.requests.get(template)
+            if stats is None:
+                stats = self.requests[template] = LatencyStats()
+            stats.add(duration)
+            if outcome != OUTCOME_OK:
+                stats.errors += 1
+                if outcome == OUTCOME_TIMEOUT:
+                    stats.timeouts += 1
+
+            self.keep_slowest((duration, request, outcome))
+
+    def keep_slowest(self, entry):
+        # Min-heap of the slowest requests, only touched when a request beats the fastest kept one
+        # Must be called with the lock held
+        if len(self.slowest) < self.slowest_size:
+            heapq.heappush(self.slowest, entry)
+        elif entry[0] > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, entry)
+
+    def record_task(self, name, duration, failed=False):
+        with self.lock:
+            stats = self.tasks.get(name)
+            if stats is None:
+                stats = self.tasks[name] = LatencyStats()
+            stats.add(duration)
+            if failed:
+                stats.errors += 1
+
+    def merge(self, requests, tasks, slowest):
+        # Adds what cycle_snapshot() returned elsewhere, in a collection worker process, to this cycle
+        with self.lock:
+            for own, other in ((self.requests, requests), (self.tasks, tasks)):
+                for name, stats in other.items():
+                    if name in own:
+                        own[name].merge(stats)
+                    else:
+                        own[name] = stats
+            for entry in slowest:
+                self.keep_slowest(entry)
+
+    def cycle_snapshot(self):
+        # Returns (requests, tasks, slowest) of the cycle so far and resets them
+        with self.lock:
+            requests, self.requests = self.requests, {}
+            tasks, self.tasks = self.tasks, {}
+            slowest, self.slowest = self.slowest, []
+        return requests, tasks, sorted(slowest, reverse=True)
+
+    def dump_slowest(self, endpoint, requests, slowest):
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return
+        for duration, request, outcome in slowest:
+            self.logger.debug(
+                f"Slow request for {endpoint}: {request} took {duration * 1000:.1f}ms ({outcome})"
+            )
+        for template, stats in sorted(requests.items()):
+            histogram = ", ".join(
+                f"<={bound}s: {count}"
+                for bound, count in zip(LATENCY_BUCKETS, stats.buckets, strict=False)
+                if count
+            )
+            if stats.buckets[-1]:
+                histogram += f", >{LATENCY_BUCKETS[-1]}s: {stats.buckets[-1]}"
+            self.logger.debug(f"Latency histogram for {endpoint} {template}: {histogram}")
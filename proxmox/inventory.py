@@ -0,0 +1,96 @@
+import logging
+import random
+import threading
+import time
+from collections import OrderedDict
+
+default_logger = logging.getLogger(__name__)
+default_logger.setLevel(logging.INFO)
+
+
+class InventoryEntry:
+    __slots__ = ("name", "ips", "agent", "uptime", "expires")
+
+    def __init__(self, name, ips, agent, uptime, expires):
+        self.name = name
+        self.ips = ips
+        self.agent = agent  # False when the last lookup found no reachable guest agent
+        self.uptime = uptime
+        self.expires = expires
+
+
+class InventoryCache:
+    """Caches guest names and guest-agent IPs of one endpoint, keyed by (cluster, node, vmid).
+
+    An entry is looked up again when its TTL expires, when the guest was renamed or its vmid
+    re-used, or when its uptime went backwards (reboot). Guests without a reachable agent are
+    cached with the longer negative TTL. Expiry is jittered and expired entries are only
+    refreshed up to refresh_budget times per cycle, so lookups are spread over several cycles.
+    The least recently used entries are evicted beyond max_entries.
+    """
+
+    def __init__(
+        self, ttl=600, negative_ttl=1800, refresh_budget=20, max_entries=10000, logger=default_logger
+    ):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.refresh_budget = refresh_budget
+        self.max_entries = max_entries
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.refreshes_left = refresh_budget
+        self.hits = 0
+        self.lookups = 0
+
+    def start_cycle(self):
+        with self.lock:
+            self.refreshes_left = self.refresh_budget
+
+    def needs_lookup(self, key, name, uptime=None):
+        # Returns (cached_ips, lookup_needed), a granted lookup is taken from the cycle's refresh budget
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return "", True
+            self.entries.move_to_end(key)
+
+            if entry.name != name:
+                self.logger.info(
+                    f"Guest {key} changed name from {entry.name} to {name}, refreshing inventory"
+                )
+                return "", True
+            if uptime is not None and entry.uptime is not None and uptime < entry.uptime:
+                return entry.ips, True
+            entry.uptime = uptime if uptime is not None else entry.uptime
+
+            if time.monotonic() < entry.expires or self.refreshes_left <= 0:
+                self.hits += 1
+                return entry.ips, False
+            self.refreshes_left -= 1
+            return entry.ips, True
+
+    def store(self, key, name, ips, agent, uptime=None):
+        ttl = self.ttl if agent else self.negative_ttl
+        # Jitter the expiry so guests discovered together are not refreshed together
+        expires = time.monotonic() + ttl * random.uniform(0.75, 1.25)
+        with self.lock:
+            self.lookups += 1
+            self.entries[key] = InventoryEntry(name, ips, agent, uptime, expires)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def get_vm_ips(self, key, name, lookup, uptime=None):
+        # lookup() returns the guest's IPs, or None when its agent could not be reached
+        ips, lookup_needed = self.needs_lookup(key, name, uptime)
+        if not lookup_needed:
+            return ips
+
+        ips = lookup()
+        self.store(key, name, ips or "", ips is not None, uptime)
+        return ips or ""
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "hits": self.hits, "lookups": self.lookups}
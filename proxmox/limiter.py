@@ -0,0 +1,158 @@
+import asyncio
+import contextlib
+import logging
+import threading
+import time
+
+default_logger = logging.getLogger(__name__)
+default_logger.setLevel(logging.INFO)
+
+# Limit a fresh endpoint starts with, it grows towards its maximum while the API stays healthy
+INITIAL_LIMIT = 4
+# Multiplicative decrease after a 5xx or timeout, and after latency climbed above the baseline
+OVERLOAD_DECREASE = 0.5
+LATENCY_DECREASE = 0.9
+# Recent latency this many times the long-term baseline counts as pveproxy getting slower
+LATENCY_TOLERANCE = 2.0
+# Below this recent latency the API is considered healthy however the baseline moved
+LATENCY_FLOOR = 0.05
+# Smoothing of the recent and the long-term latency averages
+RECENT_ALPHA = 0.2
+BASELINE_ALPHA = 0.02
+# Waiters limited by the in-flight count also re-check this often, in case their wake-up was lost
+WAIT_POLL = 0.1
+
+
+class AdaptiveLimiter:
+    """Adaptive limit on the API requests one endpoint has in flight, with a request rate ceiling.
+
+    The limit follows AIMD: every healthy response raises it by 1/limit, so by about one request
+    per round trip, up to `maximum`. A 5xx response or a timeout halves it, a recent latency of
+    more than twice the long-term baseline lowers it by a tenth. Decreases are at most once per
+    recent latency, so one burst of slow responses only counts once. `rate` is a token bucket
+    ceiling in requests per second for the whole cluster, 0 leaves the rate unlimited. Requests
+    released without a latency sample, such as guest-agent calls that wait on the guest, only
+    give their slot back and leave the latency averages and the limit alone.
+
+    The thread-pool collectors wait in acquire(), the asyncio engine in acquire_async(). Both
+    share the same limit, as they share the cluster's pveproxy.
+    """
+
+    def __init__(self, maximum, minimum=1, rate=0, burst=None, logger=default_logger):
+        self.maximum = max(minimum, maximum)
+        self.minimum = minimum
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1, rate)
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.async_waiters = []
+        self.limit = float(min(self.maximum, max(minimum, INITIAL_LIMIT)))
+        self.in_flight = 0
+        self.tokens = float(self.burst)
+        self.refilled = time.monotonic()
+        self.recent_latency = None
+        self.baseline_latency = None
+        self.last_decrease = 0.0
+        self.decreases = 0
+        self.throttled = 0
+
+    def try_acquire(self):
+        # Called with the lock held: 0 when a slot was taken, else the seconds to wait before trying again
+        if self.in_flight >= int(self.limit):
+            return WAIT_POLL
+        if self.rate:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+            self.refilled = now
+            if self.tokens < 1:
+                return (1 - self.tokens) / self.rate
+            self.tokens -= 1
+        self.in_flight += 1
+        return 0
+
+    def acquire(self):
+        with self.lock:
+            wait = self.try_acquire()
+            if wait:
+                self.throttled += 1
+            while wait:
+                self.condition.wait(wait)
+                wait = self.try_acquire()
+
+    async def acquire_async(self):
+        loop = asyncio.get_running_loop()
+        throttled = False
+        while True:
+            with self.lock:
+                wait = self.try_acquire()
+                if not wait:
+                    return
+                if not throttled:
+                    throttled = True
+                    self.throttled += 1
+                waiter = loop.create_future()
+                self.async_waiters.append((loop, waiter))
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(waiter, wait)
+
+    def release(self, latency, overloaded=False, sample=True):
+        # latency in seconds, overloaded for a 5xx answer or a timeout that pveproxy itself is to blame for
+        # Without sample the latency says nothing about pveproxy, only an overload answer still counts
+        with self.lock:
+            self.in_flight -= 1
+            if sample:
+                if self.recent_latency is None:
+                    self.recent_latency = self.baseline_latency = latency
+                else:
+                    self.recent_latency += RECENT_ALPHA * (latency - self.recent_latency)
+                    self.baseline_latency += BASELINE_ALPHA * (latency - self.baseline_latency)
+
+            if overloaded:
+                self.decrease(OVERLOAD_DECREASE)
+            elif sample:
+                if self.recent_latency > max(LATENCY_FLOOR, LATENCY_TOLERANCE * self.baseline_latency):
+                    self.decrease(LATENCY_DECREASE)
+                else:
+                    self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+            self.condition.notify()
+            while self.async_waiters:
+                loop, waiter = self.async_waiters.pop(0)
+                if not waiter.done():
+                    loop.call_soon_threadsafe(self.wake, waiter)
+                    break
+
+    @staticmethod
+    def wake(waiter):
+        if not waiter.done():
+            waiter.set_result(None)
+
+    def decrease(self, factor):
+        # Called with the lock held, responses to requests sent before the last decrease do not count again
+        now = time.monotonic()
+        if now - self.last_decrease < (self.recent_latency or 0):
+            return
+        self.last_decrease = now
+        limit = max(self.minimum, self.limit * factor)
+        if int(limit) < int(self.limit):
+            recent = (self.recent_latency or 0) * 1000
+            baseline = (self.baseline_latency or 0) * 1000
+            self.logger.info(
+                f"API concurrency limit lowered from {int(self.limit)} to {int(limit)}, recent latency "
+                f"{recent:.0f}ms, baseline {baseline:.0f}ms"
+            )
+        self.limit = limit
+        self.decreases += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "limit": int(self.limit),
+                "maximum": self.maximum,
+                "in_flight": self.in_flight,
+                "decreases": self.decreases,
+                "throttled": self.throttled,
+                "recent_latency_ms": round((self.recent_latency or 0) * 1000, 1),
+                "baseline_latency_ms": round((self.baseline_latency or 0) * 1000, 1),
+            }
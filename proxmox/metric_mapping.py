@@ -0,0 +1,258 @@
+import re
+
+
+def percent(value):
+    return value * 100
+
+
+def running(value):
+    return 1 if value == "running" else 0
+
+
+def state(expected):
+    # Maps a string state to 1 when it equals the expected value, otherwise 0
+    def transform(value):
+        return 1 if value == expected else 0
+
+    return transform
+
+
+def compile_path(path):
+    # "swap.free" reads data["swap"]["free"], numeric segments index into lists ("loadavg.0")
+    steps = tuple(int(step) if step.isdigit() else step for step in path.split("."))
+    if len(steps) == 1:
+        field = steps[0]
+        return lambda data: data.get(field)
+
+    def get(data):
+        for step in steps:
+            try:
+                data = data[step]
+            except (KeyError, IndexError, TypeError):
+                return None
+        return data
+
+    return get
+
+
+class MetricTable:
+    """Maps the fields of one API response to metric keys.
+
+    Each row is (field path, metric key, transform). The paths are compiled to getters once,
+    emit() then is a single loop per entity. Fields that are missing from the response are
+    skipped, so optional fields need no special handling. With `keep_missing` they are handed
+    to their transform as None instead, a state table then reports 0 for a missing state.
+    """
+
+    def __init__(self, rows, keep_missing=False):
+        self.rows = tuple(rows)
+        self.keep_missing = keep_missing
+        self.compiled = tuple((compile_path(path), key, transform) for path, key, transform in self.rows)
+        self.keys = tuple(key for _, key, _ in self.rows)
+
+    def required_keys(self):
+        # Top-level response keys the table reads, in first-use order
+        keys = []
+        for path, _, _ in self.rows:
+            field = path.split(".", 1)[0]
+            if field not in keys:
+                keys.append(field)
+        return tuple(keys)
+
+    def without(self, fields):
+        # Same table without the rows reading any of the given top-level fields
+        return MetricTable(
+            (row for row in self.rows if row[0].split(".", 1)[0] not in fields), self.keep_missing
+        )
+
+    def emit(self, batch, data: dict):
+        for get, key, transform in self.compiled:
+            value = get(data)
+            if value is None and (transform is None or not self.keep_missing):
+                continue
+            batch.add(key, transform(value) if transform is not None else value)
+
+
+NODE_METRICS = MetricTable(
+    (
+        ("swap.free", "proxmox.node.swap.free", None),
+        ("swap.total", "proxmox.node.swap.total", None),
+        ("swap.used", "proxmox.node.swap.used", None),
+        ("rootfs.avail", "proxmox.node.rootfs.avail", None),
+        ("rootfs.used", "proxmox.node.rootfs.used", None),
+        ("rootfs.free", "proxmox.node.rootfs.free", None),
+        ("rootfs.total", "proxmox.node.rootfs.total", None),
+        ("cpu", "proxmox.node.cpu.usage", percent),
+        ("wait", "proxmox.node.cpu.wait", percent),
+        ("idle", "proxmox.node.cpu.idle", percent),
+        ("uptime", "proxmox.node.uptime", None),
+        ("memory.free", "proxmox.node.memory.free", None),
+        ("memory.total", "proxmox.node.memory.total", None),
+        ("memory.used", "proxmox.node.memory.used", None),
+        ("loadavg.0", "proxmox.node.loadavg.1min", float),
+        ("loadavg.1", "proxmox.node.loadavg.5min", float),
+        ("loadavg.2", "proxmox.node.loadavg.15min", float),
+    )
+)
+
+# nodes/{node}/services reports the running state as "state", a service without a state is reported as 0
+SERVICE_METRICS = MetricTable(
+    (
+        ("state", "proxmox.node.service.state", running),
+        ("active-state", "proxmox.node.service.activestate", state("active")),
+        ("unit-state", "proxmox.node.service.unitstate", state("enabled")),
+    ),
+    keep_missing=True,
+)
+
+# balloon, freemem and qmpstatus are only part of status/current, not of cluster/resources
+VM_METRICS = MetricTable(
+    (
+        ("netin", "proxmox.vm.network.netin", None),
+        ("netout", "proxmox.vm.network.netout", None),
+        ("diskwrite", "proxmox.vm.disk.write", None),
+        ("maxdisk", "proxmox.vm.disk.max", None),
+        ("disk", "proxmox.vm.disk.used", None),
+        ("diskread", "proxmox.vm.disk.read", None),
+        ("maxmem", "proxmox.vm.memory.max", None),
+        ("mem", "proxmox.vm.memory.mem", None),
+        ("cpus", "proxmox.vm.cpu.usable", percent),
+        ("cpu", "proxmox.vm.cpu.usage", None),
+        ("uptime", "proxmox.vm.uptime", None),
+        ("status", "proxmox.vm.status", running),
+        ("freemem", "proxmox.vm.memory.free", None),
+        ("balloon", "proxmox.vm.balloon", None),
+        ("qmpstatus", "proxmox.vm.qmp.status", running),
+    )
+)
+
+# swap and maxswap are only part of status/current, not of cluster/resources
+LXC_METRICS = MetricTable(
+    (
+        ("netout", "proxmox.lxc.network.netout", None),
+        ("uptime", "proxmox.lxc.uptime", None),
+        ("diskwrite", "proxmox.lxc.disk.write", None),
+        ("netin", "proxmox.lxc.network.netin", None),
+        ("diskread", "proxmox.lxc.disk.read", None),
+        ("mem", "proxmox.lxc.memory.mem", None),
+        ("cpu", "proxmox.lxc.cpu.usage", None),
+        ("cpus", "proxmox.lxc.cpu.usable", None),
+        ("maxmem", "proxmox.lxc.memory.max", None),
+        ("status", "proxmox.lxc.status", running),
+        ("disk", "proxmox.lxc.disk.usage", None),
+        ("maxdisk", "proxmox.lxc.disk.max", None),
+        ("swap", "proxmox.lxc.swap.usage", None),
+        ("maxswap", "proxmox.lxc.swap.max", None),
+    )
+)
+
+# Cumulative guest counters, a RateStore turns them into per-second rates under these keys
+VM_COUNTER_RATES = MetricTable(
+    (
+        ("netin", "proxmox.vm.network.netin.rate", None),
+        ("netout", "proxmox.vm.network.netout.rate", None),
+        ("diskread", "proxmox.vm.disk.read.rate", None),
+        ("diskwrite", "proxmox.vm.disk.write.rate", None),
+    )
+)
+
+LXC_COUNTER_RATES = MetricTable(
+    (
+        ("netin", "proxmox.lxc.network.netin.rate", None),
+        ("netout", "proxmox.lxc.network.netout.rate", None),
+        ("diskread", "proxmox.lxc.disk.read.rate", None),
+        ("diskwrite", "proxmox.lxc.disk.write.rate", None),
+    )
+)
+
+# Guest tables without the raw counters, used when only the rates are sent
+VM_GAUGE_METRICS = VM_METRICS.without(VM_COUNTER_RATES.required_keys())
+LXC_GAUGE_METRICS = LXC_METRICS.without(LXC_COUNTER_RATES.required_keys())
+
+# Minute averages of nodes/{node}/rrddata, the history a backfill replays for a node
+NODE_RRD_METRICS = MetricTable(
+    (
+        ("cpu", "proxmox.node.cpu.usage", percent),
+        ("iowait", "proxmox.node.cpu.wait", percent),
+        ("loadavg", "proxmox.node.loadavg.1min", float),
+        ("memused", "proxmox.node.memory.used", None),
+        ("memtotal", "proxmox.node.memory.total", None),
+        ("swapused", "proxmox.node.swap.used", None),
+        ("swaptotal", "proxmox.node.swap.total", None),
+        ("rootused", "proxmox.node.rootfs.used", None),
+        ("roottotal", "proxmox.node.rootfs.total", None),
+    )
+)
+
+# The guest rrddata keeps network and disk I/O as per-second averages, so they fill the rate metrics
+VM_RRD_METRICS = MetricTable(
+    (
+        ("cpu", "proxmox.vm.cpu.usage", None),
+        ("mem", "proxmox.vm.memory.mem", None),
+        ("maxmem", "proxmox.vm.memory.max", None),
+        ("disk", "proxmox.vm.disk.used", None),
+        ("maxdisk", "proxmox.vm.disk.max", None),
+        ("netin", "proxmox.vm.network.netin.rate", None),
+        ("netout", "proxmox.vm.network.netout.rate", None),
+        ("diskread", "proxmox.vm.disk.read.rate", None),
+        ("diskwrite", "proxmox.vm.disk.write.rate", None),
+    )
+)
+
+LXC_RRD_METRICS = MetricTable(
+    (
+        ("cpu", "proxmox.lxc.cpu.usage", None),
+        ("mem", "proxmox.lxc.memory.mem", None),
+        ("maxmem", "proxmox.lxc.memory.max", None),
+        ("disk", "proxmox.lxc.disk.usage", None),
+        ("maxdisk", "proxmox.lxc.disk.max", None),
+        ("netin", "proxmox.lxc.network.netin.rate", None),
+        ("netout", "proxmox.lxc.network.netout.rate", None),
+        ("diskread", "proxmox.lxc.disk.read.rate", None),
+        ("diskwrite", "proxmox.lxc.disk.write.rate", None),
+    )
+)
+
+# Guest history without the rates, for endpoints that only send the raw counters
+VM_RRD_GAUGE_METRICS = VM_RRD_METRICS.without(VM_COUNTER_RATES.required_keys())
+LXC_RRD_GAUGE_METRICS = LXC_RRD_METRICS.without(LXC_COUNTER_RATES.required_keys())
+
+# Capacities and states that rarely change, with a static heartbeat they are only sent on change or as a
+# heartbeat
+STATIC_METRIC_KEYS = frozenset(
+    (
+        "proxmox.node.memory.total",
+        "proxmox.node.rootfs.total",
+        "proxmox.node.swap.total",
+        "proxmox.node.storage.total",
+        "proxmox.cluster.storage.total",
+        "proxmox.vm.memory.max",
+        "proxmox.vm.disk.max",
+        "proxmox.vm.cpu.usable",
+        "proxmox.lxc.memory.max",
+        "proxmox.lxc.disk.max",
+        "proxmox.lxc.cpu.usable",
+        "proxmox.lxc.swap.max",
+    )
+    + SERVICE_METRICS.keys
+)
+
+METRIC_TABLES = (
+    NODE_METRICS,
+    SERVICE_METRICS,
+    VM_METRICS,
+    LXC_METRICS,
+    VM_COUNTER_RATES,
+    LXC_COUNTER_RATES,
+    NODE_RRD_METRICS,
+    VM_RRD_METRICS,
+    LXC_RRD_METRICS,
+)
+
+DECLARED_METRIC_KEY = re.compile(r"^\s*-\s+key:\s+(proxmox\.\S+)\s*$", re.MULTILINE)
+
+
+def undeclared_keys(extension_yaml: str):
+    # Keys of the tables that extension.yaml does not declare under metrics:, without needing a YAML parser
+    declared = set(DECLARED_METRIC_KEY.findall(extension_yaml or ""))
+    return [key for table in METRIC_TABLES for key in table.keys if key not in declared]
@@ -0,0 +1,190 @@
+import logging
+import threading
+import time
+
+default_logger = logging.getLogger(__name__)
+default_logger.setLevel(logging.INFO)
+
+
+def escape_value(value):
+    # MINT dimension values are quoted, quotes and backslashes inside them must be escaped
+    return str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+
+def format_dimensions(dimensions: dict):
+    return "".join(f',{key}="{escape_value(value)}"' for key, value in dimensions.items())
+
+
+class MetricBatch:
+    """The values of one entity, all sharing a dimension set that is formatted once.
+
+    prefix is an already formatted dimension string, such as the one a NodeRecord keeps for its
+    node, that the entity's own dimensions are appended to. `changes` is the ChangeFilter the
+    values pass, None sends all of them.
+    """
+
+    __slots__ = ("sink", "dimension_string", "timestamp", "lines", "changes")
+
+    def __init__(self, sink, dimensions: dict = None, timestamp=None, prefix="", changes=None):
+        self.sink = sink
+        self.dimension_string = prefix + format_dimensions(dimensions) if dimensions else prefix
+        self.timestamp = f" {timestamp}" if timestamp is not None else ""
+        self.lines = []
+        self.changes = changes
+
+    def add(self, key, value):
+        if value is None:
+            self.sink.count_dropped()
+            return
+        changes = self.changes
+        if (
+            changes is not None
+            and key in changes.keys
+            and not changes.should_send(key, self.dimension_string, value, self.sink.timestamp)
+        ):
+            return
+        self.lines.append(f"{key}{self.dimension_string} gauge,{value}{self.timestamp}")
+
+    def add_summary(self, key, minimum, maximum, total, count):
+        # Gauge summary of several observations, Dynatrace derives min/max/avg/count from one line
+        if not count:
+            return
+        self.lines.append(
+            f"{key}{self.dimension_string} gauge,min={minimum},max={maximum},sum={total},count={count}"
+            f"{self.timestamp}"
+        )
+
+    def commit(self):
+        self.sink.append(self.lines)
+        self.lines = []
+
+
+class ChangeFilter:
+    """Last sent value of every static series, so an unchanged value is only re-sent as a heartbeat.
+
+    A series is a metric key of `keys` with its dimension string. Only the hash of the series
+    is kept, with its value and when it was last sent, and beyond max_series the oldest entries
+    are dropped, which only costs them one extra send. A series is sent again once its value
+    changed, or after between half and the full heartbeat, spread by its hash so the heartbeats
+    of series first seen in the same cycle do not all fall into one later cycle.
+    """
+
+    def __init__(self, keys, heartbeat, max_series=100000, logger=default_logger):
+        self.keys = frozenset(keys)
+        self.heartbeat = int(heartbeat * 1000)  # In milliseconds, like the metric timestamps
+        self.spread = self.heartbeat // 2 + 1
+        self.max_series = max_series
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.series = {}
+        self.sent = 0
+        self.suppressed = 0
+
+    def should_send(self, key, dimension_string, value, timestamp):
+        # Both strings cache their hash, so hashing the pair costs no pass over the dimension string
+        series = hash((key, dimension_string))
+        period = self.heartbeat - series % self.spread
+        with self.lock:
+            last = self.series.get(series)
+            if last is not None and last[0] == value and timestamp - last[1] < period:
+                self.suppressed += 1
+                return False
+            self.series[series] = (value, timestamp)
+            if len(self.series) > self.max_series:
+                del self.series[next(iter(self.series))]
+            self.sent += 1
+            return True
+
+    def stats(self):
+        with self.lock:
+            return {"series": len(self.series), "sent": self.sent, "suppressed": self.suppressed}
+
+
+class MetricSink:
+    """Buffers MINT lines of one endpoint and hands them to the SDK in bulk.
+
+    Collectors open one MetricBatch per entity, add its values and commit it. The sink flushes
+    through report_mint_lines once flush_size lines are buffered and at the end of every cycle.
+    All lines of a cycle carry the timestamp taken in start_cycle, unless a batch brings its own.
+    With a ChangeFilter, values of static metrics that did not change are left out of the
+    cycle's batches, batches with their own timestamp send every value.
+    """
+
+    def __init__(self, extension, flush_size=1000, changes=None, logger=default_logger):
+        self.extension = extension
+        self.changes = changes  # ChangeFilter for the static metrics, None sends every value
+        self.flush_size = flush_size
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.timestamp = None
+        self.flushes = 0
+        self.lines_flushed = 0
+        self.last_flush_size = 0
+        self.max_flush_size = 0
+        self.flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+        self.dropped = 0
+
+    def start_cycle(self):
+        self.timestamp = int(time.time() * 1000)
+
+    def batch(self, dimensions: dict = None, prefix="", timestamp=None):
+        # timestamp overrides the cycle's one for values recorded at another time, such as backfilled history
+        # Such values bypass the change filter, they are neither suppressed nor kept as a series' last value
+        if timestamp is None:
+            return MetricBatch(self, dimensions, self.timestamp, prefix, self.changes)
+        return MetricBatch(self, dimensions, timestamp, prefix)
+
+    def add(self, key, value, dimensions: dict = None, prefix=""):
+        # Single value of an entity that reports nothing else
+        batch = self.batch(dimensions, prefix)
+        batch.add(key, value)
+        batch.commit()
+
+    def append(self, lines):
+        with self.lock:
+            self.buffer.extend(lines)
+            if len(self.buffer) < self.flush_size:
+                return
+            lines, self.buffer = self.buffer, []
+        self.send(lines)
+
+    def count_dropped(self):
+        with self.lock:
+            self.dropped += 1
+
+    def flush(self):
+        with self.lock:
+            lines, self.buffer = self.buffer, []
+        if lines:
+            self.send(lines)
+
+    def send(self, lines):
+        start = time.perf_counter()
+        try:
+            self.extension.report_mint_lines(lines)
+        except Exception as e:
+            self.logger.error(f"Could not report {len(lines)} metric lines: {e!r}")
+            return
+        duration = time.perf_counter() - start
+        with self.lock:
+            self.flushes += 1
+            self.lines_flushed += len(lines)
+            self.last_flush_size = len(lines)
+            self.max_flush_size = max(self.max_flush_size, len(lines))
+            self.flush_seconds += duration
+            self.max_flush_seconds = max(self.max_flush_seconds, duration)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "flushes": self.flushes,
+                "lines": self.lines_flushed,
+                "last_flush_size": self.last_flush_size,
+                "max_flush_size": self.max_flush_size,
+                "avg_flush_ms": round(self.flush_seconds * 1000 / self.flushes, 3) if self.flushes else 0.0,
+                "max_flush_ms": round(self.max_flush_seconds * 1000, 3),
+                "dropped": self.dropped,
+                "suppressed": self.changes.suppressed if self.changes is not None else 0,
+            }
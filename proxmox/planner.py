@@ -0,0 +1,72 @@
+from .metric_mapping import (
+    LXC_COUNTER_RATES,
+    LXC_METRICS,
+    NODE_METRICS,
+    SERVICE_METRICS,
+    VM_COUNTER_RATES,
+    VM_METRICS,
+)
+
+# Collection domains, a cycle that overlaps the previous one can shed some of them
+DOMAIN_CLUSTER = "cluster"  # Cluster and HA metrics, cluster/status itself is needed by every cycle
+DOMAIN_NODE = "node"
+DOMAIN_STORAGE = "storage"
+DOMAIN_VM = "vm"
+DOMAIN_LXC = "lxc"
+DOMAIN_SERVICES = "services"
+DOMAINS = (DOMAIN_NODE, DOMAIN_STORAGE, DOMAIN_VM, DOMAIN_LXC, DOMAIN_SERVICES)
+
+CLUSTER_METRIC_KEYS = ("proxmox.cluster.node", "proxmox.cluster.node.online", "proxmox.cluster.sdn.status")
+CLUSTER_HA_METRIC_KEYS = ("proxmox.cluster.ha.quorate", "proxmox.cluster.ha.status")
+NODE_METRIC_KEYS = ("proxmox.node.online",) + NODE_METRICS.keys
+STORAGE_METRIC_KEYS = (
+    "proxmox.node.storage.total",
+    "proxmox.node.storage.used",
+    "proxmox.node.storage.avail",
+    "proxmox.cluster.storage.total",
+    "proxmox.cluster.storage.used",
+    "proxmox.cluster.storage.avail",
+)
+NODE_VM_COUNT_KEY = "proxmox.node.vm"
+NODE_LXC_COUNT_KEY = "proxmox.node.lxc"
+
+
+class CollectionPlan:
+    """What a cycle has to request, derived from the metrics of the enabled featureSets.
+
+    A request is only planned when at least one metric it feeds is enabled. The guest lists
+    are still needed for the per-node VM and container counts (Node featureSet) when the VM
+    or CONTAINER featureSet is disabled, but then without the per-guest status and agent calls.
+    """
+
+    def __init__(self, enabled_metrics=None):
+        # None means the enabled featureSets are not known, everything is collected then
+        self.enabled_metrics = set(enabled_metrics) if enabled_metrics is not None else None
+        self.cluster = self.any_enabled(CLUSTER_METRIC_KEYS)
+        self.cluster_ha = self.any_enabled(CLUSTER_HA_METRIC_KEYS)
+        self.vm_guests = self.any_enabled(VM_METRICS.keys + VM_COUNTER_RATES.keys)
+        self.lxc_guests = self.any_enabled(LXC_METRICS.keys + LXC_COUNTER_RATES.keys)
+
+        self.skipped_domains = frozenset(
+            domain
+            for domain, needed in (
+                (DOMAIN_NODE, self.any_enabled(NODE_METRIC_KEYS)),
+                (DOMAIN_STORAGE, self.any_enabled(STORAGE_METRIC_KEYS)),
+                (DOMAIN_VM, self.vm_guests or self.any_enabled((NODE_VM_COUNT_KEY,))),
+                (DOMAIN_LXC, self.lxc_guests or self.any_enabled((NODE_LXC_COUNT_KEY,))),
+                (DOMAIN_SERVICES, self.any_enabled(SERVICE_METRICS.keys)),
+            )
+            if not needed
+        )
+
+    def any_enabled(self, keys):
+        return self.enabled_metrics is None or any(key in self.enabled_metrics for key in keys)
+
+    def describe(self):
+        if self.enabled_metrics is None:
+            return "no featureSet information, collecting everything"
+        return (
+            f"cluster={self.cluster}, cluster_ha={self.cluster_ha}, "
+            f"domains={[domain for domain in DOMAINS if domain not in self.skipped_domains]}, "
+            f"vm_guests={self.vm_guests}, lxc_guests={self.lxc_guests}"
+        )
@@ -0,0 +1,673 @@
+import concurrent.futures
+import contextlib
+import logging
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import Future, as_completed
+
+from .backfill import MAX_BACKFILL_GAP, Backfill
+from .cadence import DomainCadence
+from .capture import load_replay
+from .collectors import (
+    COLLECTION_MODE_BULK,
+    COLLECTION_MODE_PER_GUEST,
+    COUNTER_OUTPUT_BOTH,
+    COUNTER_OUTPUT_RAW,
+    DOMAIN_INTERVAL_KEYS,
+    STORAGE_MODE_PER_NODE,
+    STORAGE_MODE_SHARED_ONCE,
+    NodeCollectors,
+)
+from .instrumentation import Instrumentation
+from .limiter import AdaptiveLimiter
+from .metric_sink import MetricSink
+from .planner import DOMAIN_NODE
+from .proxmox_api import DEFAULT_REQUEST_TIMEOUT, ProxmoxClient
+from .scheduler import CollectionScheduler
+from .snapshot import CycleSnapshot
+
+try:
+    import resource
+except ImportError:  # Not available on Windows, the peak RSS is reported as 0 there
+    resource = None
+
+default_logger = logging.getLogger(__name__)
+default_logger.setLevel(logging.INFO)
+
+# A worker that crashed more than max_restarts times within this many seconds is not restarted again
+RESTART_WINDOW = 3600
+
+
+def peak_rss():
+    # Peak RSS of this process in KB, macOS reports ru_maxrss in bytes where Linux reports KB
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+class WorkerError(Exception):
+    """A shard that a worker process did not answer, because it failed there or the process went away."""
+
+
+class ShardRequest:
+    """The nodes of one endpoint a worker process collects in one cycle, with what it needs of the cycle."""
+
+    __slots__ = (
+        "key",
+        "config",
+        "plan",
+        "cluster_status",
+        "nodes",
+        "skip_domains",
+        "timestamp",
+        "backfill_window",
+        "concurrency",
+        "rate",
+        "refresh_budget",
+    )
+
+    def __init__(
+        self,
+        key,
+        config,
+        plan,
+        cluster_status,
+        nodes,
+        skip_domains,
+        timestamp,
+        backfill_window,
+        concurrency,
+        rate,
+        refresh_budget,
+    ):
+        self.key = key  # Host of the endpoint, the worker keeps the endpoint's client and state under it
+        self.config = config
+        self.plan = plan
+        self.cluster_status = cluster_status
+        self.nodes = nodes  # Names of the nodes of this shard
+        self.skip_domains = skip_domains
+        self.timestamp = timestamp
+        self.backfill_window = backfill_window
+        self.concurrency = concurrency
+        self.rate = rate
+        self.refresh_budget = refresh_budget
+
+
+class ShardResult:
+    """What a worker process hands back for a shard.
+
+    The MINT lines travel as one UTF-8 block joined by newlines, which MINT lines cannot contain,
+    so the parent gets them with one decode and one split instead of unpickling every line.
+    Shared storages are handed back as values, the parent claims them across all shards.
+    """
+
+    __slots__ = (
+        "lines",
+        "line_count",
+        "shared_storages",
+        "requests",
+        "tasks",
+        "slowest",
+        "backfill_points",
+        "cpu",
+        "peak_rss",
+    )
+
+    def __init__(
+        self, lines, line_count, shared_storages, requests, tasks, slowest, backfill_points, cpu, peak_rss
+    ):
+        self.lines = lines
+        self.line_count = line_count
+        self.shared_storages = shared_storages  # storage name -> (type, total, used, avail)
+        self.requests = requests
+        self.tasks = tasks
+        self.slowest = slowest
+        self.backfill_points = backfill_points
+        self.cpu = cpu  # CPU seconds of the worker process while it collected the shard
+        self.peak_rss = peak_rss  # Peak RSS of the worker process in KB
+
+
+class ShardBuffer:
+    """Takes a worker's MetricSink lines in place of the extension until the shard is answered."""
+
+    __slots__ = ("lock", "lines", "shared_storages")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.lines = []
+        self.shared_storages = {}
+
+    def report_mint_lines(self, lines):
+        with self.lock:
+            self.lines.extend(lines)
+
+    def take(self):
+        with self.lock:
+            lines, self.lines = self.lines, []
+            shared_storages, self.shared_storages = self.shared_storages, {}
+        return lines, shared_storages
+
+
+class ShardView:
+    """One shard of an endpoint's client, so shards of overlapping cycles keep their own lines and tasks.
+
+    Attributes are those of the client, only the identity differs: the collectors key the sink
+    and the scheduler by it, while the inventory, rates and backfill are the endpoint's.
+    """
+
+    __slots__ = ("client", "shard_id")
+
+    def __init__(self, client, shard_id):
+        self.client = client
+        self.shard_id = shard_id
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def __str__(self):
+        return str(self.client)
+
+
+class ShardCollector(NodeCollectors):
+    """Runs inside a worker process and collects the shards its parent sends, with the thread-pool collectors.
+
+    Each endpoint gets its own ProxmoxClient, metric sink, guest inventory and counter rates in
+    the worker, kept from cycle to cycle. The parent always sends a node to the same worker, so
+    the rates and cached agent IPs of its guests stay where they were computed. The collectors
+    are the NodeCollectors the extension runs in its own process.
+    """
+
+    def __init__(self, max_workers=10, logger=default_logger):
+        self.logger = logger
+        self.scheduler = CollectionScheduler(max_workers=max_workers, logger=logger)
+        self.lock = threading.Lock()
+        self.endpoints = {}  # endpoint host -> ProxmoxClient of this worker
+        self.sinks = {}  # ProxmoxClient and ShardView -> MetricSink
+        self.inventories = {}
+        self.rate_stores = {}
+        self.backfills = {}
+        self.plan = None
+
+    def get_endpoint(self, request):
+        with self.lock:
+            endpoint = self.endpoints.get(request.key)
+            if endpoint is None:
+                endpoint = self.endpoints[request.key] = self.create_endpoint(request)
+            # The share of the endpoint's budget changes with the number of shards of the cycle
+            limiter = endpoint.limiter
+            maximum = request.concurrency + 1
+            if limiter is not None and (limiter.maximum, limiter.rate) != (maximum, request.rate):
+                endpoint.limiter = AdaptiveLimiter(maximum, rate=request.rate, logger=self.logger)
+        return endpoint
+
+    def open_shard(self, endpoint, shard_id, request):
+        # A cycle that overlaps the previous one (SHED) can send a shard of the same endpoint before the
+        # last one is answered, each shard gets its own buffer and scheduler key so neither takes the
+        # other's lines or waits for the other's tasks
+        shard = ShardView(endpoint, shard_id)
+        idle = threading.Event()
+        with self.lock:
+            changes = self.sinks[endpoint].changes
+            self.sinks[shard] = MetricSink(ShardBuffer(), changes=changes, logger=self.logger)
+            self.inventories[shard] = self.inventories[endpoint]
+            if endpoint in self.rate_stores:
+                self.rate_stores[shard] = self.rate_stores[endpoint]
+            if endpoint in self.backfills:
+                self.backfills[shard] = self.backfills[endpoint]
+        self.scheduler.register(
+            shard, request.concurrency, on_idle=idle.set, on_task=endpoint.instrumentation.record_task
+        )
+        return shard, idle
+
+    def close_shard(self, shard):
+        self.scheduler.unregister(shard)
+        with self.lock:
+            for table in (self.sinks, self.inventories, self.rate_stores, self.backfills):
+                table.pop(shard, None)
+
+    def create_endpoint(self, request):
+        config = request.config
+        limiter = None
+        if config.get("adaptive_concurrency", True):
+            limiter = AdaptiveLimiter(request.concurrency + 1, rate=request.rate, logger=self.logger)
+        replay = None
+        if config.get("replay_file"):
+            replay = load_replay(
+                config["replay_file"], speed=config.get("replay_speed", 1.0), logger=self.logger
+            )
+        endpoint = ProxmoxClient(
+            host=config.get("host"),
+            user=config.get("user"),
+            token_name=config.get("token_name"),
+            token_value=config.get("token_value"),
+            verify_ssl=False,
+            pool_size=request.concurrency + 1,
+            instrumentation=Instrumentation(logger=self.logger),
+            discover_hosts=config.get("discover_hosts", False),
+            timeout=config.get("request_timeout", DEFAULT_REQUEST_TIMEOUT),
+            limiter=limiter,
+            replay=replay,
+            stream_lists=config.get("stream_lists", True),
+        )
+        frequency = config.get("frequency", 60)
+        intervals = {domain: config.get(key, 0) for domain, key in DOMAIN_INTERVAL_KEYS.items()}
+        cadence = DomainCadence(frequency, intervals, logger=self.logger)
+        self.register_endpoint_state(endpoint, config, cadence, ShardBuffer())
+        if config.get("backfill", False):
+            # The parent opens the window and keeps the watermark, the worker only sends the points inside it
+            self.backfills[endpoint] = Backfill(
+                None,
+                endpoint.host,
+                frequency,
+                max_gap=config.get("backfill_max_gap", MAX_BACKFILL_GAP),
+                rates=config.get("counter_output", COUNTER_OUTPUT_BOTH) != COUNTER_OUTPUT_RAW,
+                logger=self.logger,
+            )
+        self.logger.info(f"Worker process {os.getpid()} collects for {endpoint}")
+        return endpoint
+
+    def collect_shard(self, shard_id, request):
+        cpu = time.process_time()
+        self.plan = request.plan
+        endpoint = self.get_endpoint(request)
+        endpoint.initialize_proxmoxapi()
+        shard, idle = self.open_shard(endpoint, shard_id, request)
+        try:
+            return self.collect_nodes(endpoint, shard, idle, request, cpu)
+        finally:
+            self.close_shard(shard)
+
+    def collect_nodes(self, endpoint, shard, idle, request, cpu):
+        sink = self.sinks[shard]
+        sink.timestamp = request.timestamp
+        self.inventories[endpoint].refresh_budget = request.refresh_budget
+        self.inventories[endpoint].start_cycle()
+        rates = self.rate_stores.get(endpoint)
+        if rates is not None:
+            rates.start_cycle()
+        backfill = self.backfills.get(endpoint)
+        backfill_points = 0
+        if backfill is not None:
+            backfill.window = request.backfill_window
+            backfill_points = backfill.points
+
+        # The worker's client routes and fails over on its own, its circuit breaker covers the nodes of its
+        # shards
+        storage_mode = request.config.get("storage_mode", STORAGE_MODE_PER_NODE)
+        shared_storage_once = storage_mode == STORAGE_MODE_SHARED_ONCE
+        snapshot = CycleSnapshot.from_cluster_status(request.cluster_status, self.logger, shared_storage_once)
+        endpoint.register_nodes(snapshot.nodes)
+        if endpoint.hosts_due():
+            endpoint.check_hosts()
+        collected_nodes = []
+        for node in snapshot.nodes:
+            if node.name not in request.nodes:
+                continue
+            if not endpoint.node_open(node.name):
+                collected_nodes.append(node)
+            elif DOMAIN_NODE not in request.skip_domains:
+                self.logger.info(f"Node {node.name} did not answer recently, skipping its collection")
+                self.report_node_metrics(sink, node, {})
+
+        self.submit_node_collection(shard, request.config, collected_nodes, request.skip_domains)
+        while True:
+            idle.clear()
+            if not self.scheduler.pending(shard):
+                break
+            idle.wait()
+
+        sink.flush()
+        lines, shared_storages = sink.extension.take()
+        requests, tasks, slowest = endpoint.instrumentation.cycle_snapshot()
+        if backfill is not None:
+            backfill_points = backfill.points - backfill_points
+        return ShardResult(
+            "\n".join(lines).encode(),
+            len(lines),
+            shared_storages,
+            requests,
+            tasks,
+            slowest,
+            backfill_points,
+            time.process_time() - cpu,
+            peak_rss(),
+        )
+
+    def report_storage_metrics(
+        self, sink, node, storage_name, storage_type, storage_total, storage_used, storage_avail, shared=False
+    ):
+        # A shared storage is claimed by the parent across the shards of all workers, the worker only keeps
+        # its values
+        if shared and node.cluster.shared_storages is not None:
+            sink.extension.shared_storages.setdefault(
+                storage_name, (storage_type, storage_total, storage_used, storage_avail)
+            )
+            return
+        super().report_storage_metrics(
+            sink, node, storage_name, storage_type, storage_total, storage_used, storage_avail, shared
+        )
+
+    def answer(self, connection, send_lock, shard_id, request):
+        try:
+            result, error = self.collect_shard(shard_id, request), None
+        except Exception as e:
+            self.logger.exception(f"Collection of shard {shard_id} for {request.key} failed: {e!r}")
+            result, error = None, repr(e)
+        with send_lock:
+            connection.send((shard_id, result, error))
+
+
+def worker_main(connection, index, max_workers, log_level, initializer=None):
+    # Entry point of a worker process, every shard is collected on its own thread until the parent goes away
+    logging.basicConfig(
+        level=log_level, format=f"%(asctime)s [proxmox-worker-{index}] %(levelname)s %(message)s"
+    )
+    logger = logging.getLogger("proxmox.worker")
+    logger.setLevel(log_level)
+    if initializer is not None:
+        initializer()
+    collector = ShardCollector(max_workers, logger=logger)
+    send_lock = threading.Lock()
+    while True:
+        try:
+            message = connection.recv()
+        except (EOFError, OSError):
+            break
+        if message is None:
+            break
+        threading.Thread(target=collector.answer, args=(connection, send_lock, *message), daemon=True).start()
+    collector.scheduler.shutdown()
+
+
+class WorkerProcess:
+    """One worker process of the pool, seen from the parent.
+
+    Shards are sent over a pipe with an id, a reader thread hands every answer to the future of
+    its shard. When the process exits, the futures of its unanswered shards fail and the process
+    is started again, unless it already crashed max_restarts times within RESTART_WINDOW. Then it
+    stays down and its nodes move to the other workers.
+    """
+
+    def __init__(
+        self, index, context, max_workers, max_restarts, log_level, initializer=None, logger=default_logger
+    ):
+        self.index = index
+        self.context = context
+        self.max_workers = max_workers
+        self.max_restarts = max_restarts
+        self.log_level = log_level
+        self.initializer = initializer
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.process = None
+        self.connection = None
+        self.pending = {}  # shard id -> Future
+        self.next_id = 0
+        self.restarts = deque()  # monotonic times of the restarts within RESTART_WINDOW
+        self.down = False
+        self.closing = False
+        self.shards = 0
+        self.crashes = 0
+        self.peak_rss = 0  # KB, as of the last shard the process answered
+        with self.lock:
+            self.start()
+
+    def start(self):
+        # Must be called with the lock held
+        connection, child_connection = self.context.Pipe()
+        process = self.context.Process(
+            target=worker_main,
+            args=(child_connection, self.index, self.max_workers, self.log_level, self.initializer),
+            name=f"proxmox-worker-{self.index}",
+            daemon=True,
+        )
+        process.start()
+        child_connection.close()
+        self.process, self.connection = process, connection
+        threading.Thread(
+            target=self.read,
+            args=(process, connection),
+            name=f"proxmox-worker-{self.index}-reader",
+            daemon=True,
+        ).start()
+
+    def submit(self, request):
+        future = Future()
+        with self.lock:
+            if self.down:
+                future.set_exception(WorkerError(f"Worker process {self.index} is down"))
+                return future
+            shard_id = self.next_id
+            self.next_id += 1
+            self.pending[shard_id] = future
+            self.shards += 1
+            try:
+                self.connection.send((shard_id, request))
+            except (OSError, ValueError) as e:
+                # The process just went away, read() restarts it
+                del self.pending[shard_id]
+                future.set_exception(
+                    WorkerError(f"Worker process {self.index} could not take the shard: {e!r}")
+                )
+        return future
+
+    def read(self, process, connection):
+        while True:
+            try:
+                shard_id, result, error = connection.recv()
+            except (EOFError, OSError):
+                break
+            with self.lock:
+                future = self.pending.pop(shard_id, None)
+            if future is None:
+                continue
+            if not future.set_running_or_notify_cancel():
+                continue  # The parent gave up on the shard
+            if error is not None:
+                future.set_exception(WorkerError(f"Worker process {self.index}: {error}"))
+            else:
+                future.set_result(result)
+        connection.close()
+        process.join(timeout=5)
+        self.crashed(process)
+
+    def crashed(self, process):
+        with self.lock:
+            if self.closing:
+                return
+            pending, self.pending = self.pending, {}
+            self.crashes += 1
+            self.peak_rss = 0
+            now = time.monotonic()
+            while self.restarts and now - self.restarts[0] > RESTART_WINDOW:
+                self.restarts.popleft()
+            restart = len(self.restarts) < self.max_restarts
+            if restart:
+                self.restarts.append(now)
+                self.start()
+            else:
+                self.down = True
+        error = WorkerError(f"Worker process {self.index} exited with code {process.exitcode}")
+        for future in pending.values():
+            if future.set_running_or_notify_cancel():
+                future.set_exception(error)
+        if restart:
+            self.logger.error(f"{error}, {len(pending)} shards lost, restarted it")
+        else:
+            self.logger.error(
+                f"{error}, not restarted after {self.max_restarts} restarts within {RESTART_WINDOW}s, "
+                f"its nodes move to the other workers"
+            )
+
+    def available(self):
+        with self.lock:
+            return not self.down
+
+    def close(self):
+        with self.lock:
+            self.closing = True
+            with contextlib.suppress(OSError, ValueError):
+                self.connection.send(None)
+            process = self.process
+        process.join(timeout=5)
+        if process.is_alive():
+            process.terminate()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "alive": self.process.is_alive(),
+                "down": self.down,
+                "shards": self.shards,
+                "crashes": self.crashes,
+                "peak_rss": self.peak_rss,
+            }
+
+    def __repr__(self):
+        return f"WorkerProcess({self.index})"
+
+
+class ProcessCollectionEngine:
+    """Collects the nodes of an endpoint's cycle in a pool of worker processes, to use more than one core.
+
+    In PER_GUEST mode the collected nodes are split into one shard per worker, a node always
+    goes to the same worker by the hash of its name. In BULK mode the whole endpoint is one
+    shard, cluster/resources is only requested once. The parent keeps the cycle, its snapshot and
+    the emission, the workers send the requests and build the MINT lines of their nodes.
+    """
+
+    def __init__(
+        self, extension, workers=2, max_restarts=5, max_workers=10, initializer=None, logger=default_logger
+    ):
+        self.extension = extension
+        self.logger = logger
+        # Spawned, not forked, the parent's scheduler and SDK threads could hold locks a forked child inherits
+        context = multiprocessing.get_context("spawn")
+        count = max(1, workers)
+        log_level = logger.getEffectiveLevel()
+        self.workers = [
+            WorkerProcess(index, context, max_workers, max_restarts, log_level, initializer, logger)
+            for index in range(count)
+        ]
+        self.lock = threading.Lock()
+        self.shards = 0
+        self.failed = 0
+        self.requests = 0
+        self.errors = 0
+        self.worker_cpu = 0.0
+        self.logger.info(f"Started {count} collection worker processes")
+
+    def run_cycle(self, endpoint, endpoint_config: dict, cluster_status, snapshot, nodes, skip_domains=()):
+        # Blocks until every shard is answered and its lines are in the endpoint's sink, False when no
+        # worker is left
+        workers = [worker for worker in self.workers if worker.available()]
+        if not workers:
+            return False
+        if not nodes:
+            return True
+
+        shards = {}
+        if endpoint_config.get("collection_mode", COLLECTION_MODE_PER_GUEST) == COLLECTION_MODE_BULK:
+            shards[workers[zlib.crc32(endpoint.host.encode()) % len(workers)]] = [node.name for node in nodes]
+        else:
+            for node in nodes:
+                worker = workers[zlib.crc32(node.name.encode()) % len(workers)]
+                shards.setdefault(worker, []).append(node.name)
+
+        # The endpoint's request budget, rate and agent lookups are split between its shards
+        count = len(shards)
+        concurrency = -(-endpoint_config.get("endpoint_concurrency", 5) // count)
+        rate = endpoint_config.get("max_requests_per_second", 0) / count
+        refresh_budget = -(-endpoint_config.get("agent_lookups_per_cycle", 20) // count)
+        sink = self.extension.sinks[endpoint]
+        backfill = self.extension.backfills.get(endpoint)
+        futures = {}
+        for worker, node_names in shards.items():
+            request = ShardRequest(
+                endpoint.host,
+                endpoint_config,
+                self.extension.plan,
+                cluster_status,
+                frozenset(node_names),
+                frozenset(skip_domains),
+                sink.timestamp,
+                backfill.window if backfill is not None else None,
+                concurrency,
+                rate,
+                refresh_budget,
+            )
+            futures[worker.submit(request)] = (worker, node_names)
+
+        # A shard still unanswered once its requests had the cycle and two request timeouts is given up
+        timeout = endpoint_config.get("frequency", 60) + 2 * endpoint_config.get(
+            "request_timeout", DEFAULT_REQUEST_TIMEOUT
+        )
+        try:
+            for future in as_completed(futures, timeout=timeout):
+                worker, node_names = futures.pop(future)
+                try:
+                    result = future.result()
+                except WorkerError as e:
+                    self.logger.error(f"Nodes {node_names} of {endpoint} were not collected: {e}")
+                    self.count_failed()
+                    continue
+                worker.peak_rss = result.peak_rss
+                self.emit(endpoint, snapshot, sink, backfill, result)
+        except concurrent.futures.TimeoutError:
+            for future, (worker, node_names) in futures.items():
+                # Its lines are dropped when they still arrive, they would land in a later cycle
+                future.cancel()
+                self.logger.error(
+                    f"Nodes {node_names} of {endpoint} were not collected: "
+                    f"{worker} did not answer within {timeout}s"
+                )
+                self.count_failed()
+        return True
+
+    def count_failed(self):
+        with self.lock:
+            self.shards += 1
+            self.failed += 1
+
+    def emit(self, endpoint, snapshot, sink, backfill, result):
+        if result.line_count:
+            sink.append(result.lines.decode().split("\n"))
+        shared_storages = snapshot.cluster.shared_storages
+        for storage_name, values in result.shared_storages.items():
+            if shared_storages is not None and shared_storages.claim(storage_name):
+                self.extension.report_shared_storage_metrics(sink, snapshot.cluster, storage_name, *values)
+        if endpoint.instrumentation is not None:
+            endpoint.instrumentation.merge(result.requests, result.tasks, result.slowest)
+        if backfill is not None and result.backfill_points:
+            backfill.add_points(result.backfill_points)
+        with self.lock:
+            self.shards += 1
+            self.requests += sum(stats.count for stats in result.requests.values())
+            self.errors += sum(stats.errors for stats in result.requests.values())
+            self.worker_cpu += result.cpu
+
+    def stats(self):
+        workers = [worker.stats() for worker in self.workers]
+        with self.lock:
+            return {
+                "workers": len(workers),
+                "alive": sum(1 for stats in workers if stats["alive"]),
+                "down": sum(1 for stats in workers if stats["down"]),
+                "crashes": sum(stats["crashes"] for stats in workers),
+                "shards": self.shards,
+                "failed": self.failed,
+                "requests": self.requests,
+                "errors": self.errors,
+                "worker_cpu_s": round(self.worker_cpu, 3),
+                "worker_rss_mb": round(sum(stats["peak_rss"] for stats in workers) / 1024, 1),
+            }
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
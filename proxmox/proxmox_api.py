@@ -1,64 +1,624 @@
-import logging
 import json
-from proxmoxer import ProxmoxAPI
+import logging
+import threading
+import time
+
+import requests
+from proxmoxer import AuthenticationError, ProxmoxAPI
+from proxmoxer.core import ResourceException
+from requests.adapters import HTTPAdapter
+
 from .common_functions import common_functions
+from .instrumentation import OUTCOME_ERROR, OUTCOME_OK, OUTCOME_TIMEOUT
+from .streaming import STREAM_CHUNK_SIZE, DataListParser
 
 default_logger = logging.getLogger(__name__)
 default_logger.setLevel(logging.INFO)
 
+
+class PooledHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter that can report how many requests were served by an already open connection."""
+
+    def pool_counters(self):
+        requests_total = 0
+        connections_total = 0
+        for key in list(self.poolmanager.pools.keys()):
+            pool = self.poolmanager.pools.get(key)
+            if pool is None:
+                continue
+            requests_total += pool.num_requests
+            connections_total += pool.num_connections
+        return requests_total, connections_total
+
+
+# Health-check backoff of a failed API host, doubled per consecutive failure
+HOST_RETRY_INITIAL = 30
+HOST_RETRY_MAX = 600
+
+# Seconds a request may take, connecting and reading each, unless the endpoint configures another value
+DEFAULT_REQUEST_TIMEOUT = 5
+
+# Failed requests in a row after which a node's circuit opens, and its backoff, doubled per consecutive trip
+NODE_FAILURE_THRESHOLD = 3
+NODE_RETRY_INITIAL = 60
+NODE_RETRY_MAX = 900
+# pveproxy answers these when the node it proxies a request to is unreachable or does not answer in time
+NODE_PROXY_ERRORS = (595, 596)
+# Answers of an overloaded pveproxy, 500 is left out as PVE also uses it for ordinary API errors
+OVERLOAD_ERRORS = (502, 503, 504)
+
+
+def split_host_port(host):
+    # "10.0.0.1:8006" -> ("10.0.0.1", "8006"), "[fd00::1]:8006" -> ("fd00::1", "8006"), bare IPv6 has no port
+    if host.startswith("["):
+        address, _, rest = host[1:].partition("]")
+        return address, rest[1:] if rest.startswith(":") else ""
+    if host.count(":") == 1:
+        address, port = host.split(":")
+        return address, port
+    return host, ""
+
+
+def route_node(request):
+    # Node whose own API can answer the request: "nodes/pve1/qemu" -> "pve1", cluster-wide requests -> None
+    parts = request.split("/", 2)
+    if len(parts) > 1 and parts[0] == "nodes":
+        return parts[1]
+    return None
+
+
+class ApiHost:
+    """One pveproxy of the cluster with its own pooled ProxmoxAPI session and health state."""
+
+    def __init__(self, host, configured=True):
+        self.host = host
+        self.configured = configured  # False for hosts discovered from cluster/status
+        self.api = None
+        self.adapter = None
+        # Discovered hosts are only used after a successful health check
+        self.healthy = configured
+        self.failures = 0
+        self.retry_at = 0.0
+        self.requests = 0
+
+    def __repr__(self):
+        return f"ApiHost({self.host})"
+
+
+class NodeBreaker:
+    """Circuit breaker of one cluster node.
+
+    After NODE_FAILURE_THRESHOLD failed requests in a row the circuit opens: the node's requests
+    fail fast without touching the network until the backoff expired. The first request after
+    that is let through alone as a probe, a success closes the circuit and a failure reopens it
+    with a doubled backoff.
+    """
+
+    __slots__ = ("failures", "trips", "retry_at", "probing")
+
+    def __init__(self):
+        self.failures = 0
+        self.trips = 0
+        self.retry_at = 0.0
+        self.probing = False  # A probe request is in flight, the other requests still fail fast
+
+
 class ProxmoxClient:
     def __init__(
         self,
-        host: str,
+        host,
         user: str,
         token_name: str,
         token_value: str,
         logger=default_logger,
-        verify_ssl=False
+        verify_ssl=False,
+        pool_size=10,
+        instrumentation=None,
+        discover_hosts=False,
+        timeout=DEFAULT_REQUEST_TIMEOUT,
+        limiter=None,
+        recorder=None,
+        replay=None,
+        stream_lists=True,
     ):
         self.logger = logger
+        # Every configured host can serve the API, the first one is the preferred host and names the endpoint
+        hosts = [entry for entry in (host if isinstance(host, list) else [host]) if entry]
+        if not hosts:
+            self.logger.warning("No host configured for the endpoint")
+            hosts = [""]
 
-        # Patch: Ensure host is always a string
-        if isinstance(host, list):
-            if host:
-                host = host[0]
-            else:
-                host = ""
-            self.logger.warning(f"Host was provided as a list, converted to string: {host}")
-
-        self.host = host
+        self.host = hosts[0]
         self.user = user
         self.token_name = token_name
         self.token_value = token_value
         self.verify_ssl = verify_ssl
-        self.api = None  # Will hold the ProxmoxAPI connection
+        self.pool_size = pool_size
+        self.instrumentation = instrumentation  # Records latency and outcome of every request when set
+        self.discover_hosts = discover_hosts  # Also use the node IPs reported by cluster/status
+        self.timeout = timeout
+        # AdaptiveLimiter of the endpoint, None sends requests as soon as they are made
+        self.limiter = limiter
+        self.recorder = recorder  # CaptureRecorder writing every answer to a capture file when set
+        # ReplayTransport answering every request from a capture instead of the network when set
+        self.replay = replay
+        # fetch_iter parses list responses as they arrive instead of decoding them at once
+        self.stream_lists = stream_lists
+        self.api_hosts = {entry: ApiHost(entry) for entry in hosts}
+        self.node_hosts = {}  # node name -> host serving that node's own requests
+        self.node_breakers = {}  # node name -> NodeBreaker, created on the node's first failure
+
+        # Connection pool bookkeeping, counters of dropped pools are kept so stats survive a rebuild
+        self.api_lock = threading.Lock()
+        self.pool_rebuilds = 0
+        self.retired_requests = 0
+        self.retired_connections = 0
 
-    def initialize_proxmoxapi(self):
-        self.logger.info(f"ProxmoxClient - Building Client API Auth")
-        self.api = ProxmoxAPI(
-            self.host,
+    def build_api(self, host):
+        return ProxmoxAPI(
+            host,
             user=self.user,
             token_name=self.token_name,
             token_value=self.token_value,
-            verify_ssl=self.verify_ssl
+            verify_ssl=self.verify_ssl,
+            timeout=self.timeout,
         )
-        return self.api
 
-    def get_metrics(self, request):
-        JSON = None
+    def initialize_proxmoxapi(self, api_host=None):
+        # The ProxmoxAPI session of a host is long-lived, it is only rebuilt after invalidate_proxmoxapi()
+        api_host = api_host or self.api_hosts[self.host]
+        with self.api_lock:
+            if api_host.api is not None:
+                return api_host.api
+
+            self.logger.info(
+                f"ProxmoxClient - Building Client API Auth for {api_host.host} "
+                f"with a connection pool of {self.pool_size}"
+            )
+            api = self.build_api(api_host.host)
+
+            # proxmoxer does not expose its requests session, mount our own pool sized to the
+            # collector concurrency
+            adapter = PooledHTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, pool_block=True)
+            api._store["session"].mount("https://", adapter)
+
+            api_host.api = api
+            api_host.adapter = adapter
+            self.pool_rebuilds += 1
+            return api
+
+    def invalidate_proxmoxapi(self, reason, api_host=None):
+        api_host = api_host or self.api_hosts[self.host]
+        with self.api_lock:
+            if api_host.api is None:
+                return
+            self.logger.warning(f"ProxmoxClient - Dropping connection pool for {api_host.host}: {reason}")
+            requests_total, connections_total = api_host.adapter.pool_counters()
+            self.retired_requests += requests_total
+            self.retired_connections += connections_total
+            api_host.api._store["session"].close()
+            api_host.api = None
+            api_host.adapter = None
+
+    def is_session_failure(self, error):
+        # Only auth and transport failures justify a new pool, API errors on a single path do not
+        if isinstance(error, AuthenticationError):
+            return True
+        if isinstance(error, ResourceException):
+            return error.status_code == 401
+        return isinstance(error, requests.exceptions.ConnectionError)
+
+    def is_host_failure(self, error, node=None):
+        # The host itself did not answer, another host of the cluster may
+        # A read timeout on a node's request is blamed on that node, the host has proxied it
+        if isinstance(error, requests.exceptions.ConnectionError):
+            return True
+        return node is None and isinstance(error, requests.exceptions.Timeout)
+
+    def is_node_failure(self, request, status, timed_out):
+        # The node behind the request could not be reached or did not answer in time
+        # Hanging guest agents time out as well, they say nothing about the node itself
+        if "/agent/" in request:
+            return False
+        return timed_out or status in NODE_PROXY_ERRORS
+
+    def is_overload(self, request, status, timed_out):
+        # pveproxy answered that it is overloaded or did not answer in time, hanging guest agents do not count
+        if "/agent/" in request:
+            return False
+        return timed_out or status in OVERLOAD_ERRORS
+
+    def is_latency_sample(self, request):
+        # Guest agents answer when the guest does and rrddata is read from disk, their latency says
+        # nothing about pveproxy
+        return "/agent/" not in request and not request.endswith("/rrddata")
+
+    def node_open(self, node):
+        # True while the node's circuit is open and its backoff has not expired, a cycle then skips the node
+        breaker = self.node_breakers.get(node)
+        if breaker is None or breaker.failures < NODE_FAILURE_THRESHOLD:
+            return False
+        return time.monotonic() < breaker.retry_at
+
+    def node_available(self, node):
+        # False while the node's circuit is open, its requests are then not sent at all
+        # Once the backoff expired one request is let through as the probe, the others wait for its outcome
+        breaker = self.node_breakers.get(node)
+        if breaker is None or breaker.failures < NODE_FAILURE_THRESHOLD:
+            return True
+        now = time.monotonic()
+        with self.api_lock:
+            if now < breaker.retry_at:
+                return False
+            # A probe that neither succeeds nor fails the node lets the next one through after its timeout
+            breaker.probing = True
+            breaker.retry_at = now + 2 * self.timeout
+        return True
+
+    def node_failed(self, node, error):
+        now = time.monotonic()
+        with self.api_lock:
+            breaker = self.node_breakers.get(node)
+            if breaker is None:
+                breaker = self.node_breakers[node] = NodeBreaker()
+            breaker.failures += 1
+            # Requests already in flight when the circuit opened do not extend it, a failed probe does
+            if breaker.failures < NODE_FAILURE_THRESHOLD or (now < breaker.retry_at and not breaker.probing):
+                return
+            breaker.probing = False
+            breaker.trips += 1
+            backoff = min(NODE_RETRY_INITIAL * 2 ** (breaker.trips - 1), NODE_RETRY_MAX)
+            breaker.retry_at = now + backoff
+        self.logger.warning(
+            f"ProxmoxClient - Node {node} failed {breaker.failures} requests in a row, "
+            f"skipping it for {backoff}s: {error}"
+        )
+
+    def node_succeeded(self, node):
+        breaker = self.node_breakers.get(node)
+        if breaker is None or not breaker.failures:
+            return
+        with self.api_lock:
+            recovered = breaker.trips > 0
+            breaker.failures = 0
+            breaker.trips = 0
+            breaker.retry_at = 0.0
+            breaker.probing = False
+        if recovered:
+            self.logger.info(f"ProxmoxClient - Node {node} answers again")
+
+    def breaker_stats(self):
+        now = time.monotonic()
+        with self.api_lock:
+            return {
+                node: {
+                    "failures": breaker.failures,
+                    "trips": breaker.trips,
+                    "open": breaker.failures >= NODE_FAILURE_THRESHOLD and now < breaker.retry_at,
+                }
+                for node, breaker in self.node_breakers.items()
+                if breaker.failures
+            }
+
+    def register_nodes(self, nodes):
+        # Maps every NodeRecord to the host that is its own API: a configured host with the node's IP,
+        # or a discovered one
+        configured = {
+            split_host_port(host)[0]: host for host, api_host in self.api_hosts.items() if api_host.configured
+        }
+        port = split_host_port(self.host)[1]
+        with self.api_lock:
+            for node in nodes:
+                address = node.ip
+                if not address:
+                    continue
+                host = configured.get(address)
+                if host is None and self.discover_hosts:
+                    host = (f"[{address}]" if ":" in address else address) + (f":{port}" if port else "")
+                    if host not in self.api_hosts:
+                        self.logger.info(f"ProxmoxClient - Discovered API host {host} of node {node.name}")
+                        self.api_hosts[host] = ApiHost(host, configured=False)
+                if host is not None:
+                    self.node_hosts[node.name] = host
+
+    def select_host(self, node=None, exclude=()):
+        # The node's own host when it is healthy, else the first healthy configured host, else any
+        # healthy host
+        with self.api_lock:
+            api_host = self.api_hosts.get(self.node_hosts.get(node)) if node is not None else None
+            if api_host is None or not api_host.healthy or api_host.host in exclude:
+                healthy = [
+                    candidate
+                    for candidate in self.api_hosts.values()
+                    if candidate.healthy and candidate.host not in exclude
+                ]
+                api_host = next((candidate for candidate in healthy if candidate.configured), None)
+                if api_host is None and healthy:
+                    api_host = healthy[0]
+            if api_host is None:
+                # Nothing known to be healthy, try the host that failed longest ago rather than giving up
+                candidates = [
+                    candidate for candidate in self.api_hosts.values() if candidate.host not in exclude
+                ]
+                api_host = min(candidates, key=lambda candidate: candidate.retry_at) if candidates else None
+            if api_host is not None:
+                api_host.requests += 1
+            return api_host
+
+    def mark_up(self, api_host):
+        if api_host.healthy and not api_host.failures:
+            return
+        with self.api_lock:
+            recovered = not api_host.healthy
+            api_host.healthy = True
+            api_host.failures = 0
+        if recovered:
+            self.logger.info(f"ProxmoxClient - API host {api_host.host} is healthy")
+
+    def mark_down(self, api_host, error):
+        with self.api_lock:
+            api_host.failures += 1
+            backoff = min(HOST_RETRY_INITIAL * 2 ** (api_host.failures - 1), HOST_RETRY_MAX)
+            api_host.retry_at = time.monotonic() + backoff
+            failed = api_host.healthy
+            api_host.healthy = False
+        if failed:
+            self.logger.warning(
+                f"ProxmoxClient - API host {api_host.host} failed, next check in {backoff}s: {error}"
+            )
+
+    def hosts_due(self):
+        # Unhealthy hosts whose backoff expired, they are health-checked before they get traffic again
+        now = time.monotonic()
+        with self.api_lock:
+            return [
+                api_host
+                for api_host in self.api_hosts.values()
+                if not api_host.healthy and api_host.retry_at <= now
+            ]
+
+    def check_hosts(self):
+        for api_host in self.hosts_due():
+            try:
+                self.request_host(api_host, "version")
+            except Exception as e:
+                self.mark_down(api_host, e)
+                if self.is_session_failure(e):
+                    self.invalidate_proxmoxapi(e, api_host)
+                continue
+            self.mark_up(api_host)
+
+    def host_stats(self):
+        with self.api_lock:
+            return {
+                api_host.host: {
+                    "healthy": api_host.healthy,
+                    "configured": api_host.configured,
+                    "failures": api_host.failures,
+                    "requests": api_host.requests,
+                }
+                for api_host in self.api_hosts.values()
+            }
+
+    def pool_stats(self):
+        with self.api_lock:
+            requests_total = self.retired_requests
+            connections_total = self.retired_connections
+            for api_host in self.api_hosts.values():
+                if api_host.adapter is not None:
+                    current_requests, current_connections = api_host.adapter.pool_counters()
+                    requests_total += current_requests
+                    connections_total += current_connections
+            return {
+                "requests": requests_total,
+                "hits": requests_total - connections_total,
+                "misses": connections_total,
+                "rebuilds": self.pool_rebuilds,
+            }
+
+    def fetch(self, request, params=None, stream=False):
+        # Returns the decoded response as proxmoxer parsed it, or None when the request failed, params go
+        # into the query
+        # A host that does not answer is marked down and the request is repeated on the next one
+        # With stream, a list response is returned as an iterator over its entries, read once the headers
+        # arrived, the request only ends once the iterator has read the body
+        node = route_node(request)
+        if node is not None and not self.node_available(node):
+            return None
+
+        # Timed once the limiter let the request through, waiting behind other requests is not latency
+        if self.limiter is not None:
+            self.limiter.acquire()
+        start = time.perf_counter()
+        outcome = OUTCOME_OK
+        overloaded = False
+        streaming = False
+        tried = []
         try:
-            JSON = json.dumps(self.api(request).get())
-            if common_functions.is_valid_json(JSON):
-                self.logger.info(f"nodeMetricsJSON for '{request}' is valid JSON.")
+            while True:
+                api_host = self.select_host(node, tried)
+                if api_host is None:
+                    return None
+                try:
+                    data = self.request_host(api_host, request, params, stream)
+                except Exception as e:
+                    if self.is_host_failure(e, node):
+                        self.mark_down(api_host, e)
+                        tried.append(api_host.host)
+                        if len(tried) < len(self.api_hosts):
+                            continue
+                    timed_out = isinstance(e, requests.exceptions.Timeout)
+                    outcome = OUTCOME_TIMEOUT if timed_out else OUTCOME_ERROR
+                    overloaded = self.is_overload(request, getattr(e, "status_code", None), timed_out)
+                    self.logger.error(f"Error fetching metrics for '{request}' from {api_host.host}: {e}")
+                    if self.recorder is not None:
+                        self.recorder.record(
+                            request,
+                            params,
+                            start,
+                            time.perf_counter() - start,
+                            status=getattr(e, "status_code", None),
+                            timed_out=timed_out,
+                        )
+                    if self.is_session_failure(e):
+                        self.invalidate_proxmoxapi(e, api_host)
+                    status = getattr(e, "status_code", None)
+                    if node is not None and self.is_node_failure(request, status, timed_out):
+                        self.node_failed(node, e)
+                    return None
+                self.mark_up(api_host)
+                if node is not None:
+                    self.node_succeeded(node)
+                if stream:
+                    # The limiter slot is kept until the body is read, read_list gives it back
+                    streaming = True
+                    entries = self.read_list(request, params, start, data)
+                    next(entries)  # Started, so a stream dropped unread still ends its request
+                    return entries
+                if self.recorder is not None:
+                    self.recorder.record(request, params, start, time.perf_counter() - start, data)
+                return data
+        finally:
+            if not streaming:
+                self.end_request(request, start, outcome, overloaded)
+
+    def end_request(self, request, start, outcome, overloaded=False):
+        # Gives the limiter slot back and records the request, with its latency up to now
+        duration = time.perf_counter() - start
+        if self.limiter is not None:
+            self.limiter.release(duration, overloaded, self.is_latency_sample(request))
+        if self.instrumentation is not None:
+            self.instrumentation.record_request(request, duration, outcome)
+
+    def read_list(self, request, params, start, response):
+        # Hands out the entries of a streamed list as its body is read, the request ends once the body
+        # is read, failed or the caller stopped reading it
+        outcome = OUTCOME_OK
+        overloaded = False
+        recorded = [] if self.recorder is not None else None
+        parser = DataListParser()
+        count = 0
+        try:
+            yield None
+            for entry in self.iter_list(response, parser):
+                count += 1
+                if recorded is not None:
+                    recorded.append(entry)
+                yield entry
+        except (requests.exceptions.RequestException, ValueError) as e:
+            # The entries read so far have been handed out, the rest of the list is lost
+            timed_out = isinstance(e, requests.exceptions.Timeout)
+            outcome = OUTCOME_TIMEOUT if timed_out else OUTCOME_ERROR
+            overloaded = self.is_overload(request, None, timed_out)
+            self.logger.error(f"Error reading the response of '{request}' after {count} entries: {e!r}")
+            if recorded is not None:
+                self.recorder.record(
+                    request, params, start, time.perf_counter() - start, status=None, timed_out=timed_out
+                )
+        else:
+            if parser.unexpected is not None:
+                self.logger.warning(f"Expected a list for '{request}', got {parser.unexpected}.")
+            if recorded is not None:
+                self.recorder.record(request, params, start, time.perf_counter() - start, recorded)
+        finally:
+            response.close()
+            self.end_request(request, start, outcome, overloaded)
+
+    def request_host(self, api_host, request, params=None, stream=False):
+        # One GET on one API host, answered from the capture instead when the client replays one
+        if self.replay is not None:
+            return self.replay.get(request, params)
+        api = self.initialize_proxmoxapi(api_host)
+        if stream:
+            return self.stream_list(api, request, params)
+        return api(request).get(**(params or {}))
+
+    def stream_list(self, api, request, params=None):
+        # Sends the request on the host's proxmoxer session and returns the response once its headers
+        # arrived, read_list reads the body while the entries are consumed
+        url = api(request)._store["base_url"]
+        response = api._store["session"].request("GET", url, params=params, stream=True)
+        if response.status_code >= 400:
+            response.close()
+            raise ResourceException(response.status_code, response.reason, response.reason)
+        return response
+
+    @staticmethod
+    def iter_list(response, parser):
+        # The entries of the body as its chunks complete them, raises what reading or parsing it raises
+        for chunk in response.iter_content(STREAM_CHUNK_SIZE):
+            yield from parser.feed(chunk)
+        yield from parser.close()
+
+    def fetch_iter(self, request, required_keys=(), params=None):
+        # Like fetch_list, but a streamed list is parsed entry by entry while the caller iterates it
+        # A replayed request is decoded at once, the capture holds the whole response
+        if not self.stream_lists or self.replay is not None:
+            return iter(self.fetch_list(request, required_keys, params))
+        entries = self.fetch(request, params, stream=True)
+        if entries is None:
+            return iter(())
+        return self.validate_entries(request, entries, required_keys)
+
+    def validate_entries(self, request, entries, required_keys=()):
+        dropped = 0
+        for entry in entries:
+            if common_functions.has_keys(entry, required_keys):
+                yield entry
             else:
-                self.logger.warning(f"Invalid JSON for nodeMetricsJSON for '{request}'.")
-        except Exception as e:
-            self.logger.error(f"Error fetching metrics for '{request}': {e}")
-            JSON = json.dumps({})
-        return JSON
-
-    def get_metrics_2(self, request):
-        return self.get_metrics(request)
+                dropped += 1
+        if dropped:
+            self.logger.warning(f"Dropped {dropped} malformed entries from '{request}'.")
+
+    def fetch_list(self, request, required_keys=(), params=None):
+        # Fetches a list response, entries which are not dicts or lack a required key are dropped
+        return self.validate_list(request, self.fetch(request, params), required_keys)
+
+    def fetch_dict(self, request, required_keys=()):
+        # Fetches a dict response, an empty dict is returned when it is malformed or lacks a required key
+        return self.validate_dict(request, self.fetch(request), required_keys)
+
+    def validate_list(self, request, data, required_keys=()):
+        if data is None:
+            return []
+        if not isinstance(data, list):
+            self.logger.warning(f"Expected a list for '{request}', got {type(data).__name__}.")
+            return []
+
+        entries = [entry for entry in data if common_functions.has_keys(entry, required_keys)]
+        if len(entries) != len(data):
+            self.logger.warning(f"Dropped {len(data) - len(entries)} malformed entries from '{request}'.")
+        return entries
+
+    def validate_dict(self, request, data, required_keys=()):
+        if data is None:
+            return {}
+        if not common_functions.has_keys(data, required_keys):
+            self.logger.warning(
+                f"Expected a dict with keys {required_keys} for '{request}', got {type(data).__name__}."
+            )
+            return {}
+        return data
+
+    def get_cluster_status(self):
+        cluster_status = self.fetch_list("cluster/status", ("type",))
+        self.logger.info(f"Fetch and print cluster status: {cluster_status}")
+        return cluster_status
+
+    def get_node_status(self):
+        node_status = self.fetch_list("nodes", ("node",))
+        self.logger.info(f"Fetch and print node status: {node_status}")
+        return node_status
+
+    def get_node_info(self, node_status):
+        node_names = [item["node"] for item in node_status]
+        self.logger.info(f"Extracted node names from the node status: {node_names}")
+        return node_names
+
+    def get_metrics(self, request):
+        # Kept for callers which expect a JSON string, collectors use fetch_list/fetch_dict instead
+        data = self.fetch(request)
+        return json.dumps(data if data is not None else {})
 
     def __repr__(self):
         return f"ProxmoxClient({self.host})"
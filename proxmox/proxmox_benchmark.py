@@ -0,0 +1,417 @@
+"""End-to-end collection benchmark against the local Proxmox simulator (not production).
+
+For every scenario the simulator is started in this process and the extension runs in a
+child process, so its CPU time and peak RSS are measured on their own. The child runs the
+real ProxmoxExtension (DEV mode, metrics are counted instead of sent) for a number of cycles
+and reports wall time, API calls, metric lines, CPU seconds and peak RSS per cycle:
+
+    python -m proxmox.proxmox_benchmark --scenarios 3x30,10x500,30x3000,100x10000 --latency-ms 5
+
+The first cycle starts with an empty inventory cache, so it includes every guest-agent lookup.
+
+--record writes the API answers of the child's cycles to a capture, --replay runs the child
+against a capture instead of the simulator, e.g. one recorded on a customer cluster:
+
+    python -m proxmox.proxmox_benchmark --replay capture.jsonl.gz --replay-speed 0 --cycles 5
+"""
+
+import argparse
+import gzip
+import json
+import logging
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from pathlib import Path
+
+from .process_engine import peak_rss
+from .proxmox_simulator import add_simulator_arguments, build_simulator
+
+DEFAULT_SCENARIOS = "3x30,10x500,30x3000,100x10000"
+ROOT = Path(__file__).resolve().parent.parent
+EXTENSION_YAML = str(ROOT / "extension" / "extension.yaml")
+
+
+def parse_scenarios(value):
+    # "3x30,10x500" -> [(3, 30), (10, 500)], nodes x guests
+    scenarios = []
+    for scenario in value.split(","):
+        nodes, guests = scenario.lower().split("x")
+        scenarios.append((int(nodes), int(guests)))
+    return scenarios
+
+
+def simulator_stats(port, reset=False):
+    url = f"http://127.0.0.1:{port}/{'_reset' if reset else '_stats'}"
+    with urllib.request.urlopen(url, timeout=10) as response:
+        return json.load(response)
+
+
+def capture_shape(path):
+    # Nodes and guests of the first cycle of a capture, for the report
+    nodes, guests, seen = 0, 0, set()
+    with gzip.open(path, "rt", encoding="utf-8") as capture:
+        capture.readline()
+        for line in capture:
+            record = json.loads(line)
+            path = record["path"]
+            if path in seen or not isinstance(record["data"], list):
+                continue
+            seen.add(path)
+            if path == "cluster/status":
+                nodes = sum(
+                    1 for item in record["data"] if isinstance(item, dict) and item.get("type") == "node"
+                )
+            elif path.startswith("nodes/") and path.endswith(("/qemu", "/lxc")):
+                guests += len(record["data"])
+    return nodes, guests
+
+
+def use_plain_http():
+    # The simulator speaks plain HTTP, every API host the clients build is pointed at it that way
+    # Also the initializer of the collection worker processes, which do not inherit the patch
+    from .async_engine import AsyncProxmoxClient
+    from .proxmox_api import ProxmoxClient
+
+    build_api = ProxmoxClient.build_api
+
+    def build_plain_http_api(self, host):
+        api = build_api(self, host)
+        api._store["base_url"] = api._store["base_url"].replace("https://", "http://", 1)
+        return api
+
+    ProxmoxClient.build_api = build_plain_http_api
+    AsyncProxmoxClient.build_base_url = staticmethod(lambda host: f"http://{host}/api2/json/")
+
+
+def run_child(args):
+    # Runs inside the child process, prints one JSON document with the per-cycle results
+    host = f"127.0.0.1:{args.port}" if args.port else "127.0.0.1:8006"
+    state_file = None
+    if args.backfill_gap:
+        # The first cycle finds a watermark backfill_gap seconds old, as if the extension had been down
+        # that long
+        with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as state:
+            json.dump({host: int((time.time() - args.backfill_gap) * 1000)}, state)
+        state_file = state.name
+
+    activation = {
+        "enabled": True,
+        "description": "benchmark",
+        "version": "0.0.1",
+        "activationContext": "REMOTE",
+        "pythonRemote": {
+            "max_workers": args.max_workers,
+            "process_workers": args.process_workers,
+            "backfill_state_file": state_file,
+            "endpoints": [
+                {
+                    "host": [host],
+                    "user": "root@pam",
+                    "token_name": "benchmark",
+                    "token_value": "benchmark",
+                    "frequency": 60,
+                    "endpoint_concurrency": args.endpoint_concurrency,
+                    "async_concurrency": args.async_concurrency,
+                    "engine": args.engine,
+                    "collection_mode": args.collection_mode,
+                    "storage_mode": args.storage_mode,
+                    "agent_lookups_per_cycle": args.agent_lookups_per_cycle,
+                    "discover_hosts": args.discover_hosts,
+                    "request_timeout": args.request_timeout,
+                    "backfill": bool(args.backfill_gap),
+                    "adaptive_concurrency": not args.fixed_concurrency,
+                    "max_requests_per_second": args.max_requests_per_second,
+                    "static_heartbeat": args.static_heartbeat,
+                    "capture_file": args.record,
+                    "capture_cycles": args.cycles,
+                    "replay_file": args.replay,
+                    "replay_speed": args.replay_speed,
+                    "stream_lists": not args.no_stream_lists,
+                }
+            ],
+        },
+    }
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as activation_file:
+        json.dump(activation, activation_file)
+
+    sys.argv = [
+        sys.argv[0],
+        "--activationconfig",
+        activation_file.name,
+        "--extensionconfig",
+        EXTENSION_YAML,
+        "--no-print-metrics",
+    ]
+
+    # Imported here so the parent process does not pay for the SDK
+    from .__main__ import ProxmoxExtension
+
+    use_plain_http()
+
+    class BenchmarkExtension(ProxmoxExtension):
+        worker_initializer = staticmethod(use_plain_http)
+
+        def __init__(self):
+            self.callbacks = []
+            self.metric_lines = 0
+            super().__init__()
+
+        def schedule(self, callback, interval, args=None, activation_type=None, offset_seconds=None):  # noqa: ARG002
+            # Only the endpoint cycles are run, by the benchmark loop instead of the SDK scheduler
+            if callback == self.monitor:
+                self.callbacks.append((callback, args))
+
+        def report_mint_lines(self, lines):
+            self.metric_lines += len(lines)
+
+    logging.getLogger().setLevel(args.log_level)
+    extension = BenchmarkExtension()
+    extension.logger.setLevel(args.log_level)
+    Path(activation_file.name).unlink()
+
+    def replay_stats():
+        # Requests served from the capture by all endpoints, counted in place of the simulator's
+        served = failed = 0
+        for endpoint in extension.cycle_guards:
+            stats = endpoint.replay.stats()
+            served += stats["served"]
+            failed += stats["failed"]
+        if extension.process_engine is not None:
+            # The worker processes answer from their own copies of the capture
+            stats = extension.process_engine.stats()
+            served += stats["requests"]
+            failed += stats["errors"]
+        return {"requests": served, "errors": failed, "overloaded": 0, "paths": {}, "addresses": {}}
+
+    def worker_stats():
+        # CPU seconds and peak RSS in MB of the collection worker processes, which the CPU time of the
+        # child leaves out
+        if extension.process_engine is None:
+            return 0.0, 0.0
+        stats = extension.process_engine.stats()
+        return stats["worker_cpu_s"], stats["worker_rss_mb"]
+
+    results = []
+    for cycle in range(args.cycles):
+        if args.replay:
+            stats_before = replay_stats()
+        else:
+            simulator_stats(args.port, reset=True)
+        lines_before = extension.metric_lines
+        cpu_before = time.process_time()
+        worker_cpu_before, _ = worker_stats()
+        start = time.perf_counter()
+
+        for callback, callback_args in extension.callbacks:
+            callback(*callback_args)
+
+        for guard in extension.cycle_guards.values():
+            while guard.running:
+                time.sleep(0.005)
+
+        wall = time.perf_counter() - start
+        cpu = time.process_time()
+        worker_cpu, worker_rss = worker_stats()
+        if args.replay:
+            stats = replay_stats()
+            stats["requests"] -= stats_before["requests"]
+            stats["errors"] -= stats_before["errors"]
+        else:
+            stats = simulator_stats(args.port)
+        results.append(
+            {
+                "cycle": cycle + 1,
+                "wall_s": round(wall, 3),
+                "cpu_s": round(cpu - cpu_before + worker_cpu - worker_cpu_before, 3),
+                "api_calls": stats["requests"],
+                "api_errors": stats["errors"] + stats["overloaded"],
+                "metric_lines": extension.metric_lines - lines_before,
+                "peak_rss_mb": round(peak_rss() / 1024 + worker_rss, 1),
+                "paths": stats["paths"],
+                "addresses": stats["addresses"],
+            }
+        )
+
+    print(json.dumps(results), flush=True)
+    extension.on_shutdown()
+    if state_file is not None:
+        Path(state_file).unlink()
+
+
+def run_scenario(args, nodes, guests):
+    args.nodes, args.guests = nodes, guests
+    simulator = build_simulator(args)
+    # Node IPs on the loopback network are only reachable when the simulator listens on all addresses
+    port = simulator.start("0.0.0.0" if args.loopback_node_ips else "127.0.0.1")
+    try:
+        return run_benchmark_child(args, ["--port", str(port)], f"{nodes}x{guests}")
+    finally:
+        simulator.stop()
+
+
+def run_benchmark_child(args, target, scenario):
+    # target points the child at the simulator's port or at a capture to replay
+    command = [
+        sys.executable,
+        "-m",
+        "proxmox.proxmox_benchmark",
+        "--child",
+        *target,
+        "--cycles",
+        str(args.cycles),
+        "--engine",
+        args.engine,
+        "--collection-mode",
+        args.collection_mode,
+        "--storage-mode",
+        args.storage_mode,
+        "--max-workers",
+        str(args.max_workers),
+        "--process-workers",
+        str(args.process_workers),
+        "--endpoint-concurrency",
+        str(args.endpoint_concurrency),
+        "--async-concurrency",
+        str(args.async_concurrency),
+        "--agent-lookups-per-cycle",
+        str(args.agent_lookups_per_cycle),
+        "--request-timeout",
+        str(args.request_timeout),
+        "--backfill-gap",
+        str(args.backfill_gap),
+        "--max-requests-per-second",
+        str(args.max_requests_per_second),
+        "--static-heartbeat",
+        str(args.static_heartbeat),
+        "--log-level",
+        args.log_level,
+    ]
+    if args.discover_hosts:
+        command.append("--discover-hosts")
+    if args.fixed_concurrency:
+        command.append("--fixed-concurrency")
+    if args.no_stream_lists:
+        command.append("--no-stream-lists")
+    if args.record:
+        command += ["--record", args.record]
+    completed = subprocess.run(command, cwd=ROOT, capture_output=True, text=True, timeout=args.timeout)
+    if completed.returncode != 0:
+        raise RuntimeError(f"Benchmark child failed for {scenario}:\n{completed.stderr[-4000:]}")
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def print_report(rows, verbose=False):
+    header = (
+        f"{'nodes':>5} {'guests':>6} {'cycle':>5} {'wall s':>8} {'cpu s':>7} {'api calls':>9} "
+        f"{'errors':>6} {'lines':>7} {'peak RSS MB':>11}"
+    )
+    print(header)
+    print("-" * len(header))
+    for nodes, guests, result in rows:
+        print(
+            f"{nodes:>5} {guests:>6} {result['cycle']:>5} {result['wall_s']:>8.3f} {result['cpu_s']:>7.3f} "
+            f"{result['api_calls']:>9} {result['api_errors']:>6} {result['metric_lines']:>7} "
+            f"{result['peak_rss_mb']:>11.1f}"
+        )
+        if verbose:
+            for template, count in sorted(result["paths"].items()):
+                print(f"{'':>12}{template}: {count}")
+            for address, count in sorted(result["addresses"].items()):
+                print(f"{'':>12}served on {address}: {count}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="End-to-end collection benchmark against the Proxmox simulator"
+    )
+    add_simulator_arguments(parser)
+    parser.add_argument("--scenarios", default=DEFAULT_SCENARIOS, help="comma separated <nodes>x<guests>")
+    parser.add_argument("--cycles", type=int, default=3)
+    parser.add_argument("--engine", default="THREAD_POOL", choices=("THREAD_POOL", "ASYNCIO", "PROCESS_POOL"))
+    parser.add_argument("--collection-mode", default="PER_GUEST", choices=("PER_GUEST", "BULK"))
+    parser.add_argument("--storage-mode", default="PER_NODE", choices=("PER_NODE", "SHARED_ONCE"))
+    parser.add_argument("--max-workers", type=int, default=10)
+    parser.add_argument(
+        "--process-workers", type=int, default=2, help="worker processes of the PROCESS_POOL engine"
+    )
+    parser.add_argument("--endpoint-concurrency", type=int, default=5)
+    parser.add_argument("--async-concurrency", type=int, default=10)
+    parser.add_argument("--agent-lookups-per-cycle", type=int, default=20)
+    parser.add_argument(
+        "--request-timeout", type=int, default=5, help="request_timeout of the endpoint in seconds"
+    )
+    parser.add_argument(
+        "--fixed-concurrency",
+        action="store_true",
+        help="disable the adaptive concurrency limiter of the endpoint",
+    )
+    parser.add_argument(
+        "--no-stream-lists",
+        action="store_true",
+        help="decode the guest lists at once instead of parsing them while they are read",
+    )
+    parser.add_argument(
+        "--max-requests-per-second", type=int, default=0, help="request rate ceiling, 0 is unlimited"
+    )
+    parser.add_argument(
+        "--static-heartbeat",
+        type=int,
+        default=0,
+        help="send unchanged static metrics only this often, 0 sends them every cycle",
+    )
+    parser.add_argument(
+        "--backfill-gap",
+        type=int,
+        default=0,
+        help="enable backfill and start from a watermark this many seconds old",
+    )
+    parser.add_argument(
+        "--record", default="", help="write the API answers of the cycles to this capture file"
+    )
+    parser.add_argument("--replay", default="", help="run against this capture file instead of the simulator")
+    parser.add_argument(
+        "--replay-speed",
+        type=float,
+        default=1.0,
+        help="divide the recorded latencies by this factor, 0 answers at once",
+    )
+    parser.add_argument(
+        "--discover-hosts",
+        action="store_true",
+        help="let the extension use the node IPs from cluster/status, combine with --loopback-node-ips",
+    )
+    parser.add_argument("--log-level", default="WARNING", help="log level of the extension under test")
+    parser.add_argument("--timeout", type=float, default=3600, help="seconds a scenario may take")
+    parser.add_argument("--json", action="store_true", help="print the raw results as JSON")
+    parser.add_argument("--verbose", action="store_true", help="list the API calls per path template")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args)
+        return
+
+    rows = []
+    if args.replay:
+        nodes, guests = capture_shape(args.replay)
+        target = ["--replay", args.replay, "--replay-speed", str(args.replay_speed)]
+        for result in run_benchmark_child(args, target, args.replay):
+            rows.append((nodes, guests, result))
+    else:
+        for nodes, guests in parse_scenarios(args.scenarios):
+            for result in run_scenario(args, nodes, guests):
+                rows.append((nodes, guests, result))
+
+    if args.json:
+        report = [{"nodes": nodes, "guests": guests, **result} for nodes, guests, result in rows]
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(rows, args.verbose)
+
+
+if __name__ == "__main__":
+    main()
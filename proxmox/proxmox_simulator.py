@@ -0,0 +1,609 @@
+"""Local Proxmox VE API simulator for development and benchmarking (not production).
+
+Serves the read-only subset of /api2/json the extension collects from, for a synthetic
+cluster of configurable size. Latency, error rate, guest-agent behaviour and unreachable nodes can be tuned so
+collection cycles can be measured end to end without a real cluster:
+
+    python -m proxmox.proxmox_simulator --nodes 10 --guests 500 --latency-ms 20 --error-rate 0.01
+
+Request counters per path template are served as JSON from /_stats, /_reset clears them.
+"""
+
+import argparse
+import json
+import random
+import re
+import ssl
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+API_PREFIX = "/api2/json/"
+
+SERVICES = (
+    "pveproxy",
+    "pvedaemon",
+    "pvestatd",
+    "pve-cluster",
+    "corosync",
+    "pve-ha-lrm",
+    "pve-ha-crm",
+    "chronyd",
+)
+# Name, type and shared flag of the storages every node sees
+STORAGES = (("local", "dir", 0), ("local-lvm", "lvmthin", 0), ("ceph-pool", "rbd", 1))
+
+GIB = 1024**3
+
+
+class SimulatedCluster:
+    """Synthetic cluster state, generated once from a seed so runs are reproducible."""
+
+    def __init__(
+        self,
+        nodes=3,
+        guests=30,
+        lxc_share=0.3,
+        running_share=0.9,
+        agent_missing_share=0.2,
+        agent_timeout_share=0.0,
+        loopback_node_ips=False,
+        offline_nodes=0,
+        hung_nodes=0,
+        seed=1,
+    ):
+        rng = random.Random(seed)
+        # With loopback IPs every node's own API is this simulator, reached on another 127.x address
+        self.loopback_node_ips = loopback_node_ips
+        self.name = "simcluster"
+        self.nodes = [f"pve{index + 1:03d}" for index in range(nodes)]
+        self.guests = {node: {"qemu": [], "lxc": []} for node in self.nodes}
+        # The last nodes are unreachable: offline ones are reported so by cluster/status, hung ones still
+        # look online
+        unreachable = self.nodes[len(self.nodes) - min(nodes, offline_nodes + hung_nodes) :]
+        self.offline = set(unreachable[:offline_nodes])
+        self.hung = set(unreachable[offline_nodes:])
+        self.guest_index = {}
+
+        for index in range(guests):
+            node = self.nodes[index % nodes]
+            guest_type = "lxc" if rng.random() < lxc_share else "qemu"
+            vmid = 100 + index
+            guest = {
+                "vmid": vmid,
+                "name": f"{'ct' if guest_type == 'lxc' else 'vm'}{vmid}",
+                "status": "running" if rng.random() < running_share else "stopped",
+                "cpus": rng.choice((1, 2, 4, 8)),
+                "maxmem": rng.choice((2, 4, 8, 16)) * GIB,
+                "maxdisk": rng.choice((8, 32, 64)) * GIB,
+                "uptime": rng.randint(60, 10**7),
+                "agent": guest_type == "qemu" and rng.random() >= agent_missing_share,
+                "agent_timeout": guest_type == "qemu" and rng.random() < agent_timeout_share,
+                "ip": f"10.{index // 65536 % 256}.{index // 256 % 256}.{index % 256}",
+            }
+            self.guests[node][guest_type].append(guest)
+            self.guest_index[(node, guest_type, str(vmid))] = guest
+
+    def cluster_status(self):
+        entries = [
+            {"type": "cluster", "id": "cluster", "name": self.name, "nodes": len(self.nodes), "quorate": 1}
+        ]
+        for index, node in enumerate(self.nodes):
+            entries.append(
+                {
+                    "type": "node",
+                    "id": f"node/{node}",
+                    "name": node,
+                    "online": int(node not in self.offline),
+                    "local": int(index == 0),
+                    "ip": self.node_ip(index),
+                    "nodeid": index + 1,
+                }
+            )
+        return entries
+
+    def node_ip(self, index):
+        prefix = "127.0" if self.loopback_node_ips else "192.168"
+        return f"{prefix}.{index // 250}.{index % 250 + 1}"
+
+    def ha_status(self):
+        return [{"type": "quorum", "id": "quorum", "quorate": 1, "status": "OK", "node": self.nodes[0]}]
+
+    def node_status(self):
+        # Every node answers alike
+        used = random.randint(8, 48) * GIB
+        return {
+            "cpu": random.random(),
+            "wait": random.random() / 20,
+            "idle": 0,
+            "uptime": 864000,
+            "loadavg": [f"{random.random() * 4:.2f}" for _ in range(3)],
+            "memory": {"total": 64 * GIB, "used": used, "free": 64 * GIB - used},
+            "swap": {"total": 8 * GIB, "used": GIB, "free": 7 * GIB},
+            "rootfs": {"total": 100 * GIB, "used": 20 * GIB, "free": 80 * GIB, "avail": 75 * GIB},
+            "cpuinfo": {"cores": 16, "sockets": 2, "cpus": 32},
+        }
+
+    def node_storage(self):
+        return [
+            {
+                "storage": name,
+                "type": storage_type,
+                "active": 1,
+                "enabled": 1,
+                "shared": shared,
+                "total": 500 * GIB,
+                "used": 100 * GIB,
+                "avail": 400 * GIB,
+                "content": "images,rootdir",
+            }
+            for name, storage_type, shared in STORAGES
+        ]
+
+    def node_guests(self, node, guest_type):
+        # The lists of PVE carry the current counters of every guest as well
+        return [
+            {
+                "vmid": guest["vmid"],
+                "name": guest["name"],
+                "tags": "",
+                **self.guest_counters(guest),
+                "pid": 10000 + guest["vmid"] if guest["status"] == "running" else None,
+            }
+            for guest in self.guests[node][guest_type]
+        ]
+
+    def node_services(self):
+        return [
+            {
+                "service": service,
+                "name": service,
+                "desc": service,
+                "state": "running",
+                "active-state": "active",
+                "unit-state": "enabled",
+            }
+            for service in SERVICES
+        ]
+
+    def guest_counters(self, guest):
+        running = guest["status"] == "running"
+        uptime = guest["uptime"] + int(time.monotonic()) if running else 0
+        return {
+            "status": guest["status"],
+            "cpus": guest["cpus"],
+            "cpu": random.random() if running else 0,
+            "mem": guest["maxmem"] // 2 if running else 0,
+            "maxmem": guest["maxmem"],
+            "disk": guest["maxdisk"] // 4,
+            "maxdisk": guest["maxdisk"],
+            "uptime": uptime,
+            "netin": uptime * 1000,
+            "netout": uptime * 800,
+            "diskread": uptime * 4096,
+            "diskwrite": uptime * 2048,
+        }
+
+    def guest_status(self, node, guest_type, vmid):
+        guest = self.guest_index.get((node, guest_type, vmid))
+        if guest is None:
+            return None
+        status = {"vmid": guest["vmid"], "name": guest["name"], **self.guest_counters(guest)}
+        if guest_type == "qemu":
+            status.update(qmpstatus=guest["status"], balloon=guest["maxmem"], freemem=guest["maxmem"] // 4)
+        else:
+            status.update(swap=0, maxswap=512 * 1024**2)
+        return status
+
+    def rrd_points(self, point):
+        # One averaged point per minute of the last 70 minutes, what PVE returns for timeframe=hour
+        now = int(time.time()) // 60 * 60
+        return [{"time": now - 60 * index, **point()} for index in range(69, -1, -1)]
+
+    def node_rrddata(self):
+        return self.rrd_points(
+            lambda: {
+                "cpu": random.random(),
+                "iowait": random.random() / 20,
+                "loadavg": random.random() * 4,
+                "maxcpu": 32,
+                "memtotal": 64 * GIB,
+                "memused": random.randint(8, 48) * GIB,
+                "swaptotal": 8 * GIB,
+                "swapused": GIB,
+                "roottotal": 100 * GIB,
+                "rootused": 20 * GIB,
+                "netin": random.randint(10**4, 10**6),
+                "netout": random.randint(10**4, 10**6),
+            }
+        )
+
+    def guest_rrddata(self, node, guest_type, vmid):
+        guest = self.guest_index.get((node, guest_type, vmid))
+        if guest is None:
+            return None
+        running = guest["status"] == "running"
+        return self.rrd_points(
+            lambda: {
+                "cpu": random.random() if running else 0,
+                "maxcpu": guest["cpus"],
+                "mem": guest["maxmem"] // 2 if running else 0,
+                "maxmem": guest["maxmem"],
+                "disk": guest["maxdisk"] // 4,
+                "maxdisk": guest["maxdisk"],
+                "netin": 1000 if running else 0,
+                "netout": 800 if running else 0,
+                "diskread": 4096 if running else 0,
+                "diskwrite": 2048 if running else 0,
+            }
+        )
+
+    def cluster_resources(self):
+        resources = []
+        for node in self.nodes:
+            resources.append(
+                {
+                    "type": "node",
+                    "id": f"node/{node}",
+                    "node": node,
+                    "status": "offline" if node in self.offline else "online",
+                }
+            )
+            for name, storage_type, shared in STORAGES:
+                resources.append(
+                    {
+                        "type": "storage",
+                        "id": f"storage/{node}/{name}",
+                        "node": node,
+                        "storage": name,
+                        "plugintype": storage_type,
+                        "shared": shared,
+                        "status": "available",
+                        "maxdisk": 500 * GIB,
+                        "disk": 100 * GIB,
+                    }
+                )
+            for guest_type in ("qemu", "lxc"):
+                for guest in self.guests[node][guest_type]:
+                    counters = self.guest_counters(guest)
+                    counters["maxcpu"] = counters.pop("cpus")
+                    resources.append(
+                        {
+                            "type": guest_type,
+                            "id": f"{guest_type}/{guest['vmid']}",
+                            "node": node,
+                            "vmid": guest["vmid"],
+                            "name": guest["name"],
+                            "template": 0,
+                            **counters,
+                        }
+                    )
+        return resources
+
+
+class SimulatorServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Must be set before the socket listens, the default backlog of 5 makes bursts of new connections
+    # wait for SYN retries
+    request_queue_size = 256
+
+
+# Path templates in matching order, the template name is also the key of the request counters
+ROUTES = (
+    ("cluster/status", re.compile(r"^cluster/status$")),
+    ("cluster/ha/status/current", re.compile(r"^cluster/ha/status/current$")),
+    ("cluster/resources", re.compile(r"^cluster/resources$")),
+    ("version", re.compile(r"^version$")),
+    ("nodes", re.compile(r"^nodes$")),
+    ("nodes/{node}/status", re.compile(r"^nodes/([^/]+)/status$")),
+    ("nodes/{node}/rrddata", re.compile(r"^nodes/([^/]+)/rrddata$")),
+    ("nodes/{node}/storage", re.compile(r"^nodes/([^/]+)/storage$")),
+    ("nodes/{node}/services", re.compile(r"^nodes/([^/]+)/services$")),
+    ("nodes/{node}/{type}", re.compile(r"^nodes/([^/]+)/(qemu|lxc)$")),
+    (
+        "nodes/{node}/{type}/{vmid}/status/current",
+        re.compile(r"^nodes/([^/]+)/(qemu|lxc)/(\d+)/status/current$"),
+    ),
+    ("nodes/{node}/{type}/{vmid}/rrddata", re.compile(r"^nodes/([^/]+)/(qemu|lxc)/(\d+)/rrddata$")),
+    (
+        "nodes/{node}/qemu/{vmid}/agent/network-get-interfaces",
+        re.compile(r"^nodes/([^/]+)/qemu/(\d+)/agent/network-get-interfaces$"),
+    ),
+)
+
+
+def route(path):
+    # Template and match of the first route of an API path, (None, None) when no route matches
+    for template, pattern in ROUTES:
+        match = pattern.match(path)
+        if match is not None:
+            return template, match
+    return None, None
+
+
+class ProxmoxSimulator:
+    """Serves a SimulatedCluster over HTTP(S) with injected latency, errors and agent timeouts."""
+
+    def __init__(
+        self,
+        cluster,
+        latency_ms=0.0,
+        latency_jitter_ms=0.0,
+        error_rate=0.0,
+        agent_timeout=5.0,
+        node_timeout=3.0,
+        capacity=0,
+    ):
+        self.cluster = cluster
+        self.latency_ms = latency_ms
+        self.latency_jitter_ms = latency_jitter_ms
+        self.error_rate = error_rate
+        self.agent_timeout = agent_timeout
+        # How long pveproxy waits for an unreachable node before answering 595
+        self.node_timeout = node_timeout
+        # Requests served at once, beyond that every request is answered with 503, 0 is unlimited
+        self.capacity = capacity
+        self.in_progress = 0
+        self.overloaded = 0
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.addresses = {}
+        self.errors = 0
+        self.server = None
+
+    def count(self, template, address):
+        with self.lock:
+            self.counters[template] = self.counters.get(template, 0) + 1
+            self.addresses[address] = self.addresses.get(address, 0) + 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "requests": sum(self.counters.values()),
+                "errors": self.errors,
+                "overloaded": self.overloaded,
+                "paths": dict(self.counters),
+                "addresses": dict(self.addresses),
+            }
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.addresses = {}
+            self.errors = 0
+            self.overloaded = 0
+
+    def handle(self, path, address=""):
+        # Returns (status, data) for an API path without the /api2/json/ prefix, address is the local
+        # address it came in on
+        template, match = route(path)
+        if match is None:
+            return 501, None
+
+        self.count(template, address)
+        if not self.capacity:
+            return self.serve(template, match.groups())
+        with self.lock:
+            if self.in_progress >= self.capacity:
+                self.overloaded += 1
+                return 503, None
+            self.in_progress += 1
+        try:
+            return self.serve(template, match.groups())
+        finally:
+            with self.lock:
+                self.in_progress -= 1
+
+    def serve(self, template, groups):
+        if self.latency_ms or self.latency_jitter_ms:
+            time.sleep(max(0.0, random.gauss(self.latency_ms, self.latency_jitter_ms)) / 1000)
+        if self.error_rate and random.random() < self.error_rate:
+            with self.lock:
+                self.errors += 1
+            return 500, None
+
+        if groups and groups[0] not in self.cluster.guests:
+            return 500, None
+        if groups and (groups[0] in self.cluster.offline or groups[0] in self.cluster.hung):
+            time.sleep(self.node_timeout)
+            return 595, None  # PVE answers "No route to host" once proxying to the node timed out
+
+        cluster = self.cluster
+        if template == "cluster/status":
+            return 200, cluster.cluster_status()
+        if template == "cluster/ha/status/current":
+            return 200, cluster.ha_status()
+        if template == "cluster/resources":
+            return 200, cluster.cluster_resources()
+        if template == "version":
+            return 200, {"version": "8.2.4", "release": "8.2", "repoid": "simulator"}
+        if template == "nodes":
+            return 200, [{"node": node, "status": "online"} for node in cluster.nodes]
+        if template == "nodes/{node}/status":
+            return 200, cluster.node_status()
+        if template == "nodes/{node}/rrddata":
+            return 200, cluster.node_rrddata()
+        if template == "nodes/{node}/{type}/{vmid}/rrddata":
+            rrd_data = cluster.guest_rrddata(*groups)
+            return (200, rrd_data) if rrd_data is not None else (500, None)
+        if template == "nodes/{node}/storage":
+            return 200, cluster.node_storage()
+        if template == "nodes/{node}/services":
+            return 200, cluster.node_services()
+        if template == "nodes/{node}/{type}":
+            return 200, cluster.node_guests(groups[0], groups[1])
+        if template == "nodes/{node}/{type}/{vmid}/status/current":
+            status = cluster.guest_status(*groups)
+            return (200, status) if status is not None else (500, None)
+
+        guest = cluster.guest_index.get((groups[0], "qemu", groups[1]))
+        if guest is None or guest["status"] != "running" or not guest["agent"]:
+            return 500, None  # PVE answers "QEMU guest agent is not running"
+        if guest["agent_timeout"]:
+            time.sleep(self.agent_timeout)
+            return 500, None  # PVE answers "got timeout"
+        return 200, {
+            "result": [
+                {"name": "lo", "ip-addresses": [{"ip-address": "127.0.0.1", "ip-address-type": "ipv4"}]},
+                {
+                    "name": "eth0",
+                    "ip-addresses": [
+                        {"ip-address": guest["ip"], "ip-address-type": "ipv4"},
+                        {"ip-address": "fe80::1", "ip-address-type": "ipv6"},
+                    ],
+                },
+            ]
+        }
+
+    def handler_class(self):
+        simulator = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive, the extension's pooled sessions re-use their connections
+            protocol_version = "HTTP/1.1"
+            # Headers and body go out in one segment, otherwise delayed ACKs stall every keep-alive request
+            wbufsize = 64 * 1024
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                path = self.path.split("?", 1)[0]
+                if path == "/_stats":
+                    self.respond(200, simulator.stats())
+                elif path == "/_reset":
+                    simulator.reset()
+                    self.respond(200, {})
+                elif path.startswith(API_PREFIX):
+                    address = self.connection.getsockname()[0]
+                    status, data = simulator.handle(path[len(API_PREFIX) :].strip("/"), address)
+                    self.respond(status, {"data": data})
+                else:
+                    self.respond(404, {"data": None})
+
+            def respond(self, status, body):
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json;charset=UTF-8")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def start(self, host="127.0.0.1", port=0, certfile=None, keyfile=None):
+        # Serves on a background thread, port 0 picks a free port, the bound port is returned
+        server = SimulatorServer((host, port), self.handler_class())
+        if certfile:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(certfile, keyfile)
+            server.socket = context.wrap_socket(server.socket, server_side=True)
+        self.server = server
+        threading.Thread(target=server.serve_forever, name="proxmox-simulator", daemon=True).start()
+        return server.server_address[1]
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+def add_simulator_arguments(parser):
+    parser.add_argument("--nodes", type=int, default=3)
+    parser.add_argument(
+        "--guests", type=int, default=30, help="VMs and containers in total, spread over the nodes"
+    )
+    parser.add_argument(
+        "--lxc-share", type=float, default=0.3, help="share of the guests which are containers"
+    )
+    parser.add_argument("--running-share", type=float, default=0.9)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="mean latency added to every API call")
+    parser.add_argument("--latency-jitter-ms", type=float, default=0.0)
+    parser.add_argument(
+        "--error-rate", type=float, default=0.0, help="share of API calls answered with HTTP 500"
+    )
+    parser.add_argument(
+        "--agent-missing-share", type=float, default=0.2, help="share of VMs without a guest agent"
+    )
+    parser.add_argument(
+        "--agent-timeout-share",
+        type=float,
+        default=0.0,
+        help="share of VMs whose agent call hangs for --agent-timeout seconds",
+    )
+    parser.add_argument("--agent-timeout", type=float, default=5.0)
+    parser.add_argument(
+        "--offline-nodes", type=int, default=0, help="nodes reported offline, their requests hang"
+    )
+    parser.add_argument("--hung-nodes", type=int, default=0, help="nodes reported online whose requests hang")
+    parser.add_argument(
+        "--node-timeout",
+        type=float,
+        default=3.0,
+        help="seconds a request to an offline or hung node takes before it is answered with 595",
+    )
+    parser.add_argument(
+        "--capacity",
+        type=int,
+        default=0,
+        help="requests served at once, further concurrent requests are answered with 503",
+    )
+    parser.add_argument(
+        "--loopback-node-ips",
+        action="store_true",
+        help="report 127.0.x.y node IPs in cluster/status, so per-node API hosts can be tested locally",
+    )
+    parser.add_argument("--seed", type=int, default=1)
+
+
+def build_simulator(args):
+    cluster = SimulatedCluster(
+        nodes=args.nodes,
+        guests=args.guests,
+        lxc_share=args.lxc_share,
+        running_share=args.running_share,
+        agent_missing_share=args.agent_missing_share,
+        agent_timeout_share=args.agent_timeout_share,
+        loopback_node_ips=args.loopback_node_ips,
+        offline_nodes=args.offline_nodes,
+        hung_nodes=args.hung_nodes,
+        seed=args.seed,
+    )
+    return ProxmoxSimulator(
+        cluster,
+        latency_ms=args.latency_ms,
+        latency_jitter_ms=args.latency_jitter_ms,
+        error_rate=args.error_rate,
+        agent_timeout=args.agent_timeout,
+        node_timeout=args.node_timeout,
+        capacity=args.capacity,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local Proxmox VE API simulator")
+    add_simulator_arguments(parser)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8006)
+    parser.add_argument("--certfile", help="serve HTTPS with this certificate, like a real PVE node")
+    parser.add_argument("--keyfile")
+    args = parser.parse_args()
+
+    simulator = build_simulator(args)
+    port = simulator.start(args.host, args.port, args.certfile, args.keyfile)
+    scheme = "https" if args.certfile else "http"
+    print(
+        f"Proxmox simulator for {args.nodes} nodes and {args.guests} guests listening on "
+        f"{scheme}://{args.host}:{port}{API_PREFIX}",
+        flush=True,
+    )
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        simulator.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+import logging
+import threading
+import time
+from array import array
+
+default_logger = logging.getLogger(__name__)
+default_logger.setLevel(logging.INFO)
+
+NAN = float("nan")
+
+
+class RateStore:
+    """Turns the cumulative guest counters of one endpoint into per-second rates.
+
+    Every guest owns one slot in flat arrays: `width` previous counter values, the time of that
+    sample, the guest's uptime and the cycle it was last seen in. A guest therefore costs a few
+    dozen bytes and no per-sample objects. The first sample of a guest only sets its baseline. A
+    reset (a counter went backwards, the uptime went backwards or the guest moved to another node)
+    also only sets a new baseline, so no negative or inflated rate is emitted. Slots of guests not
+    seen for idle_cycles cycles are reused, and beyond max_guests the stalest slot is taken over.
+    """
+
+    def __init__(
+        self, width=4, max_guests=10000, idle_cycles=3, min_interval=1.0, emit_raw=True, logger=default_logger
+    ):
+        self.width = width
+        self.max_guests = max_guests
+        self.idle_cycles = idle_cycles
+        self.min_interval = min_interval  # Samples closer together than this keep the older baseline
+        self.emit_raw = emit_raw  # False when only the rates replace the raw counters
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.slots = {}  # guest key -> slot
+        self.free = []
+        self.values = array("d")
+        self.times = array("d")
+        self.uptimes = array("d")
+        self.seen = array("q")
+        self.nodes = []
+        self.cycle = 0
+        self.resets = 0
+        self.evictions = 0
+
+    def start_cycle(self):
+        with self.lock:
+            self.cycle += 1
+            idle = [
+                key for key, slot in self.slots.items() if self.cycle - self.seen[slot] > self.idle_cycles
+            ]
+            for key in idle:
+                self.release(key)
+
+    def release(self, key):
+        # Must be called with the lock held
+        slot = self.slots.pop(key)
+        self.nodes[slot] = None
+        self.free.append(slot)
+
+    def allocate(self, key):
+        # Must be called with the lock held
+        if self.free:
+            slot = self.free.pop()
+        elif len(self.slots) < self.max_guests:
+            slot = len(self.times)
+            self.values.extend([NAN] * self.width)
+            self.times.append(0.0)
+            self.uptimes.append(NAN)
+            self.seen.append(0)
+            self.nodes.append(None)
+        else:
+            stalest = min(self.slots, key=lambda guest: self.seen[self.slots[guest]])
+            self.release(stalest)
+            self.evictions += 1
+            slot = self.free.pop()
+        self.slots[key] = slot
+        return slot
+
+    def sample(self, key, node, uptime, counters):
+        # Returns the per-second rate of every counter (None where unknown), or None for a baseline sample
+        now = time.monotonic()
+        with self.lock:
+            slot = self.slots.get(key)
+            new = slot is None
+            if new:
+                slot = self.allocate(key)
+            base = slot * self.width
+            elapsed = now - self.times[slot]
+
+            rates = None
+            if not new:
+                if elapsed < self.min_interval:
+                    self.seen[slot] = self.cycle
+                    return None
+                reset = self.nodes[slot] != node or (uptime is not None and uptime < self.uptimes[slot])
+                rates = []
+                for index, value in enumerate(counters):
+                    previous = self.values[base + index]
+                    if value is None or previous != previous:  # NaN, no previous value
+                        rates.append(None)
+                    elif value < previous:
+                        reset = True
+                    else:
+                        rates.append((value - previous) / elapsed)
+                if reset:
+                    self.resets += 1
+                    rates = None
+
+            for index, value in enumerate(counters):
+                self.values[base + index] = NAN if value is None else value
+            self.times[slot] = now
+            self.uptimes[slot] = NAN if uptime is None else uptime
+            self.seen[slot] = self.cycle
+            self.nodes[slot] = node
+            return rates
+
+    def emit(self, batch, key, node, data: dict, table):
+        # Adds the rate metrics of `table` (rows of counter field and rate key) for one guest
+        counters = [get(data) for get, _, _ in table.compiled]
+        rates = self.sample(key, node, data.get("uptime"), counters)
+        if rates is None:
+            return
+        for (_, rate_key, _), rate in zip(table.compiled, rates, strict=True):
+            if rate is not None:
+                batch.add(rate_key, round(rate, 3))
+
+    def stats(self):
+        with self.lock:
+            return {
+                "guests": len(self.slots),
+                "slots": len(self.times),
+                "resets": self.resets,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,381 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+default_logger = logging.getLogger(__name__)
+default_logger.setLevel(logging.INFO)
+
+# The TaskGraph task running on the current worker thread, tasks it submits join its graph
+running = threading.local()
+
+
+class CollectionScheduler:
+    """Runs collection tasks on one shared thread pool with a concurrency budget per endpoint.
+
+    The pool size is the global cap. Each endpoint may only have `budget` tasks handed to the
+    pool at a time, the rest wait in the endpoint's own queue. A cluster with thousands of
+    guests therefore cannot occupy every worker and starve the other endpoints.
+    """
+
+    def __init__(self, max_workers=10, logger=default_logger):
+        self.logger = logger
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="proxmox-collect")
+        self.lock = threading.Lock()
+        self.budgets = {}
+        self.queues = {}
+        self.in_flight = {}
+        self.idle_callbacks = {}
+        self.task_callbacks = {}
+
+    def register(self, key, budget, on_idle=None, on_task=None):
+        # on_idle is called, outside the lock, whenever the endpoint has no queued or running task left
+        # on_task(name, duration, failed) is called after every task of the endpoint
+        with self.lock:
+            self.budgets[key] = max(1, min(budget, self.max_workers))
+            self.queues.setdefault(key, deque())
+            self.in_flight.setdefault(key, 0)
+            if on_idle is not None:
+                self.idle_callbacks[key] = on_idle
+            if on_task is not None:
+                self.task_callbacks[key] = on_task
+
+    def submit(self, key, fn, *args):
+        # Submitted from inside a task of a TaskGraph, the new task joins that graph as started by the
+        # running task
+        task = getattr(running, "task", None)
+        if task is not None and task.graph.key == key and not isinstance(fn, GraphTask):
+            task.graph.add(fn, *args, cause=task)
+            return
+        with self.lock:
+            if key not in self.budgets:
+                raise KeyError(f"Endpoint {key} was not registered with the scheduler")
+            self.queues[key].append((fn, args))
+            self.dispatch(key)
+
+    def dispatch(self, key):
+        # Must be called with the lock held
+        queue = self.queues[key]
+        while queue and self.in_flight[key] < self.budgets[key]:
+            fn, args = queue.popleft()
+            self.in_flight[key] += 1
+            self.executor.submit(self.run, key, fn, args)
+
+    def run(self, key, fn, args):
+        start = time.perf_counter()
+        failed = False
+        try:
+            fn(*args)
+        except Exception as e:
+            failed = True
+            self.logger.exception(f"Collection task {fn.__name__} failed for {key}: {e!r}")
+        finally:
+            on_task = self.task_callbacks.get(key)
+            if on_task is not None:
+                on_task(fn.__name__, time.perf_counter() - start, failed)
+            with self.lock:
+                self.in_flight[key] -= 1
+                self.dispatch(key)
+                idle = self.in_flight[key] == 0 and not self.queues[key]
+                on_idle = self.idle_callbacks.get(key)
+            if idle and on_idle is not None:
+                on_idle()
+
+    def unregister(self, key):
+        # Only for a key without queued or running tasks, such as a worker's shard once it is answered
+        with self.lock:
+            for table in (
+                self.budgets,
+                self.queues,
+                self.in_flight,
+                self.idle_callbacks,
+                self.task_callbacks,
+            ):
+                table.pop(key, None)
+
+    def pending(self, key):
+        with self.lock:
+            return len(self.queues.get(key, ())) + self.in_flight.get(key, 0)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+# Cycle guard decisions
+CYCLE_RUN = "RUN"
+CYCLE_SKIP = "SKIP"
+CYCLE_SHED = "SHED"
+
+# Overrun policies selectable per endpoint
+OVERRUN_SKIP = "SKIP"
+OVERRUN_COALESCE = "COALESCE"
+OVERRUN_SHED = "SHED"
+
+
+class CycleGuard:
+    """Tracks the cycle of one endpoint and decides what a new cycle does while the last one still runs.
+
+    A cycle starts with begin() and is complete once submissions are done (end_submission)
+    and the scheduler reports the endpoint idle. With SKIP an overlapping cycle is dropped,
+    with COALESCE all overlapping cycles collapse into one that runs as soon as the current
+    cycle completes, and with SHED the overlapping cycle runs without its low-priority domains.
+    The TaskGraphs added while a cycle runs, a shed cycle's included, are handed to
+    on_complete(endpoint, duration, graphs) with it.
+    """
+
+    def __init__(
+        self,
+        endpoint,
+        scheduler,
+        policy=OVERRUN_SKIP,
+        on_complete=None,
+        on_coalesced=None,
+        logger=default_logger,
+    ):
+        self.endpoint = endpoint
+        self.scheduler = scheduler
+        self.policy = policy
+        self.on_complete = on_complete
+        self.on_coalesced = on_coalesced
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.running = False
+        self.submitting = False
+        self.coalesced = False
+        self.start = 0.0
+        self.overruns = 0
+        self.last_duration = None
+        self.graphs = []
+
+    def begin(self):
+        with self.lock:
+            if not self.running:
+                self.running = True
+                self.submitting = True
+                self.start = time.perf_counter()
+                return CYCLE_RUN
+
+            self.overruns += 1
+            elapsed = time.perf_counter() - self.start
+            self.logger.warning(
+                f"Previous cycle for {self.endpoint} still running after {elapsed:.1f}s, "
+                f"{self.scheduler.pending(self.endpoint)} tasks pending, applying policy {self.policy}"
+            )
+            if self.policy == OVERRUN_SHED:
+                self.submitting = True
+                return CYCLE_SHED
+            if self.policy == OVERRUN_COALESCE:
+                self.coalesced = True
+            return CYCLE_SKIP
+
+    def add_graph(self, graph):
+        # Called between begin() and end_submission(), the cycle cannot complete before it is added
+        with self.lock:
+            self.graphs.append(graph)
+
+    def end_submission(self):
+        with self.lock:
+            self.submitting = False
+        if self.scheduler.pending(self.endpoint) == 0:
+            self.on_idle()
+
+    def on_idle(self):
+        with self.lock:
+            if not self.running or self.submitting:
+                return
+            self.running = False
+            self.last_duration = time.perf_counter() - self.start
+            coalesced = self.coalesced
+            self.coalesced = False
+            graphs, self.graphs = self.graphs, []
+
+        self.logger.info(f"Cycle for {self.endpoint} completed in {self.last_duration:.3f}s")
+        if self.on_complete is not None:
+            self.on_complete(self.endpoint, self.last_duration, graphs)
+        if coalesced and self.on_coalesced is not None:
+            self.logger.info(f"Running coalesced cycle for {self.endpoint}")
+            self.on_coalesced(self.endpoint)
+
+
+class GraphTask:
+    """One step of a TaskGraph, handed to the scheduler once every task it runs after has completed."""
+
+    __slots__ = (
+        "graph",
+        "fn",
+        "args",
+        "label",
+        "__name__",
+        "after",
+        "waiting",
+        "dependents",
+        "result",
+        "failed",
+        "skipped",
+        "cause",
+        "ready",
+        "started",
+        "ended",
+        "done",
+    )
+
+    def __init__(self, graph, fn, args, after, label=None, cause=None):
+        self.graph = graph
+        self.fn = fn
+        self.args = args
+        self.__name__ = fn.__name__  # The scheduler and the instrumentation know the task by its function
+        # The node a collector works on is part of its label, when one of its arguments is a node
+        node = next((arg.name for arg in args if isinstance(getattr(arg, "name", None), str)), None)
+        self.label = label or (f"{fn.__name__}({node})" if node else fn.__name__)
+        self.after = after
+        self.waiting = 0
+        self.dependents = []
+        self.result = None
+        self.failed = False
+        self.skipped = False
+        self.cause = cause  # The task this one waited for last, or that submitted it
+        self.ready = self.started = self.ended = None
+        self.done = threading.Event()
+
+    def __call__(self):
+        # The results of the tasks it runs after are passed after its own arguments
+        previous = getattr(running, "task", None)
+        running.task = self
+        self.started = time.perf_counter()
+        try:
+            self.result = self.fn(*self.args, *(task.result for task in self.after))
+        except Exception:
+            self.failed = True
+            raise
+        finally:
+            self.ended = time.perf_counter()
+            running.task = previous
+            self.args = None
+            self.graph.complete(self)
+
+    def __repr__(self):
+        return f"GraphTask({self.label})"
+
+
+class TaskGraph:
+    """The requests and processing steps of one collection cycle, with the tasks each of them needs first.
+
+    A task is handed to the scheduler as soon as the tasks it runs after have completed, so
+    independent requests of the cycle overlap instead of running one stage after the other.
+    Tasks a graph task submits to the scheduler join the graph as started by it, this is how
+    a guest list fans out into its per-guest requests. A task whose inputs failed is skipped.
+
+    Dependents are handed to the scheduler before the completed task gives its slot back, so
+    the endpoint is never idle while the graph still has tasks waiting. critical_path() follows
+    the chain of tasks that kept the last task of the cycle from completing earlier.
+
+    `timeout` bounds how long run_inline() waits for the inputs of its step, counted from the
+    start of the graph. A step whose inputs are not done by then is skipped like one whose
+    inputs failed, so a stuck request cannot hold the monitor callback beyond its cycle.
+    """
+
+    def __init__(self, scheduler, key, timeout=None, logger=default_logger):
+        self.scheduler = scheduler
+        self.key = key
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.tasks = []
+        self.start = time.perf_counter()
+        self.deadline = None if timeout is None else self.start + timeout
+
+    def add(self, fn, *args, after=(), label=None, cause=None):
+        task = GraphTask(self, fn, args, tuple(after), label, cause)
+        with self.lock:
+            self.tasks.append(task)
+            for dependency in task.after:
+                if not dependency.done.is_set():
+                    dependency.dependents.append(task)
+                    task.waiting += 1
+        if not task.waiting:
+            self.release(task)
+        return task
+
+    def run_inline(self, fn, *args, after=(), label=None):
+        # Runs fn on the calling thread once its inputs are ready, for a step that blocks like the
+        # asyncio engine
+        task = GraphTask(self, fn, args, tuple(after), label)
+        with self.lock:
+            self.tasks.append(task)
+        for dependency in task.after:
+            timeout = None if self.deadline is None else max(0.0, self.deadline - time.perf_counter())
+            if not dependency.done.wait(timeout):
+                pending = [dependency.label for dependency in task.after if not dependency.done.is_set()]
+                self.logger.error(
+                    f"Skipping {task.label} for {self.key}, its inputs {pending} did not complete within "
+                    f"{self.deadline - self.start:.0f}s"
+                )
+                self.skip(task)
+                return task
+        if self.prepare(task):
+            task()
+        return task
+
+    def prepare(self, task):
+        # False when an input failed, the task is then skipped and counts as done
+        task.ready = time.perf_counter()
+        if task.after:
+            task.cause = max(task.after, key=lambda dependency: dependency.ended)
+        failed = [dependency.label for dependency in task.after if dependency.failed or dependency.skipped]
+        if failed:
+            self.logger.warning(f"Skipping {task.label} for {self.key}, its inputs {failed} failed")
+            self.skip(task)
+            return False
+        return True
+
+    def skip(self, task):
+        # The task counts as done without running, its dependents are skipped in turn
+        task.ready = task.ready or time.perf_counter()
+        task.skipped = True
+        task.started = task.ended = task.ready
+        task.args = None
+        self.complete(task)
+
+    def release(self, task):
+        if self.prepare(task):
+            self.scheduler.submit(self.key, task)
+
+    def complete(self, task):
+        ready = []
+        with self.lock:
+            task.done.set()
+            for dependent in task.dependents:
+                dependent.waiting -= 1
+                if not dependent.waiting:
+                    ready.append(dependent)
+            task.dependents = []
+        for dependent in ready:
+            self.release(dependent)
+
+    def critical_path(self):
+        # The chain of causes of the task that ended last, with the total time tasks of the chain waited
+        # for a worker
+        with self.lock:
+            ended = [task for task in self.tasks if task.ended is not None]
+        if not ended:
+            return [], 0.0, 0.0
+        task = max(ended, key=lambda candidate: candidate.ended)
+        path = []
+        while task is not None:
+            path.append(task)
+            task = task.cause
+        path.reverse()
+        queued = sum(task.started - task.ready for task in path)
+        return path, path[-1].ended - self.start, queued
+
+    def describe_path(self, path):
+        return " -> ".join(self.describe_task(task) for task in path)
+
+    @staticmethod
+    def describe_task(task):
+        queued = task.started - task.ready
+        description = f"{task.label} {(task.ended - task.started) * 1000:.0f}ms"
+        if queued >= 0.001:
+            description += f" (+{queued * 1000:.0f}ms queued)"
+        return description
@@ -0,0 +1,149 @@
+import logging
+import threading
+
+from .metric_sink import format_dimensions
+
+default_logger = logging.getLogger(__name__)
+default_logger.setLevel(logging.INFO)
+
+# Storage types shared by design, for storage entries that carry no shared flag (cluster/resources of
+# older releases)
+SHARED_STORAGE_TYPES = frozenset(
+    ("rbd", "cephfs", "nfs", "cifs", "glusterfs", "iscsi", "iscsidirect", "zfs", "pbs")
+)
+
+
+def is_shared_storage(entry: dict, storage_type):
+    # nodes/{node}/storage flags shared storages, otherwise the storage type decides
+    shared = entry.get("shared")
+    if shared is not None:
+        return shared == 1
+    return storage_type in SHARED_STORAGE_TYPES
+
+
+class SharedStorageClaims:
+    """Shared storages already reported in this cycle, each is claimed by the first node that reports it."""
+
+    __slots__ = ("lock", "claimed")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.claimed = set()
+
+    def claim(self, storage_name):
+        # True only for the first caller of the cycle, every other node leaves the storage out
+        with self.lock:
+            if storage_name in self.claimed:
+                return False
+            self.claimed.add(storage_name)
+            return True
+
+
+class ClusterRecord:
+    """The cluster as cluster/status reported it in this cycle."""
+
+    __slots__ = (
+        "name",
+        "id",
+        "nodes_count",
+        "online_count",
+        "sdn_status",
+        "dimensions",
+        "dimension_string",
+        "shared_storages",
+    )
+
+    def __init__(self, name, cluster_id, nodes_count, online_count, sdn_status, shared_storages=None):
+        self.name = name
+        self.id = cluster_id
+        self.nodes_count = nodes_count
+        self.online_count = online_count
+        self.sdn_status = sdn_status
+        self.dimensions = {"cluster": name, "clusterid": cluster_id}
+        self.dimension_string = format_dimensions(self.dimensions)
+        # None when every node reports its shared storages itself
+        self.shared_storages = shared_storages
+
+
+class NodeRecord:
+    """One node of the cycle with the dimension strings all metrics of the node start with."""
+
+    __slots__ = (
+        "cluster",
+        "name",
+        "id",
+        "ip",
+        "online",
+        "request",
+        "dimension_string",
+        "status_dimension_string",
+    )
+
+    def __init__(self, cluster, name, node_id, ip, online):
+        self.cluster = cluster
+        self.name = name
+        self.id = node_id
+        self.ip = ip
+        self.online = online
+        self.request = f"nodes/{name}"  # Prefix of every request for the node
+        # Only the node metrics themselves carry the node IP, storage, service and guest metrics name and id
+        self.dimension_string = cluster.dimension_string + format_dimensions(
+            {"node": name, "nodeid": node_id}
+        )
+        self.status_dimension_string = cluster.dimension_string + format_dimensions(
+            {"node": name, "nodeip": ip, "nodeid": node_id}
+        )
+
+    def __repr__(self):
+        return f"NodeRecord({self.name})"
+
+
+class CycleSnapshot:
+    """Cluster and nodes of one cycle, built once from cluster/status.
+
+    The records are shared read-only by every collector of the cycle, on the scheduler's
+    threads and on the asyncio engine alike. Their MINT dimension strings are formatted here
+    once, the batches of a node's storages, services and guests only append their own. The
+    shared storage claims are the one part the collectors write to, behind their own lock.
+    """
+
+    __slots__ = ("cluster", "nodes")
+
+    def __init__(self, cluster, nodes):
+        self.cluster = cluster
+        self.nodes = nodes
+
+    @classmethod
+    def from_cluster_status(cls, cluster_status, logger=default_logger, shared_storage_once=False):
+        cluster_entry = {}
+        node_entries = []
+        sdn_status = 1
+
+        if isinstance(cluster_status, list):
+            for item in cluster_status:
+                if not isinstance(item, dict):
+                    logger.error(f"Unexpected item type: {type(item)} - {item}")
+                    continue
+                item_type = item.get("type")
+                if item_type == "cluster":
+                    cluster_entry = item
+                elif item_type == "node":
+                    node_entries.append(item)
+                elif item_type == "sdn" and item.get("status") != "ok":
+                    sdn_status = 0
+        else:
+            logger.error("cluster_status is not a list. Check the source of the data.")
+
+        cluster = ClusterRecord(
+            cluster_entry.get("name"),
+            cluster_entry.get("id"),
+            cluster_entry.get("nodes"),
+            sum(1 for entry in node_entries if entry.get("online") == 1),
+            sdn_status,
+            SharedStorageClaims() if shared_storage_once else None,
+        )
+        nodes = tuple(
+            NodeRecord(cluster, entry.get("name"), entry.get("id"), entry.get("ip"), entry.get("online"))
+            for entry in node_entries
+        )
+        return cls(cluster, nodes)
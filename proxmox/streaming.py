@@ -0,0 +1,171 @@
+import codecs
+import json
+
+# Bytes read from a streamed response at a time
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Parser states, from the opening brace of the response object to its closing one
+EXPECT_OBJECT = 0
+EXPECT_KEY = 1
+EXPECT_VALUE = 2
+EXPECT_FIRST_ENTRY = 3
+EXPECT_ENTRY = 4
+EXPECT_ENTRY_SEPARATOR = 5
+EXPECT_MEMBER_SEPARATOR = 6
+COMPLETE = 7
+
+WHITESPACE = " \t\n\r"
+# Characters that may follow a complete value
+FOLLOWING = WHITESPACE + ",:]}"
+
+
+class DataListParser:
+    """Incremental parser of a {"data": [...]} API response, hands out the list entries as they complete.
+
+    feed() takes the body in chunks of bytes as they arrive and returns the entries completed
+    by the chunk, so at most one chunk and one entry are held besides the entries the caller
+    keeps. Members of the response other than "data" are decoded and dropped. When "data" is
+    not a list, no entry is returned and `unexpected` names its type. A body that is not valid
+    JSON raises ValueError, from feed() or at the latest from close().
+    """
+
+    def __init__(self):
+        self.decoder = json.JSONDecoder()
+        self.text = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.position = 0
+        self.state = EXPECT_OBJECT
+        self.key = None
+        self.unexpected = None
+        self.entries = 0
+
+    def feed(self, chunk: bytes):
+        self.buffer = self.buffer[self.position :] + self.text.decode(chunk)
+        self.position = 0
+        return self.parse(final=False)
+
+    def close(self):
+        self.buffer = self.buffer[self.position :] + self.text.decode(b"", final=True)
+        self.position = 0
+        entries = self.parse(final=True)
+        if self.state != COMPLETE:
+            raise ValueError(f"Response ended before its end, {self.entries} entries were read")
+        return entries
+
+    def skip_whitespace(self):
+        buffer = self.buffer
+        position = self.position
+        while position < len(buffer) and buffer[position] in WHITESPACE:
+            position += 1
+        self.position = position
+        return buffer[position] if position < len(buffer) else None
+
+    def decode_value(self, final):
+        # The value at the current position, or (None, False) when it may continue in the next chunk
+        try:
+            value, end = self.decoder.raw_decode(self.buffer, self.position)
+        except json.JSONDecodeError:
+            if final:
+                raise
+            return None, False
+        # A number cut by the chunk ("3." of "3.5") decodes as well, only a value followed by what may
+        # follow it is complete
+        if not final and (end == len(self.buffer) or self.buffer[end] not in FOLLOWING):
+            return None, False
+        self.position = end
+        return value, True
+
+    def expect(self, character, expected):
+        if character not in expected:
+            raise ValueError(f"Expected one of {expected!r} at {self.position}, got {character!r}")
+        self.position += 1
+
+    def parse_entries(self, entries, final):
+        # Hot loop over the entries of the list and their separators, False when the next entry is not
+        # complete yet
+        buffer = self.buffer
+        length = len(buffer)
+        position = self.position
+        decode = self.decoder.raw_decode
+        try:
+            while buffer[position] not in WHITESPACE:
+                try:
+                    entry, end = decode(buffer, position)
+                except json.JSONDecodeError:
+                    if final:
+                        raise
+                    return False
+                following = buffer[end] if end < length else None
+                if following == ",":
+                    position = end + 1
+                elif following == "]":
+                    position = end + 1
+                    self.state = EXPECT_MEMBER_SEPARATOR
+                elif final if following is None else following in FOLLOWING:
+                    # Whitespace after the entry, the separator is left to parse()
+                    position = end
+                    self.state = EXPECT_ENTRY_SEPARATOR
+                else:
+                    # Cut by the chunk, or a number that may go on in the next one
+                    return False
+                entries.append(entry)
+                self.entries += 1
+                if self.state != EXPECT_ENTRY or position >= length:
+                    return True
+        finally:
+            self.position = position
+        return True
+
+    def parse(self, final):
+        entries = []
+        while True:
+            character = self.skip_whitespace()
+            if character is None or self.state == COMPLETE:
+                if character is not None:
+                    raise ValueError(f"Unexpected data after the end of the response at {self.position}")
+                return entries
+
+            if self.state == EXPECT_OBJECT:
+                self.expect(character, "{")
+                self.state = EXPECT_KEY
+            elif self.state == EXPECT_KEY:
+                if character == "}":
+                    self.position += 1
+                    self.state = COMPLETE
+                    continue
+                start = self.position
+                key, complete = self.decode_value(final)
+                if not complete:
+                    return entries
+                self.key = key
+                if self.skip_whitespace() is None:
+                    # Its colon has not arrived yet, the key is decoded again with the next chunk
+                    self.position = start
+                    return entries
+                self.expect(self.buffer[self.position], ":")
+                self.state = EXPECT_VALUE
+            elif self.state == EXPECT_VALUE:
+                if self.key == "data" and character == "[":
+                    self.position += 1
+                    self.state = EXPECT_FIRST_ENTRY
+                    continue
+                value, complete = self.decode_value(final)
+                if not complete:
+                    return entries
+                if self.key == "data":
+                    self.unexpected = type(value).__name__
+                self.state = EXPECT_MEMBER_SEPARATOR
+            elif self.state == EXPECT_FIRST_ENTRY and character == "]":
+                self.position += 1
+                self.state = EXPECT_MEMBER_SEPARATOR
+            elif self.state == EXPECT_FIRST_ENTRY:
+                self.state = EXPECT_ENTRY
+            elif self.state == EXPECT_ENTRY:
+                if not self.parse_entries(entries, final):
+                    return entries
+            elif self.state == EXPECT_ENTRY_SEPARATOR:
+                self.expect(character, ",]")
+                self.state = EXPECT_ENTRY if character == "," else EXPECT_MEMBER_SEPARATOR
+            elif self.state == EXPECT_MEMBER_SEPARATOR:
+                self.expect(character, ",}")
+                self.state = EXPECT_KEY if character == "," else COMPLETE
@@ -25,6 +25,6 @@ setup(
     packages=find_packages(),
     python_requires=">=3.10",
     include_package_data=True,
-    install_requires=["dt-extensions-sdk", "proxmoxer", "requests"],
+    install_requires=["dt-extensions-sdk", "proxmoxer", "requests", "aiohttp>=3.10"],
     extras_require={"dev": ["dt-extensions-sdk[cli]"]},
 )
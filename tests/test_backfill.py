@@ -0,0 +1,102 @@
+import json
+
+from proxmox.backfill import MAX_BACKFILL_GAP, Backfill, WatermarkStore
+from proxmox.metric_sink import MetricSink
+
+FREQUENCY = 60
+KEY = "https://pve1:8006"
+
+
+class Reporter:
+    def __init__(self):
+        self.lines = []
+
+    def report_mint_lines(self, lines):
+        self.lines.extend(lines)
+
+
+def rrd_points(start, end):
+    # nodes/{node}/rrddata, one averaged point per minute
+    return [{"time": second, "loadavg": 0.5} for second in range(start, end + 1, 60)]
+
+
+def test_watermarks_survive_a_restart(tmp_path):
+    path = tmp_path / "watermarks.json"
+    store = WatermarkStore(str(path))
+    assert store.get(KEY) is None
+    store.advance(KEY, 1_000_000)
+    assert WatermarkStore(str(path)).get(KEY) == 1_000_000
+    assert not (tmp_path / "watermarks.json.tmp").exists()
+
+
+def test_a_watermark_only_moves_forward(tmp_path):
+    path = tmp_path / "watermarks.json"
+    store = WatermarkStore(str(path))
+    store.advance(KEY, 2_000_000)
+    store.advance(KEY, 1_000_000)
+    assert store.get(KEY) == 2_000_000
+    assert json.loads(path.read_text()) == {KEY: 2_000_000}
+
+
+def test_an_unreadable_state_file_starts_without_watermarks(tmp_path):
+    path = tmp_path / "watermarks.json"
+    path.write_text("{not json")
+    assert WatermarkStore(str(path)).watermarks == {}
+    path.write_text(json.dumps({KEY: 1_000_000, "other": "late"}))
+    assert WatermarkStore(str(path)).watermarks == {KEY: 1_000_000}
+
+
+def test_cycles_on_time_open_no_window(tmp_path):
+    backfill = Backfill(WatermarkStore(str(tmp_path / "watermarks.json")), KEY, FREQUENCY)
+    assert backfill.start_cycle(1_000_000_000) is None
+    backfill.complete_cycle()
+    assert backfill.start_cycle(1_000_060_000) is None
+    backfill.complete_cycle()
+    assert backfill.stats() == {"gaps": 0, "points": 0, "watermark": 1_000_060_000}
+
+
+def test_a_gap_opens_a_window_up_to_half_a_cycle_ago(tmp_path):
+    store = WatermarkStore(str(tmp_path / "watermarks.json"))
+    store.advance(KEY, 1_000_000_000)
+    backfill = Backfill(store, KEY, FREQUENCY)
+    assert backfill.start_cycle(1_000_600_000) == (1_000_000, 1_000_570)
+
+    # An overlapping cycle does not replay the window again
+    assert backfill.start_cycle(1_000_660_000) == (1_000_570, 1_000_630)
+
+
+def test_a_gap_longer_than_max_gap_is_cut_to_its_end(tmp_path):
+    store = WatermarkStore(str(tmp_path / "watermarks.json"))
+    store.advance(KEY, 1_000_000_000)
+    backfill = Backfill(store, KEY, FREQUENCY, max_gap=600)
+    assert backfill.start_cycle(1_007_200_000) == (1_006_600, 1_007_170)
+    assert Backfill(store, KEY, FREQUENCY, max_gap=10 * MAX_BACKFILL_GAP).max_gap == MAX_BACKFILL_GAP
+
+
+def test_the_watermark_advances_only_when_the_cycle_completes(tmp_path):
+    store = WatermarkStore(str(tmp_path / "watermarks.json"))
+    store.advance(KEY, 1_000_000_000)
+    backfill = Backfill(store, KEY, FREQUENCY)
+    backfill.start_cycle(1_000_600_000)
+    assert store.get(KEY) == 1_000_000_000
+    backfill.complete_cycle()
+    assert store.get(KEY) == 1_000_600_000
+    backfill.complete_cycle()
+    assert store.get(KEY) == 1_000_600_000
+
+
+def test_emit_sends_the_points_inside_the_window_with_their_own_timestamps(tmp_path):
+    store = WatermarkStore(str(tmp_path / "watermarks.json"))
+    store.advance(KEY, 1_000_020_000)
+    backfill = Backfill(store, KEY, FREQUENCY)
+    backfill.start_cycle(1_000_260_000)
+    reporter = Reporter()
+    sink = MetricSink(reporter)
+    points = [*rrd_points(999_960, 1_000_260), {"time": None, "loadavg": 1.0}]
+    assert backfill.emit(sink, "node", points, {"node": "pve1"}) == 3
+    sink.flush()
+    assert reporter.lines == [
+        f'proxmox.node.loadavg.1min,node="pve1" gauge,0.5 {second * 1000}'
+        for second in (1_000_080, 1_000_140, 1_000_200)
+    ]
+    assert backfill.stats()["points"] == 3
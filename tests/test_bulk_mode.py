@@ -0,0 +1,188 @@
+import logging
+
+from proxmox.cadence import DomainCadence
+from proxmox.collectors import COUNTER_OUTPUT_RAW, NodeCollectors
+from proxmox.planner import DOMAIN_LXC, DOMAIN_STORAGE, CollectionPlan
+from proxmox.snapshot import CycleSnapshot
+
+CLUSTER_STATUS = [
+    {"type": "cluster", "id": "cluster", "name": "lab", "nodes": 2},
+    {"type": "node", "id": "node/pve1", "name": "pve1", "ip": "10.0.0.1", "online": 1},
+    {"type": "node", "id": "node/pve2", "name": "pve2", "ip": "10.0.0.2", "online": 1},
+]
+
+# cluster/resources of the two nodes, guest entries trimmed to the fields bulk mode reads
+GUEST = {"cpu": 0.1, "maxcpu": 2, "mem": 512, "maxmem": 1024, "disk": 0, "maxdisk": 8192, "uptime": 600}
+CLUSTER_RESOURCES = [
+    {"type": "node", "id": "node/pve1", "node": "pve1", "status": "online"},
+    {
+        "type": "qemu",
+        "id": "qemu/100",
+        "node": "pve1",
+        "vmid": 100,
+        "name": "web",
+        "status": "running",
+        **GUEST,
+    },
+    {
+        "type": "qemu",
+        "id": "qemu/101",
+        "node": "pve1",
+        "vmid": 101,
+        "name": "db",
+        "status": "stopped",
+        **GUEST,
+    },
+    {
+        "type": "qemu",
+        "id": "qemu/900",
+        "node": "pve2",
+        "vmid": 900,
+        "name": "tpl",
+        "status": "running",
+        "template": 1,
+    },
+    {
+        "type": "lxc",
+        "id": "lxc/200",
+        "node": "pve2",
+        "vmid": 200,
+        "name": "dns",
+        "status": "running",
+        **GUEST,
+    },
+    {
+        "type": "storage",
+        "id": "storage/pve1/local",
+        "node": "pve1",
+        "storage": "local",
+        "plugintype": "dir",
+        "shared": 0,
+        "status": "available",
+        "maxdisk": 100,
+        "disk": 40,
+    },
+    {
+        "type": "storage",
+        "id": "storage/pve2/backup",
+        "node": "pve2",
+        "storage": "backup",
+        "plugintype": "nfs",
+        "shared": 1,
+        "status": "unknown",
+    },
+]
+
+
+class Endpoint:
+    def __init__(self):
+        self.requests = []
+
+    def fetch_iter(self, request, required_keys=()):
+        assert required_keys == ("type",)
+        self.requests.append(request)
+        return iter(CLUSTER_RESOURCES)
+
+    def fetch_dict(self, request):
+        self.requests.append(request)
+        if "/qemu/" in request:
+            return {"balloon": 1024, "freemem": 256, "qmpstatus": "running", "cpu": 0.9}
+        return {"swap": 0, "maxswap": 512}
+
+    def fetch(self, request):
+        # No guest agent in the VMs
+        self.requests.append(request)
+
+
+class Scheduler:
+    def __init__(self):
+        self.tasks = []
+
+    def submit(self, _endpoint, task, *args):
+        self.tasks.append((task.__name__, args))
+        task(*args)
+
+
+class Collectors(NodeCollectors):
+    def __init__(self, plan=None):
+        self.logger = logging.getLogger(__name__)
+        self.plan = plan or CollectionPlan()
+        self.scheduler = Scheduler()
+        self.sinks, self.inventories, self.rate_stores, self.backfills = {}, {}, {}, {}
+        self.lines = []
+        self.endpoint = Endpoint()
+        self.register_endpoint_state(
+            self.endpoint, {"counter_output": COUNTER_OUTPUT_RAW}, DomainCadence(60, {})
+        )
+
+    def report_mint_lines(self, lines):
+        self.lines.extend(lines)
+
+    def collect(self, guest_details, skip_domains=()):
+        nodes = CycleSnapshot.from_cluster_status(CLUSTER_STATUS).nodes
+        self.collect_cluster_resources(self.endpoint, nodes, guest_details, skip_domains)
+        self.sinks[self.endpoint].flush()
+        return self.lines
+
+
+def keys(lines, prefix):
+    return {line.split(",", 1)[0] for line in lines if line.startswith(prefix)}
+
+
+def test_one_request_reports_storages_counts_and_running_guests():
+    collectors = Collectors()
+    lines = collectors.collect(guest_details=False)
+    assert collectors.endpoint.requests[0] == "cluster/resources"
+    assert [task for task, _ in collectors.scheduler.tasks] == ["collect_bulk_vm"]
+
+    # The stopped VM and the template are left out of the counts and get no task
+    assert 'proxmox.node.vm,cluster="lab",clusterid="cluster",node="pve1",nodeid="node/pve1" gauge,1' in lines
+    assert 'proxmox.node.vm,cluster="lab",clusterid="cluster",node="pve2",nodeid="node/pve2" gauge,0' in lines
+    assert (
+        'proxmox.node.lxc,cluster="lab",clusterid="cluster",node="pve2",nodeid="node/pve2" gauge,1' in lines
+    )
+
+    # Only the available storage is reported, its free space is derived from maxdisk and disk
+    storage = [line for line in lines if line.startswith("proxmox.node.storage")]
+    assert len(storage) == 3
+    assert all('nodestorage="local",nodestoragetype="dir"' in line for line in storage)
+    assert storage[-1].endswith(" gauge,60")
+
+
+def test_without_guest_details_only_the_agent_is_requested():
+    collectors = Collectors()
+    lines = collectors.collect(guest_details=False)
+    assert collectors.endpoint.requests[1:] == ["nodes/pve1/qemu/100/agent/network-get-interfaces"]
+    assert keys(lines, "proxmox.vm.memory.free") == set()
+    assert keys(lines, "proxmox.lxc.swap") == set()
+    assert 'vmname="web"' in next(line for line in lines if line.startswith("proxmox.vm.cpu.usable"))
+    assert keys(lines, "proxmox.lxc.cpu.usable") == {"proxmox.lxc.cpu.usable"}
+
+
+def test_guest_details_add_the_status_current_fields():
+    collectors = Collectors()
+    lines = collectors.collect(guest_details=True)
+    assert "nodes/pve1/qemu/100/status/current" in collectors.endpoint.requests
+    assert "nodes/pve2/lxc/200/status/current" in collectors.endpoint.requests
+    assert keys(lines, "proxmox.vm.memory.free") == {"proxmox.vm.memory.free"}
+    assert keys(lines, "proxmox.lxc.swap.max") == {"proxmox.lxc.swap.max"}
+    # The usage of cluster/resources is kept, only the missing fields come from status/current
+    assert any(line.startswith("proxmox.vm.cpu.usage") and line.endswith(" gauge,0.1") for line in lines)
+
+
+def test_skipped_domains_are_left_out_of_the_response():
+    collectors = Collectors()
+    lines = collectors.collect(guest_details=False, skip_domains=(DOMAIN_STORAGE, DOMAIN_LXC))
+    assert keys(lines, "proxmox.node.storage") == set()
+    assert keys(lines, "proxmox.node.lxc") == set()
+    assert keys(lines, "proxmox.lxc.") == set()
+    assert keys(lines, "proxmox.node.vm") == {"proxmox.node.vm"}
+
+
+def test_guest_counts_without_the_guest_metrics():
+    plan = CollectionPlan(["proxmox.node.vm", "proxmox.node.lxc"])
+    collectors = Collectors(plan)
+    lines = collectors.collect(guest_details=True, skip_domains=plan.skipped_domains)
+    assert collectors.scheduler.tasks == []
+    assert collectors.endpoint.requests == ["cluster/resources"]
+    assert keys(lines, "proxmox.") == {"proxmox.node.vm", "proxmox.node.lxc"}
@@ -0,0 +1,72 @@
+import pytest
+
+from proxmox import cadence
+from proxmox.cadence import DomainCadence
+from proxmox.planner import DOMAIN_NODE, DOMAIN_SERVICES, DOMAIN_STORAGE
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cadence.time, "monotonic", clock)
+    return clock
+
+
+def cycles(clock, domains, count, frequency=60, jitter=0.0, excluded=()):
+    # The waiting domains of `count` cycles, one frequency apart
+    waiting = []
+    for index in range(count):
+        clock.now += frequency + (jitter if index % 2 else -jitter)
+        waiting.append(domains.next_cycle(excluded))
+    return waiting
+
+
+def test_domains_wait_for_their_interval(clock):
+    domains = DomainCadence(60, {DOMAIN_STORAGE: 300, DOMAIN_SERVICES: 900, DOMAIN_NODE: 60})
+    assert domains.next_cycle() == set()
+    waiting = cycles(clock, domains, 15)
+    due_storage = [index for index, names in enumerate(waiting, 1) if DOMAIN_STORAGE not in names]
+    due_services = [index for index, names in enumerate(waiting, 1) if DOMAIN_SERVICES not in names]
+    assert due_storage == [5, 10, 15]
+    assert due_services == [15]
+    assert all(DOMAIN_NODE not in names for names in waiting)
+
+
+def test_scheduler_jitter_does_not_push_a_domain_into_the_next_cycle(clock):
+    domains = DomainCadence(60, {DOMAIN_STORAGE: 120})
+    domains.next_cycle()
+    waiting = cycles(clock, domains, 6, jitter=5.0)
+    assert [DOMAIN_STORAGE in names for names in waiting] == [True, False] * 3
+
+
+def test_an_excluded_domain_stays_due(clock):
+    domains = DomainCadence(60, {DOMAIN_STORAGE: 300})
+    # Shed in the first cycle, so it runs in the next one instead of waiting a whole interval
+    assert domains.next_cycle(excluded=(DOMAIN_STORAGE,)) == set()
+    clock.now += 60
+    assert domains.next_cycle() == set()
+    clock.now += 60
+    assert domains.next_cycle() == {DOMAIN_STORAGE}
+
+
+def test_intervals_up_to_the_frequency_mean_every_cycle():
+    domains = DomainCadence(60, {DOMAIN_STORAGE: 0, DOMAIN_SERVICES: 30, DOMAIN_NODE: 600})
+    assert domains.intervals == {DOMAIN_NODE: 600}
+    assert domains.describe() == "node every 600s"
+    assert DomainCadence(60, {}).describe() == "every domain every cycle"
+
+
+def test_cycles_per_run_of_the_slowest_domain():
+    domains = DomainCadence(60, {DOMAIN_STORAGE: 300, DOMAIN_SERVICES: 90})
+    assert domains.cycles_per_run((DOMAIN_STORAGE, DOMAIN_SERVICES)) == 5
+    assert domains.cycles_per_run((DOMAIN_SERVICES,)) == 2
+    assert domains.cycles_per_run((DOMAIN_NODE,)) == 1
+    assert domains.cycles_per_run(()) == 1
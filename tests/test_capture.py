@@ -0,0 +1,71 @@
+import gzip
+import json
+import logging
+
+import pytest
+import requests
+
+from proxmox.capture import MISSING_STATUS, CaptureRecorder, ReplayError, ReplayTransport, load_replay
+
+
+def record_cycle(path):
+    recorder = CaptureRecorder(str(path), cycles=1, host="pve1")
+    recorder.start_cycle()
+    recorder.record("cluster/status", None, recorder.start, 0.01, [{"type": "cluster"}])
+    recorder.record("nodes/pve1/qemu", None, recorder.start, 0.02, status=503)
+    recorder.record(
+        "nodes/pve1/qemu/100/agent/network-get-interfaces",
+        None,
+        recorder.start,
+        5.0,
+        status=None,
+        timed_out=True,
+    )
+    recorder.complete_cycle()
+    assert recorder.stats() == {"cycles": 1, "records": 3, "recording": False}
+
+
+def test_replay_answers_as_recorded(tmp_path):
+    path = tmp_path / "capture.json.gz"
+    record_cycle(path)
+    replay = ReplayTransport(str(path), speed=0)
+
+    assert replay.get("cluster/status") == [{"type": "cluster"}]
+    assert replay.get("cluster/status") == [{"type": "cluster"}]
+    with pytest.raises(ReplayError) as error:
+        replay.get("nodes/pve1/qemu")
+    assert error.value.status_code == 503
+    with pytest.raises(requests.exceptions.Timeout):
+        replay.get("nodes/pve1/qemu/100/agent/network-get-interfaces")
+    with pytest.raises(ReplayError) as error:
+        replay.get("nodes/pve1/lxc")
+    assert error.value.status_code == MISSING_STATUS
+    assert replay.stats() == {"served": 5, "failed": 3, "paths": 3, "missing": 1}
+
+
+@pytest.mark.parametrize(
+    "content",
+    [
+        None,
+        b"not a gzip file",
+        gzip.compress(b'{"version": 99}\n'),
+        gzip.compress(b'{"version": 1}\n{"path": "cluster/status"\n'),
+        gzip.compress(b'{"version": 1}\n{"params": null}\n'),
+        gzip.compress(b'{"version": 1}\n')[:-8],
+    ],
+)
+def test_load_replay_without_a_readable_capture(tmp_path, caplog, content):
+    path = tmp_path / "capture.json.gz"
+    if content is not None:
+        path.write_bytes(content)
+    with caplog.at_level(logging.WARNING):
+        assert load_replay(str(path), logger=logging.getLogger("test")) is None
+    assert "not replaying it" in caplog.text
+
+
+def test_load_replay_of_a_capture(tmp_path):
+    path = tmp_path / "capture.json.gz"
+    path.write_bytes(gzip.compress((json.dumps({"version": 1, "host": "pve1"}) + "\n").encode()))
+    replay = load_replay(str(path))
+    assert replay is not None
+    assert replay.header["host"] == "pve1"
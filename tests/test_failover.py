@@ -0,0 +1,129 @@
+import pytest
+import requests
+from proxmoxer.core import ResourceException
+
+from proxmox import proxmox_api
+from proxmox.proxmox_api import HOST_RETRY_INITIAL, ProxmoxClient
+from proxmox.snapshot import CycleSnapshot
+
+CLUSTER_STATUS = [
+    {"type": "cluster", "id": "cluster", "name": "lab", "nodes": 3},
+    {"type": "node", "id": "node/pve1", "name": "pve1", "ip": "10.0.0.1", "online": 1},
+    {"type": "node", "id": "node/pve2", "name": "pve2", "ip": "10.0.0.2", "online": 1},
+    {"type": "node", "id": "node/pve3", "name": "pve3", "ip": "10.0.0.3", "online": 1},
+]
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(proxmox_api.time, "monotonic", clock)
+    return clock
+
+
+class Hosts:
+    # Answers request_host, with the error of a host that does not answer
+    def __init__(self):
+        self.errors = {}
+        self.requests = []
+
+    def __call__(self, api_host, request, _params=None, _stream=False):
+        self.requests.append((api_host.host, request))
+        error = self.errors.get(api_host.host)
+        if error is not None:
+            raise error
+        return {"host": api_host.host}
+
+
+@pytest.fixture
+def client(monkeypatch):
+    client = ProxmoxClient(["10.0.0.1:8006", "10.0.0.2:8006"], "root@pam", "token", "secret")
+    client.answers = Hosts()
+    monkeypatch.setattr(client, "request_host", client.answers)
+    client.register_nodes(CycleSnapshot.from_cluster_status(CLUSTER_STATUS).nodes)
+    return client
+
+
+def test_node_requests_go_to_the_node_itself(client):
+    assert client.node_hosts == {"pve1": "10.0.0.1:8006", "pve2": "10.0.0.2:8006"}
+    assert client.select_host("pve2").host == "10.0.0.2:8006"
+    # A node without a host of its own and cluster-wide requests use the preferred host
+    assert client.select_host("pve3").host == "10.0.0.1:8006"
+    assert client.select_host().host == "10.0.0.1:8006"
+
+    client.fetch("nodes/pve2/status")
+    client.fetch("cluster/resources")
+    assert client.answers.requests == [
+        ("10.0.0.2:8006", "nodes/pve2/status"),
+        ("10.0.0.1:8006", "cluster/resources"),
+    ]
+
+
+def test_a_host_that_does_not_answer_fails_over_to_the_next(client):
+    client.answers.errors["10.0.0.1:8006"] = requests.exceptions.ConnectionError("refused")
+    assert client.fetch("cluster/resources") == {"host": "10.0.0.2:8006"}
+    assert client.fetch("nodes/pve1/status") == {"host": "10.0.0.2:8006"}
+    # The host is down now, later requests skip it without trying it first
+    assert [host for host, _ in client.answers.requests] == [
+        "10.0.0.1:8006",
+        "10.0.0.2:8006",
+        "10.0.0.2:8006",
+    ]
+    assert client.host_stats()["10.0.0.1:8006"]["healthy"] is False
+
+
+def test_api_errors_and_node_timeouts_do_not_fail_over(client):
+    client.answers.errors["10.0.0.1:8006"] = ResourceException(500, "Internal Server Error", "")
+    assert client.fetch("cluster/resources") is None
+    # A node's request that times out is blamed on the node, its host only proxied it
+    client.answers.errors["10.0.0.1:8006"] = requests.exceptions.ReadTimeout("timed out")
+    assert client.fetch("nodes/pve1/status") is None
+    assert len(client.answers.requests) == 2
+    assert client.host_stats()["10.0.0.1:8006"]["healthy"] is True
+
+
+def test_no_healthy_host_left_fails_the_request_once_every_host_was_tried(client):
+    for host in client.api_hosts:
+        client.answers.errors[host] = requests.exceptions.ConnectionError("refused")
+    assert client.fetch("cluster/resources") is None
+    assert len(client.answers.requests) == 2
+    # With every host down, the one that failed longest ago is tried rather than none
+    assert client.select_host().host == "10.0.0.1:8006"
+
+
+def test_a_down_host_is_checked_again_after_its_backoff(client, clock):
+    api_host = client.api_hosts["10.0.0.1:8006"]
+    client.mark_down(api_host, "refused")
+    assert client.hosts_due() == []
+    clock.now += HOST_RETRY_INITIAL
+
+    # A failed check doubles the backoff
+    client.answers.errors[api_host.host] = requests.exceptions.ConnectionError("refused")
+    client.check_hosts()
+    assert api_host.retry_at == clock.now + 2 * HOST_RETRY_INITIAL
+    clock.now += 2 * HOST_RETRY_INITIAL
+
+    del client.answers.errors[api_host.host]
+    client.check_hosts()
+    assert (api_host.healthy, api_host.failures) == (True, 0)
+    assert client.answers.requests[-1] == (api_host.host, "version")
+
+
+def test_discovered_hosts_get_traffic_only_after_a_health_check(monkeypatch):
+    client = ProxmoxClient("10.0.0.1:8006", "root@pam", "token", "secret", discover_hosts=True)
+    client.answers = Hosts()
+    monkeypatch.setattr(client, "request_host", client.answers)
+    client.register_nodes(CycleSnapshot.from_cluster_status(CLUSTER_STATUS).nodes)
+    assert client.node_hosts["pve3"] == "10.0.0.3:8006"
+    assert client.select_host("pve3").host == "10.0.0.1:8006"
+
+    client.check_hosts()
+    assert client.select_host("pve3").host == "10.0.0.3:8006"
@@ -0,0 +1,116 @@
+import pytest
+
+from proxmox import inventory
+from proxmox.inventory import InventoryCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(inventory.time, "monotonic", clock)
+    monkeypatch.setattr(inventory.random, "uniform", lambda _low, _high: 1.0)
+    return clock
+
+
+class Agent:
+    def __init__(self, ips="10.0.0.5"):
+        self.ips = ips
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return self.ips
+
+
+KEY = ("cluster", "pve1", 100)
+
+
+def test_ips_are_cached_until_their_ttl_expires(clock):
+    cache = InventoryCache(ttl=600, negative_ttl=1800)
+    agent = Agent()
+    assert cache.get_vm_ips(KEY, "web", agent) == "10.0.0.5"
+    clock.now += 599
+    assert cache.get_vm_ips(KEY, "web", agent) == "10.0.0.5"
+    assert agent.calls == 1
+
+    clock.now += 2
+    agent.ips = "10.0.0.6"
+    assert cache.get_vm_ips(KEY, "web", agent) == "10.0.0.6"
+    assert agent.calls == 2
+    assert cache.stats() == {"entries": 1, "hits": 1, "lookups": 2}
+
+
+def test_a_guest_without_agent_is_cached_with_the_negative_ttl(clock):
+    cache = InventoryCache(ttl=600, negative_ttl=1800)
+    agent = Agent(ips=None)
+    assert cache.get_vm_ips(KEY, "web", agent) == ""
+    clock.now += 1000
+    assert cache.get_vm_ips(KEY, "web", agent) == ""
+    assert agent.calls == 1
+    clock.now += 801
+    cache.get_vm_ips(KEY, "web", agent)
+    assert agent.calls == 2
+
+
+@pytest.mark.usefixtures("clock")
+def test_a_rename_or_reboot_looks_the_guest_up_again():
+    cache = InventoryCache()
+    agent = Agent()
+    cache.get_vm_ips(KEY, "web", agent, uptime=500)
+    cache.get_vm_ips(KEY, "web", agent, uptime=560)
+    assert agent.calls == 1
+
+    # A re-used vmid shows up with another name, its old IPs are not handed out
+    agent.ips = "10.0.0.9"
+    assert cache.get_vm_ips(KEY, "db", agent, uptime=600) == "10.0.0.9"
+    assert agent.calls == 2
+
+    # Uptime going backwards is a reboot
+    cache.get_vm_ips(KEY, "db", agent, uptime=20)
+    assert agent.calls == 3
+
+
+def test_expired_entries_are_only_refreshed_within_the_budget(clock):
+    cache = InventoryCache(ttl=60, refresh_budget=2)
+    agent = Agent()
+    keys = [("cluster", "pve1", vmid) for vmid in range(5)]
+    for key in keys:
+        cache.get_vm_ips(key, "guest", agent)
+    assert agent.calls == 5
+
+    clock.now += 61
+    cache.start_cycle()
+    for key in keys:
+        assert cache.get_vm_ips(key, "guest", agent) == "10.0.0.5"
+    assert agent.calls == 7
+
+    # A new guest is always looked up, whatever is left of the budget
+    cache.get_vm_ips(("cluster", "pve1", 99), "new", agent)
+    assert agent.calls == 8
+
+    cache.start_cycle()
+    for key in keys:
+        cache.get_vm_ips(key, "guest", agent)
+    assert agent.calls == 10
+
+
+@pytest.mark.usefixtures("clock")
+def test_least_recently_used_entries_are_evicted():
+    cache = InventoryCache(max_entries=2)
+    agent = Agent()
+    first, second, third = (("cluster", "pve1", vmid) for vmid in (1, 2, 3))
+    cache.get_vm_ips(first, "a", agent)
+    cache.get_vm_ips(second, "b", agent)
+    cache.get_vm_ips(first, "a", agent)
+    cache.get_vm_ips(third, "c", agent)
+    assert list(cache.entries) == [first, third]
+    cache.get_vm_ips(second, "b", agent)
+    assert agent.calls == 4
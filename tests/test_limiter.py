@@ -0,0 +1,128 @@
+import pytest
+import requests
+
+from proxmox import limiter as limiter_module
+from proxmox.limiter import INITIAL_LIMIT, AdaptiveLimiter
+from proxmox.proxmox_api import ProxmoxClient
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(limiter_module.time, "monotonic", clock)
+    return clock
+
+
+def settle(limiter, latency, count):
+    for _ in range(count):
+        limiter.acquire()
+        limiter.release(latency)
+
+
+@pytest.mark.usefixtures("clock")
+def test_healthy_responses_raise_the_limit_up_to_the_maximum():
+    limiter = AdaptiveLimiter(11)
+    assert limiter.limit == INITIAL_LIMIT
+    settle(limiter, 0.02, 1)
+    assert limiter.limit == pytest.approx(INITIAL_LIMIT + 1 / INITIAL_LIMIT)
+    settle(limiter, 0.02, 200)
+    assert limiter.limit == 11
+
+
+def test_overload_halves_the_limit_once_per_recent_latency(clock):
+    limiter = AdaptiveLimiter(11)
+    settle(limiter, 0.02, 200)
+    limiter.acquire()
+    limiter.acquire()
+    limiter.release(0.02, overloaded=True)
+    assert int(limiter.limit) == 5
+    # Answer to a request sent before the decrease, it does not count again
+    limiter.release(0.02, overloaded=True)
+    assert int(limiter.limit) == 5
+    assert limiter.decreases == 1
+
+    clock.now += 1
+    limiter.acquire()
+    limiter.release(0.02, overloaded=True)
+    assert int(limiter.limit) == 2
+    assert limiter.decreases == 2
+
+
+@pytest.mark.usefixtures("clock")
+def test_latency_above_the_baseline_lowers_the_limit():
+    limiter = AdaptiveLimiter(11)
+    settle(limiter, 0.02, 200)
+    settle(limiter, 0.5, 3)
+    assert int(limiter.limit) == 9
+    assert limiter.decreases == 1
+
+
+@pytest.mark.usefixtures("clock")
+def test_in_flight_requests_wait_for_a_slot():
+    limiter = AdaptiveLimiter(11)
+    for _ in range(INITIAL_LIMIT):
+        limiter.acquire()
+    with limiter.lock:
+        assert limiter.try_acquire() == limiter_module.WAIT_POLL
+    limiter.release(0.02)
+    with limiter.lock:
+        assert limiter.try_acquire() == 0
+
+
+@pytest.mark.usefixtures("clock")
+def test_unsampled_releases_leave_latency_and_limit_alone():
+    limiter = AdaptiveLimiter(11)
+    settle(limiter, 0.02, 200)
+    recent, baseline = limiter.recent_latency, limiter.baseline_latency
+
+    # Three guest-agent calls that timed out after 5s
+    for _ in range(3):
+        limiter.acquire()
+        limiter.release(5.0, sample=False)
+    assert limiter.limit == 11
+    assert (limiter.recent_latency, limiter.baseline_latency) == (recent, baseline)
+    assert limiter.in_flight == 0
+
+    # pveproxy overload right after them is not hidden by a decrease cooldown
+    limiter.acquire()
+    limiter.release(0.02, overloaded=True)
+    assert int(limiter.limit) == 5
+
+
+@pytest.mark.usefixtures("clock")
+def test_unsampled_release_before_any_sample():
+    limiter = AdaptiveLimiter(11)
+    limiter.acquire()
+    limiter.release(5.0, overloaded=True, sample=False)
+    assert limiter.recent_latency is None
+    assert int(limiter.limit) == INITIAL_LIMIT // 2
+
+
+@pytest.mark.usefixtures("clock")
+def test_client_does_not_sample_agent_and_rrddata_requests():
+    limiter = AdaptiveLimiter(11)
+    settle(limiter, 0.02, 200)
+    recent, baseline = limiter.recent_latency, limiter.baseline_latency
+    client = ProxmoxClient("pve1:8006", "root@pam", "token", "secret", limiter=limiter)
+
+    def request_host(_api_host, request, _params=None, _stream=False):
+        if "/agent/" in request:
+            raise requests.exceptions.Timeout("agent did not answer")
+        return []
+
+    client.request_host = request_host
+    assert client.fetch("nodes/pve1/qemu/100/agent/network-get-interfaces") is None
+    assert client.fetch("nodes/pve1/qemu/100/rrddata") == []
+    assert (limiter.recent_latency, limiter.baseline_latency) == (recent, baseline)
+    assert limiter.limit == 11
+
+    client.fetch("nodes/pve1/qemu")
+    assert limiter.recent_latency != recent
@@ -0,0 +1,93 @@
+from proxmox.metric_mapping import NODE_METRICS, SERVICE_METRICS, VM_GAUGE_METRICS, MetricTable, running
+
+# nodes/{node}/services of a PVE 8 node, trimmed to a few services
+SERVICES = [
+    {
+        "service": "pveproxy",
+        "name": "pveproxy",
+        "desc": "PVE API Proxy Server",
+        "state": "running",
+        "active-state": "active",
+        "unit-state": "enabled",
+    },
+    {
+        "service": "corosync",
+        "name": "corosync",
+        "desc": "Corosync Cluster Engine",
+        "state": "dead",
+        "active-state": "inactive",
+        "unit-state": "enabled",
+    },
+    {
+        "service": "syslog",
+        "name": "rsyslog",
+        "desc": "System Logging Service",
+        "state": "running",
+        "active-state": "active",
+        "unit-state": "static",
+    },
+    {
+        "service": "ksmtuned",
+        "name": "ksmtuned",
+        "desc": "not installed",
+        "state": "unknown",
+        "unit-state": "not-found",
+    },
+]
+
+
+class Batch:
+    def __init__(self):
+        self.values = {}
+
+    def add(self, key, value):
+        self.values[key] = value
+
+
+def emit(table, data):
+    batch = Batch()
+    table.emit(batch, data)
+    return batch.values
+
+
+def test_service_states_of_a_services_response():
+    states = [emit(SERVICE_METRICS, entry) for entry in SERVICES]
+    assert states == [
+        {
+            "proxmox.node.service.state": 1,
+            "proxmox.node.service.activestate": 1,
+            "proxmox.node.service.unitstate": 1,
+        },
+        {
+            "proxmox.node.service.state": 0,
+            "proxmox.node.service.activestate": 0,
+            "proxmox.node.service.unitstate": 1,
+        },
+        {
+            "proxmox.node.service.state": 1,
+            "proxmox.node.service.activestate": 1,
+            "proxmox.node.service.unitstate": 0,
+        },
+        {
+            "proxmox.node.service.state": 0,
+            "proxmox.node.service.activestate": 0,
+            "proxmox.node.service.unitstate": 0,
+        },
+    ]
+
+
+def test_missing_fields_are_skipped_unless_kept():
+    assert emit(NODE_METRICS, {"cpu": 0.5, "loadavg": ["0.25"], "swap": {"free": 7}}) == {
+        "proxmox.node.cpu.usage": 50.0,
+        "proxmox.node.loadavg.1min": 0.25,
+        "proxmox.node.swap.free": 7,
+    }
+    rows = (("status", "proxmox.vm.status", running), ("uptime", "proxmox.vm.uptime", None))
+    assert emit(MetricTable(rows), {}) == {}
+    assert emit(MetricTable(rows, keep_missing=True), {}) == {"proxmox.vm.status": 0}
+    assert emit(MetricTable(rows, keep_missing=True).without(("uptime",)), {}) == {"proxmox.vm.status": 0}
+
+
+def test_gauge_table_leaves_out_the_counters():
+    values = emit(VM_GAUGE_METRICS, {"netin": 1, "diskread": 2, "mem": 3, "status": "running"})
+    assert values == {"proxmox.vm.memory.mem": 3, "proxmox.vm.status": 1}
@@ -0,0 +1,50 @@
+from proxmox.metric_sink import ChangeFilter, MetricSink
+
+
+class Reporter:
+    def __init__(self):
+        self.lines = []
+
+    def report_mint_lines(self, lines):
+        self.lines.extend(lines)
+
+
+def cycle(sink, reporter, timestamp, value):
+    reporter.lines = []
+    sink.timestamp = timestamp
+    sink.add("proxmox.node.memory.total", value, {"node": "pve1"})
+    sink.flush()
+    return reporter.lines
+
+
+def test_unchanged_static_values_are_only_sent_on_heartbeat():
+    reporter = Reporter()
+    sink = MetricSink(reporter, changes=ChangeFilter({"proxmox.node.memory.total"}, heartbeat=600))
+    assert len(cycle(sink, reporter, 1_000_000, 64)) == 1
+    assert cycle(sink, reporter, 1_060_000, 64) == []
+    assert len(cycle(sink, reporter, 1_120_000, 128)) == 1
+    assert len(cycle(sink, reporter, 1_120_000 + 600_000, 128)) == 1
+    assert sink.stats()["suppressed"] == 1
+
+
+def test_batches_with_their_own_timestamp_bypass_the_change_filter():
+    reporter = Reporter()
+    changes = ChangeFilter({"proxmox.node.memory.total"}, heartbeat=600)
+    sink = MetricSink(reporter, changes=changes)
+    assert len(cycle(sink, reporter, 1_000_000, 64)) == 1
+
+    # Backfilled minutes before the cycle carry the same and an older value
+    reporter.lines = []
+    for minute, value in ((1, 64), (2, 32)):
+        batch = sink.batch({"node": "pve1"}, timestamp=1_000_000 - minute * 60_000)
+        batch.add("proxmox.node.memory.total", value)
+        batch.commit()
+    sink.flush()
+    assert reporter.lines == [
+        'proxmox.node.memory.total,node="pve1" gauge,64 940000',
+        'proxmox.node.memory.total,node="pve1" gauge,32 880000',
+    ]
+    assert changes.stats() == {"series": 1, "sent": 1, "suppressed": 0}
+
+    # The filter still holds the cycle's value, so the next cycle's unchanged value is suppressed
+    assert cycle(sink, reporter, 1_060_000, 64) == []
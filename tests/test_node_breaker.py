@@ -0,0 +1,114 @@
+import pytest
+import requests
+
+from proxmox import proxmox_api
+from proxmox.proxmox_api import NODE_FAILURE_THRESHOLD, NODE_RETRY_INITIAL, ProxmoxClient
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(proxmox_api.time, "monotonic", clock)
+    return clock
+
+
+@pytest.fixture
+def client():
+    return ProxmoxClient("pve1:8006", "root@pam", "token", "secret")
+
+
+def trip(client, node="pve2"):
+    for _ in range(NODE_FAILURE_THRESHOLD):
+        client.node_failed(node, "timeout")
+
+
+@pytest.mark.usefixtures("clock")
+def test_circuit_opens_after_consecutive_failures(client):
+    for _ in range(NODE_FAILURE_THRESHOLD - 1):
+        client.node_failed("pve2", "timeout")
+    assert client.node_available("pve2")
+    client.node_failed("pve2", "timeout")
+    assert client.node_open("pve2")
+    assert not client.node_available("pve2")
+    assert client.breaker_stats()["pve2"]["open"]
+    assert client.node_available("pve1")
+
+
+def test_failures_in_flight_do_not_extend_the_circuit(client, clock):
+    trip(client)
+    retry_at = client.node_breakers["pve2"].retry_at
+    assert retry_at == clock.now + NODE_RETRY_INITIAL
+    client.node_failed("pve2", "timeout")
+    assert client.node_breakers["pve2"].retry_at == retry_at
+    assert client.node_breakers["pve2"].trips == 1
+
+
+def test_half_open_lets_a_single_probe_through(client, clock):
+    trip(client)
+    clock.now += NODE_RETRY_INITIAL
+    # The cycle collects the node again, but only its first request is sent
+    assert not client.node_open("pve2")
+    assert client.node_available("pve2")
+    assert not client.node_available("pve2")
+    assert not client.node_available("pve2")
+
+
+def test_failed_probe_reopens_with_a_doubled_backoff(client, clock):
+    trip(client)
+    clock.now += NODE_RETRY_INITIAL
+    assert client.node_available("pve2")
+    client.node_failed("pve2", "timeout")
+    breaker = client.node_breakers["pve2"]
+    assert breaker.trips == 2
+    assert breaker.retry_at == clock.now + 2 * NODE_RETRY_INITIAL
+    assert not breaker.probing
+    assert client.node_open("pve2")
+
+
+def test_successful_probe_closes_the_circuit(client, clock):
+    trip(client)
+    clock.now += NODE_RETRY_INITIAL
+    assert client.node_available("pve2")
+    client.node_succeeded("pve2")
+    assert client.node_available("pve2")
+    assert client.node_available("pve2")
+    assert "pve2" not in client.breaker_stats()
+
+
+def test_inconclusive_probe_lets_the_next_probe_through_after_the_timeout(client, clock):
+    trip(client)
+    clock.now += NODE_RETRY_INITIAL
+    assert client.node_available("pve2")
+    assert not client.node_available("pve2")
+    clock.now += 2 * client.timeout
+    assert client.node_available("pve2")
+
+
+def test_fetch_sends_only_the_probe_of_a_half_open_node(client, clock):
+    sent = []
+
+    def request_host(_api_host, request, _params=None, _stream=False):
+        sent.append(request)
+        raise requests.exceptions.Timeout("node did not answer")
+
+    client.request_host = request_host
+    for _ in range(NODE_FAILURE_THRESHOLD):
+        assert client.fetch("nodes/pve2/status") is None
+    assert len(sent) == NODE_FAILURE_THRESHOLD
+
+    assert client.fetch("nodes/pve2/qemu") is None
+    assert len(sent) == NODE_FAILURE_THRESHOLD
+
+    clock.now += NODE_RETRY_INITIAL
+    for request in ("nodes/pve2/status", "nodes/pve2/qemu", "nodes/pve2/lxc"):
+        assert client.fetch(request) is None
+    assert sent[NODE_FAILURE_THRESHOLD:] == ["nodes/pve2/status"]
+    assert client.node_breakers["pve2"].trips == 2
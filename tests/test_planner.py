@@ -0,0 +1,66 @@
+from pathlib import Path
+
+import pytest
+import yaml
+
+from proxmox.planner import (
+    DOMAIN_LXC,
+    DOMAIN_NODE,
+    DOMAIN_SERVICES,
+    DOMAIN_STORAGE,
+    DOMAIN_VM,
+    CollectionPlan,
+)
+
+EXTENSION_YAML = Path(__file__).resolve().parent.parent / "extension" / "extension.yaml"
+
+
+@pytest.fixture(scope="module")
+def feature_sets():
+    # featureSet name -> metric keys, as declared in extension.yaml
+    document = yaml.safe_load(EXTENSION_YAML.read_text(encoding="utf-8"))
+    return {
+        feature_set["featureSet"]: [metric["key"] for metric in feature_set["metrics"]]
+        for feature_set in document["python"]["featureSets"]
+    }
+
+
+def plan_for(feature_sets, *names):
+    return CollectionPlan([key for name in names for key in feature_sets[name]])
+
+
+def test_without_feature_set_information_everything_is_collected():
+    plan = CollectionPlan()
+    assert plan.cluster and plan.cluster_ha and plan.vm_guests and plan.lxc_guests
+    assert plan.skipped_domains == frozenset()
+
+
+def test_every_feature_set_enabled_skips_nothing(feature_sets):
+    plan = plan_for(feature_sets, *feature_sets)
+    assert plan.cluster and plan.cluster_ha and plan.vm_guests and plan.lxc_guests
+    assert plan.skipped_domains == frozenset()
+
+
+def test_node_alone_keeps_the_guest_lists_for_the_counts(feature_sets):
+    plan = plan_for(feature_sets, "Node")
+    assert not plan.cluster and not plan.cluster_ha
+    assert not plan.vm_guests and not plan.lxc_guests
+    assert plan.skipped_domains == {DOMAIN_STORAGE, DOMAIN_SERVICES}
+
+
+def test_guest_feature_sets_alone_skip_the_node_domains(feature_sets):
+    plan = plan_for(feature_sets, "VM", "CONTAINER")
+    assert plan.vm_guests and plan.lxc_guests
+    assert plan.skipped_domains == {DOMAIN_NODE, DOMAIN_STORAGE, DOMAIN_SERVICES}
+
+    plan = plan_for(feature_sets, "Cluster", "Node-Storage")
+    assert plan.cluster and plan.cluster_ha
+    assert plan.skipped_domains == {DOMAIN_NODE, DOMAIN_VM, DOMAIN_LXC, DOMAIN_SERVICES}
+
+
+def test_a_single_metric_keeps_its_request():
+    plan = CollectionPlan(["proxmox.vm.network.netin.rate", "proxmox.cluster.ha.status"])
+    assert plan.vm_guests and not plan.lxc_guests
+    assert plan.cluster_ha and not plan.cluster
+    assert DOMAIN_VM not in plan.skipped_domains
+    assert DOMAIN_LXC in plan.skipped_domains
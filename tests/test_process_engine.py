@@ -0,0 +1,109 @@
+import logging
+import threading
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+import pytest
+
+from proxmox.metric_sink import MetricSink
+from proxmox.process_engine import ProcessCollectionEngine, ShardBuffer, ShardCollector, ShardView
+
+
+class Instrumentation:
+    def record_task(self, name, duration, failed):
+        pass
+
+
+class Client:
+    host = "pve"
+    instrumentation = Instrumentation()
+
+    def __str__(self):
+        return "pve"
+
+
+class Request:
+    concurrency = 2
+
+
+@pytest.fixture
+def collector():
+    collector = ShardCollector(max_workers=2)
+    client = Client()
+    collector.sinks[client] = MetricSink(ShardBuffer())
+    collector.inventories[client] = object()
+    yield collector, client
+    collector.scheduler.shutdown()
+
+
+def test_shard_view_is_its_own_key_with_the_attributes_of_the_client():
+    client = Client()
+    view = ShardView(client, 7)
+    assert view.host == "pve"
+    assert str(view) == "pve"
+    assert f"{view}" == "pve"
+    assert view != client
+    assert {view: 1}.get(client) is None
+
+
+def test_overlapping_shards_of_an_endpoint_keep_their_own_lines(collector):
+    collector, client = collector
+    first, _ = collector.open_shard(client, 1, Request())
+    second, _ = collector.open_shard(client, 2, Request())
+    assert collector.inventories[first] is collector.inventories[client]
+
+    collector.sinks[first].add("proxmox.node.vm", 1)
+    collector.sinks[second].add("proxmox.node.vm", 2)
+    for shard in (first, second):
+        collector.sinks[shard].flush()
+
+    first_lines, _ = collector.sinks[first].extension.take()
+    second_lines, _ = collector.sinks[second].extension.take()
+    assert first_lines == ["proxmox.node.vm gauge,1"]
+    assert second_lines == ["proxmox.node.vm gauge,2"]
+
+
+def test_closing_a_shard_drops_its_state(collector):
+    collector, client = collector
+    shard, idle = collector.open_shard(client, 1, Request())
+    collector.scheduler.submit(shard, lambda: None)
+    assert idle.wait(2)
+
+    collector.close_shard(shard)
+    assert shard not in collector.sinks
+    assert shard not in collector.inventories
+    with pytest.raises(KeyError):
+        collector.scheduler.submit(shard, lambda: None)
+
+
+class Worker:
+    def __init__(self):
+        self.futures = []
+
+    def available(self):
+        return True
+
+    def submit(self, request):
+        future = Future()
+        future.request = request
+        self.futures.append(future)
+        return future
+
+    def __str__(self):
+        return "WorkerProcess(0)"
+
+
+def test_a_shard_without_answer_is_cancelled_after_its_timeout():
+    client = Client()
+    extension = SimpleNamespace(sinks={client: MetricSink(ShardBuffer())}, backfills={}, plan=None)
+    engine = ProcessCollectionEngine.__new__(ProcessCollectionEngine)
+    engine.extension, engine.logger, engine.lock = extension, logging.getLogger(__name__), threading.Lock()
+    engine.shards = engine.failed = 0
+    worker = Worker()
+    engine.workers = [worker]
+    config = {"frequency": 0, "request_timeout": 0.05}
+
+    assert engine.run_cycle(client, config, [], None, [SimpleNamespace(name="pve1")])
+    assert worker.futures[0].cancelled()
+    assert worker.futures[0].request.nodes == {"pve1"}
+    assert (engine.shards, engine.failed) == (1, 1)
@@ -0,0 +1,88 @@
+import json
+
+import pytest
+import requests
+
+from proxmox.proxmox_api import ProxmoxClient
+
+BODY = json.dumps({"data": [{"vmid": 100}, {"vmid": 101}, {"name": "no id"}]}).encode()
+
+
+class Limiter:
+    def __init__(self):
+        self.in_flight = 0
+        self.released = []
+
+    def acquire(self):
+        self.in_flight += 1
+
+    def release(self, duration, overloaded=False, _sample=True):
+        self.in_flight -= 1
+        self.released.append((duration, overloaded))
+
+
+class Recorder:
+    def __init__(self):
+        self.records = []
+
+    def record(self, request, _params, _started, _latency, data=None, status=200, timed_out=False):
+        self.records.append((request, data, status, timed_out))
+
+
+class Response:
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.closed = False
+
+    def iter_content(self, _size):
+        for chunk in self.chunks:
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def client(monkeypatch):
+    client = ProxmoxClient("pve1:8006", "root@pam", "token", "secret", limiter=Limiter(), recorder=Recorder())
+    client.response = None
+    monkeypatch.setattr(client, "initialize_proxmoxapi", lambda _api_host=None: None)
+    monkeypatch.setattr(client, "stream_list", lambda _api, _request, _params=None: client.response)
+    return client
+
+
+def test_a_streamed_list_holds_its_slot_until_the_body_is_read(client):
+    client.response = Response([BODY[:10], BODY[10:]])
+    entries = client.fetch_iter("nodes/pve1/qemu", ("vmid",))
+    assert client.limiter.in_flight == 1
+    assert next(entries) == {"vmid": 100}
+    assert client.limiter.in_flight == 1
+    assert client.recorder.records == []
+
+    assert list(entries) == [{"vmid": 101}]
+    assert client.limiter.in_flight == 0
+    assert client.limiter.released[0][1] is False
+    assert client.response.closed
+    # The capture holds the list as the API answered it, malformed entries included
+    assert client.recorder.records == [
+        ("nodes/pve1/qemu", [{"vmid": 100}, {"vmid": 101}, {"name": "no id"}], 200, False)
+    ]
+
+
+def test_a_body_that_breaks_off_fails_the_request(client):
+    client.response = Response([BODY[:30], requests.exceptions.ChunkedEncodingError("reset")])
+    assert list(client.fetch_iter("nodes/pve1/qemu", ("vmid",))) == [{"vmid": 100}]
+    assert client.limiter.in_flight == 0
+    assert client.recorder.records == [("nodes/pve1/qemu", None, None, False)]
+
+
+def test_a_stream_dropped_unread_gives_its_slot_back(client):
+    client.response = Response([BODY])
+    entries = client.fetch("nodes/pve1/qemu", stream=True)
+    assert client.limiter.in_flight == 1
+    entries.close()
+    assert client.limiter.in_flight == 0
+    assert client.response.closed
+    assert client.recorder.records == []
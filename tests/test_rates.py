@@ -0,0 +1,126 @@
+import pytest
+
+from proxmox import rates
+from proxmox.metric_mapping import VM_COUNTER_RATES
+from proxmox.rates import RateStore
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(rates.time, "monotonic", clock)
+    return clock
+
+
+class Batch:
+    def __init__(self):
+        self.values = {}
+
+    def add(self, key, value):
+        self.values[key] = value
+
+
+def test_the_first_sample_only_sets_the_baseline(clock):
+    store = RateStore(width=2)
+    assert store.sample("vm100", "pve1", 100, [1000, 500]) is None
+    clock.now += 60
+    assert store.sample("vm100", "pve1", 160, [7000, 500]) == [100.0, 0.0]
+
+
+def test_a_reset_counter_gives_no_rate_until_the_next_sample(clock):
+    store = RateStore(width=2)
+    store.sample("vm100", "pve1", 100, [6000, 6000])
+    clock.now += 60
+    assert store.sample("vm100", "pve1", 160, [12000, 10]) is None
+    clock.now += 60
+    assert store.sample("vm100", "pve1", 220, [18000, 610]) == [100.0, 10.0]
+
+    # A reboot resets every counter, seen by the uptime going backwards
+    clock.now += 60
+    assert store.sample("vm100", "pve1", 30, [18600, 1210]) is None
+    assert store.stats()["resets"] == 2
+
+
+def test_a_guest_that_moved_to_another_node_starts_a_new_baseline(clock):
+    store = RateStore(width=1)
+    store.sample("vm100", "pve1", 100, [1000])
+    clock.now += 60
+    assert store.sample("vm100", "pve2", 160, [7000]) is None
+    clock.now += 60
+    assert store.sample("vm100", "pve2", 220, [13000]) == [100.0]
+
+
+def test_samples_closer_than_the_minimum_interval_keep_the_older_baseline(clock):
+    store = RateStore(width=1, min_interval=1.0)
+    store.sample("vm100", "pve1", 100, [1000])
+    clock.now += 0.5
+    assert store.sample("vm100", "pve1", 100, [1050]) is None
+    clock.now += 0.5
+    assert store.sample("vm100", "pve1", 101, [1100]) == [100.0]
+
+
+def test_missing_counters_have_no_rate(clock):
+    store = RateStore(width=2)
+    store.sample("vm100", "pve1", 100, [1000, None])
+    clock.now += 10
+    assert store.sample("vm100", "pve1", 110, [2000, 50]) == [100.0, None]
+
+
+def test_idle_guests_give_their_slot_back(clock):
+    store = RateStore(width=1, idle_cycles=2)
+    store.start_cycle()
+    store.sample("vm100", "pve1", 100, [1000])
+    store.sample("vm101", "pve1", 100, [1000])
+    for _ in range(2):
+        clock.now += 60
+        store.start_cycle()
+        store.sample("vm101", "pve1", 160, [2000])
+    assert store.stats()["guests"] == 2
+
+    store.start_cycle()
+    assert set(store.slots) == {"vm101"}
+    store.sample("vm102", "pve1", 100, [1000])
+    # The new guest takes over the free slot instead of growing the arrays
+    assert store.stats() == {"guests": 2, "slots": 2, "resets": 0, "evictions": 0}
+
+
+def test_beyond_max_guests_the_stalest_slot_is_taken_over(clock):
+    store = RateStore(width=1, max_guests=2, idle_cycles=10)
+    store.start_cycle()
+    store.sample("vm100", "pve1", 100, [1000])
+    store.start_cycle()
+    store.sample("vm101", "pve1", 100, [1000])
+    store.start_cycle()
+    store.sample("vm102", "pve1", 100, [1000])
+    assert set(store.slots) == {"vm101", "vm102"}
+    assert store.stats()["evictions"] == 1
+
+    # The evicted guest comes back with a new baseline
+    clock.now += 60
+    store.start_cycle()
+    assert store.sample("vm100", "pve1", 160, [7000]) is None
+
+
+def test_emit_adds_the_rates_of_a_table(clock):
+    store = RateStore(width=len(VM_COUNTER_RATES.rows))
+    data = {"uptime": 100, "netin": 1000, "netout": 2000, "diskread": 0, "diskwrite": 0}
+    batch = Batch()
+    store.emit(batch, "vm100", "pve1", data, VM_COUNTER_RATES)
+    assert batch.values == {}
+
+    clock.now += 30
+    data = {"uptime": 130, "netin": 4000, "netout": 2000, "diskread": 1}
+    store.emit(batch, "vm100", "pve1", data, VM_COUNTER_RATES)
+    assert batch.values == {
+        "proxmox.vm.network.netin.rate": 100.0,
+        "proxmox.vm.network.netout.rate": 0.0,
+        "proxmox.vm.disk.read.rate": 0.033,
+    }
@@ -0,0 +1,199 @@
+import threading
+import time
+
+import pytest
+
+from proxmox.scheduler import (
+    CYCLE_RUN,
+    CYCLE_SHED,
+    CYCLE_SKIP,
+    OVERRUN_COALESCE,
+    OVERRUN_SHED,
+    OVERRUN_SKIP,
+    CollectionScheduler,
+    CycleGuard,
+    TaskGraph,
+)
+
+
+@pytest.fixture
+def scheduler():
+    scheduler = CollectionScheduler(max_workers=4)
+    scheduler.register("pve", 4)
+    yield scheduler
+    scheduler.shutdown()
+
+
+def wait_all(*tasks):
+    for task in tasks:
+        assert task.done.wait(2), task
+
+
+def test_graph_runs_tasks_after_their_inputs_with_their_results(scheduler):
+    order = []
+
+    def step(name, *inputs):
+        order.append(name)
+        return (name, *inputs)
+
+    graph = TaskGraph(scheduler, "pve")
+    first = graph.add(step, "first")
+    second = graph.add(step, "second", after=(first,))
+    third = graph.add(step, "third", after=(first, second))
+    wait_all(first, second, third)
+
+    assert order == ["first", "second", "third"]
+    assert second.result == ("second", ("first",))
+    assert third.result == ("third", ("first",), ("second", ("first",)))
+    path, length, _queued = graph.critical_path()
+    assert [task.label for task in path] == ["step", "step", "step"]
+    assert path[-1] is third
+    assert length > 0
+
+
+def test_graph_skips_the_dependents_of_a_failed_task(scheduler):
+    ran = []
+
+    def fail():
+        raise RuntimeError("cluster/status failed")
+
+    graph = TaskGraph(scheduler, "pve")
+    failed = graph.add(fail)
+    dependent = graph.add(ran.append, "dependent", after=(failed,))
+    transitive = graph.add(ran.append, "transitive", after=(dependent,))
+    independent = graph.add(ran.append, "independent")
+    wait_all(failed, dependent, transitive, independent)
+
+    assert failed.failed
+    assert dependent.skipped
+    assert transitive.skipped
+    assert not independent.skipped
+    assert ran == ["independent"]
+
+
+def test_tasks_submitted_by_a_graph_task_join_the_graph(scheduler):
+    def fan_out():
+        for index in range(3):
+            scheduler.submit("pve", time.sleep, 0.01 * index)
+
+    graph = TaskGraph(scheduler, "pve")
+    parent = graph.add(fan_out)
+    wait_all(parent)
+    children = [task for task in graph.tasks if task is not parent]
+    wait_all(*children)
+    assert len(children) == 3
+    assert all(task.cause is parent for task in children)
+
+
+def test_run_inline_runs_on_the_calling_thread_after_its_inputs(scheduler):
+    graph = TaskGraph(scheduler, "pve", timeout=5)
+    upstream = graph.add(time.sleep, 0.05)
+    inline = graph.run_inline(threading.current_thread)
+    assert inline.result is threading.current_thread()
+
+    inline = graph.run_inline(lambda _value: threading.current_thread(), after=(upstream,))
+    assert upstream.done.is_set()
+    assert inline.result is threading.current_thread()
+
+
+def test_run_inline_skips_its_step_when_an_input_misses_the_deadline(scheduler):
+    stuck = threading.Event()
+    ran = []
+    graph = TaskGraph(scheduler, "pve", timeout=0.1)
+    upstream = graph.add(stuck.wait)
+    try:
+        start = time.perf_counter()
+        inline = graph.run_inline(ran.append, after=(upstream,), label="process_engine")
+        assert time.perf_counter() - start < 1
+        assert inline.skipped
+        assert inline.done.is_set()
+        assert ran == []
+
+        # Steps after the skipped one are skipped in turn
+        dependent = graph.add(ran.append, after=(inline,))
+        wait_all(dependent)
+        assert dependent.skipped
+    finally:
+        stuck.set()
+    wait_all(upstream)
+
+
+class Cycles:
+    def __init__(self, scheduler, policy):
+        self.completed = []
+        self.coalesced = []
+        self.guard = CycleGuard(
+            "pve", scheduler, policy=policy, on_complete=self.on_complete, on_coalesced=self.coalesced.append
+        )
+        scheduler.register("pve", 4, on_idle=self.guard.on_idle)
+
+    def on_complete(self, endpoint, duration, graphs):
+        self.completed.append((endpoint, duration, graphs))
+
+
+def test_cycle_guard_skips_a_cycle_while_the_previous_one_runs(scheduler):
+    cycles = Cycles(scheduler, OVERRUN_SKIP)
+    assert cycles.guard.begin() == CYCLE_RUN
+    assert cycles.guard.begin() == CYCLE_SKIP
+    assert cycles.guard.overruns == 1
+
+    cycles.guard.end_submission()
+    assert len(cycles.completed) == 1
+    assert cycles.completed[0][1] >= 0
+    assert cycles.guard.begin() == CYCLE_RUN
+    assert cycles.guard.overruns == 1
+    assert cycles.coalesced == []
+
+
+def test_cycle_guard_waits_for_the_tasks_of_the_cycle(scheduler):
+    cycles = Cycles(scheduler, OVERRUN_SKIP)
+    release = threading.Event()
+    assert cycles.guard.begin() == CYCLE_RUN
+    scheduler.submit("pve", release.wait)
+    cycles.guard.end_submission()
+    assert cycles.completed == []
+    assert cycles.guard.begin() == CYCLE_SKIP
+
+    release.set()
+    deadline = time.monotonic() + 2
+    while not cycles.completed and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert len(cycles.completed) == 1
+    assert cycles.guard.begin() == CYCLE_RUN
+
+
+def test_cycle_guard_sheds_an_overlapping_cycle(scheduler):
+    cycles = Cycles(scheduler, OVERRUN_SHED)
+    assert cycles.guard.begin() == CYCLE_RUN
+    assert cycles.guard.begin() == CYCLE_SHED
+    assert cycles.guard.overruns == 1
+    cycles.guard.end_submission()
+    assert len(cycles.completed) == 1
+
+
+def test_cycle_guard_hands_over_the_graphs_of_its_cycle(scheduler):
+    cycles = Cycles(scheduler, OVERRUN_SHED)
+    assert cycles.guard.begin() == CYCLE_RUN
+    first = TaskGraph(scheduler, "pve")
+    cycles.guard.add_graph(first)
+    assert cycles.guard.begin() == CYCLE_SHED
+    shed = TaskGraph(scheduler, "pve")
+    cycles.guard.add_graph(shed)
+    cycles.guard.end_submission()
+    assert cycles.completed[0][2] == [first, shed]
+
+    # The next cycle starts without the graphs of the last one
+    assert cycles.guard.begin() == CYCLE_RUN
+    cycles.guard.end_submission()
+    assert cycles.completed[1][2] == []
+
+
+def test_cycle_guard_coalesces_overlapping_cycles_into_one(scheduler):
+    cycles = Cycles(scheduler, OVERRUN_COALESCE)
+    assert cycles.guard.begin() == CYCLE_RUN
+    assert cycles.guard.begin() == CYCLE_SKIP
+    assert cycles.guard.begin() == CYCLE_SKIP
+    assert cycles.guard.overruns == 2
+    cycles.guard.end_submission()
+    assert len(cycles.completed) == 1
+    assert cycles.coalesced == ["pve"]
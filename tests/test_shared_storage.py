@@ -0,0 +1,118 @@
+import logging
+import threading
+
+from proxmox.collectors import NodeCollectors
+from proxmox.metric_sink import MetricSink
+from proxmox.snapshot import CycleSnapshot, SharedStorageClaims, is_shared_storage
+
+CLUSTER_STATUS = [
+    {"type": "cluster", "id": "cluster", "name": "lab", "nodes": 2},
+    {"type": "node", "id": "node/pve1", "name": "pve1", "ip": "10.0.0.1", "online": 1},
+    {"type": "node", "id": "node/pve2", "name": "pve2", "ip": "10.0.0.2", "online": 1},
+]
+
+# nodes/{node}/storage, the same on both nodes
+STORAGES = [
+    {
+        "storage": "local",
+        "type": "dir",
+        "shared": 0,
+        "active": 1,
+        "enabled": 1,
+        "total": 100,
+        "used": 40,
+        "avail": 60,
+    },
+    {
+        "storage": "ceph",
+        "type": "rbd",
+        "shared": 1,
+        "active": 1,
+        "enabled": 1,
+        "total": 900,
+        "used": 300,
+        "avail": 600,
+    },
+    {
+        "storage": "backup",
+        "type": "nfs",
+        "shared": 1,
+        "active": 0,
+        "enabled": 1,
+        "total": 0,
+        "used": 0,
+        "avail": 0,
+    },
+]
+
+
+class Reporter:
+    def __init__(self):
+        self.lines = []
+
+    def report_mint_lines(self, lines):
+        self.lines.extend(lines)
+
+
+class Endpoint:
+    def fetch_list(self, request, _required_keys=()):
+        assert request.endswith("/storage")
+        return STORAGES
+
+
+class Collectors(NodeCollectors):
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self.reporter = Reporter()
+        self.endpoint = Endpoint()
+        self.sinks = {self.endpoint: MetricSink(self.reporter)}
+
+
+def collect(shared_storage_once):
+    collectors = Collectors()
+    snapshot = CycleSnapshot.from_cluster_status(CLUSTER_STATUS, shared_storage_once=shared_storage_once)
+    for node in snapshot.nodes:
+        collectors.collect_node_storage(collectors.endpoint, node)
+    collectors.sinks[collectors.endpoint].flush()
+    return collectors.reporter.lines
+
+
+def test_per_node_mode_reports_every_storage_on_every_node():
+    lines = collect(shared_storage_once=False)
+    assert len(lines) == 2 * 2 * 3
+    assert sum(1 for line in lines if 'nodestorage="ceph"' in line) == 6
+    assert not any(line.startswith("proxmox.cluster.storage") for line in lines)
+
+
+def test_shared_once_reports_a_shared_storage_once_for_the_cluster():
+    lines = collect(shared_storage_once=True)
+    node_lines = [line for line in lines if line.startswith("proxmox.node.storage")]
+    cluster_lines = [line for line in lines if line.startswith("proxmox.cluster.storage")]
+    assert len(node_lines) == 2 * 3
+    assert all('nodestorage="local"' in line for line in node_lines)
+    dimensions = ',cluster="lab",clusterid="cluster",storage="ceph",storagetype="rbd"'
+    assert cluster_lines == [
+        f"proxmox.cluster.storage.total{dimensions} gauge,900",
+        f"proxmox.cluster.storage.used{dimensions} gauge,300",
+        f"proxmox.cluster.storage.avail{dimensions} gauge,600",
+    ]
+
+
+def test_the_shared_flag_wins_over_the_storage_type():
+    assert is_shared_storage({"shared": 1}, "dir")
+    assert not is_shared_storage({"shared": 0}, "nfs")
+    # cluster/resources of older releases carries no shared flag
+    assert is_shared_storage({}, "cephfs")
+    assert not is_shared_storage({}, "lvmthin")
+
+
+def test_only_the_first_claim_of_a_storage_wins():
+    claims = SharedStorageClaims()
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(claims.claim("ceph"))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(results) == [False] * 7 + [True]
+    assert claims.claim("nfs")
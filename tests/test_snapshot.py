@@ -0,0 +1,62 @@
+import pytest
+
+from proxmox.snapshot import CycleSnapshot, NodeRecord
+
+# cluster/status of a three node cluster with one node down
+CLUSTER_STATUS = [
+    {"type": "cluster", "id": "cluster", "name": "lab", "nodes": 3, "quorate": 1, "version": 5},
+    {"type": "node", "id": "node/pve1", "name": "pve1", "ip": "10.0.0.1", "online": 1, "nodeid": 1},
+    {"type": "node", "id": "node/pve2", "name": "pve2", "ip": "10.0.0.2", "online": 1, "nodeid": 2},
+    {"type": "node", "id": "node/pve3", "name": "pve3", "ip": "10.0.0.3", "online": 0, "nodeid": 3},
+]
+
+
+def test_records_of_a_cluster_status_response():
+    snapshot = CycleSnapshot.from_cluster_status(CLUSTER_STATUS)
+    cluster = snapshot.cluster
+    assert (cluster.name, cluster.id, cluster.nodes_count, cluster.online_count) == ("lab", "cluster", 3, 2)
+    assert cluster.sdn_status == 1
+    assert cluster.shared_storages is None
+    assert cluster.dimension_string == ',cluster="lab",clusterid="cluster"'
+
+    assert [node.name for node in snapshot.nodes] == ["pve1", "pve2", "pve3"]
+    node = snapshot.nodes[0]
+    assert node.cluster is cluster
+    assert (node.id, node.ip, node.online, node.request) == ("node/pve1", "10.0.0.1", 1, "nodes/pve1")
+    assert node.dimension_string == ',cluster="lab",clusterid="cluster",node="pve1",nodeid="node/pve1"'
+    assert node.status_dimension_string == (
+        ',cluster="lab",clusterid="cluster",node="pve1",nodeip="10.0.0.1",nodeid="node/pve1"'
+    )
+
+
+def test_records_have_no_instance_dictionary():
+    node = CycleSnapshot.from_cluster_status(CLUSTER_STATUS).nodes[0]
+    assert not hasattr(node, "__dict__")
+    with pytest.raises(AttributeError):
+        node.extra = 1
+
+
+def test_an_sdn_zone_that_is_not_ok_clears_the_sdn_status():
+    status = [
+        *CLUSTER_STATUS,
+        {"type": "sdn", "id": "sdn/pve1/zone1", "status": "ok"},
+        {"type": "sdn", "id": "sdn/pve2/zone1", "status": "pending"},
+    ]
+    assert CycleSnapshot.from_cluster_status(status).cluster.sdn_status == 0
+
+
+def test_a_single_node_without_cluster_entry_and_malformed_items():
+    status = ["not a dict", {"type": "node", "id": "node/pve", "name": "pve", "ip": "10.0.0.9", "online": 1}]
+    snapshot = CycleSnapshot.from_cluster_status(status)
+    assert snapshot.cluster.name is None
+    assert [node.name for node in snapshot.nodes] == ["pve"]
+    assert snapshot.cluster.online_count == 1
+
+    snapshot = CycleSnapshot.from_cluster_status(None)
+    assert snapshot.nodes == ()
+
+
+def test_dimension_values_are_escaped():
+    snapshot = CycleSnapshot.from_cluster_status([{"type": "cluster", "name": 'lab "a"', "id": "cluster"}])
+    node = NodeRecord(snapshot.cluster, "pve1", "node/pve1", "10.0.0.1", 1)
+    assert node.dimension_string.startswith(',cluster="lab \\"a\\""')
@@ -0,0 +1,91 @@
+import json
+import random
+
+import pytest
+
+from proxmox.streaming import DataListParser
+
+RESPONSE = {
+    "errors": None,
+    "data": [
+        {"vmid": 100, "name": "web-ä1", "status": "running", "cpu": 0.035, "mem": 1073741824, "tags": ["a"]},
+        {"vmid": 101, "name": 'db "primary"', "status": "stopped", "cpu": 0, "maxcpu": 4.5e-1},
+        {"vmid": 102, "name": "cache", "status": "running", "nested": {"list": [1, 2.25, -3], "flag": True}},
+        {"vmid": 103, "name": None, "status": "running", "uptime": 123456789},
+    ],
+    "total": 4,
+}
+
+
+def parse(body: bytes, sizes):
+    # Feeds the body in chunks of the given sizes, the last size repeats until the body is used up
+    parser = DataListParser()
+    entries = []
+    position = 0
+    index = 0
+    while position < len(body):
+        size = sizes[min(index, len(sizes) - 1)]
+        entries.extend(parser.feed(body[position : position + size]))
+        position += size
+        index += 1
+    entries.extend(parser.close())
+    return parser, entries
+
+
+@pytest.mark.parametrize("indent", [None, 2])
+def test_every_cut_of_the_body_gives_the_entries_of_one_read(indent):
+    body = json.dumps(RESPONSE, indent=indent, ensure_ascii=False).encode()
+    for cut in range(len(body) + 1):
+        parser = DataListParser()
+        entries = parser.feed(body[:cut]) + parser.feed(body[cut:]) + parser.close()
+        assert entries == RESPONSE["data"], cut
+        assert parser.entries == len(RESPONSE["data"])
+
+
+def test_random_chunk_boundaries_give_the_entries_of_one_read():
+    body = json.dumps(RESPONSE, ensure_ascii=False).encode()
+    generator = random.Random(4)
+    for _ in range(200):
+        sizes = [generator.randint(1, 16) for _ in range(len(body))]
+        _, entries = parse(body, sizes)
+        assert entries == RESPONSE["data"]
+
+
+def test_single_bytes_split_multibyte_characters():
+    body = json.dumps({"data": [{"name": "Überprüfung €"}]}, ensure_ascii=False).encode()
+    _, entries = parse(body, [1])
+    assert entries == [{"name": "Überprüfung €"}]
+
+
+def test_a_number_cut_by_the_chunk_is_not_taken_for_complete():
+    parser = DataListParser()
+    assert parser.feed(b'{"data": [3.') == []
+    assert parser.feed(b"5, 12") == [3.5]
+    assert parser.feed(b"0]}") == [120]
+    assert parser.close() == []
+
+
+def test_empty_list_and_data_that_is_not_a_list():
+    _, entries = parse(b'{"data": []}', [4])
+    assert entries == []
+
+    parser, entries = parse(b'{"data": {"vmid": 100}}', [3])
+    assert entries == []
+    assert parser.unexpected == "dict"
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        b'{"data": [{"vmid": 100}',
+        b'{"data": [{"vmid": 100},]}',
+        b'{"data": [{"vmid": 100}] "total": 1}',
+        b'{"data": []} trailing',
+        b'["not", "an", "object"]',
+        b'{"data": [{"vmid": 1OO}]}',
+    ],
+)
+def test_invalid_bodies_raise_value_error(body):
+    for size in (1, 5, len(body)):
+        with pytest.raises(ValueError):
+            parse(body, [size])